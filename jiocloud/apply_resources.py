@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 import argparse
+import gzip
+import json
 import os
+import re
+import string
+import StringIO
+import sys
+import threading
 import time
 import utils
 import yaml
@@ -19,11 +26,63 @@ def get_nova_creds_from_env():
     d['region_name'] = os.environ.get('OS_REGION_NAME')
     return d
 
+class UserData(object):
+    """
+    Userdata read once from `path` and shared by all servers.
+
+    With compress, the payload is gzipped (cloud-init unpacks it). With
+    template, ${var} placeholders are filled in from each server's spec,
+    e.g. ${name}. Rendered payloads are cached on the values of the
+    placeholders the template uses, so a template that only refers to
+    role-wide values like ${flavor} is rendered once per role.
+    """
+    def __init__(self, path, compress=False, template=False):
+        with open(path) as fp:
+            self.data = fp.read()
+        self.compress = compress
+        self.template = template and string.Template(self.data)
+        self.fields = []
+        if self.template:
+            self.fields = sorted(set([m.group('named') or m.group('braced')
+                                      for m in self.template.pattern.finditer(self.data)
+                                      if m.group('named') or m.group('braced')]))
+        self._rendered = {}
+        self.lock = threading.Lock()
+
+    def render(self, server):
+        # Placeholders that are not in the server spec (like $HOME
+        # in a shell script) are left alone
+        key = tuple([(f, str(server[f])) for f in self.fields if f in server])
+        with self.lock:
+            if key not in self._rendered:
+                data = self.data
+                if self.template:
+                    data = self.template.safe_substitute(dict(key))
+                if self.compress:
+                    buf = StringIO.StringIO()
+                    gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+                    gz.write(data)
+                    gz.close()
+                    data = buf.getvalue()
+                self._rendered[key] = data
+            return self._rendered[key]
+
 class ApplyResources(object):
-    def __init__(self):
+    # Seconds between status polls while waiting for servers to boot.
+    # The interval grows by poll_backoff every time a poll sees no
+    # change and drops back to poll_interval when something changes.
+    poll_interval = 1
+    poll_backoff = 1.5
+    max_poll_interval = 15
+    # Servers asked for per listing call; nova returns at most its osapi_max_limit
+    page_size = 1000
+
+    def __init__(self, cache_path=None, cache_ttl=86400):
         self.nova_client = None
-        self._images = {}
-        self._flavors = {}
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self._resolution_cache = None
+        self._resolution_cache_lock = threading.Lock()
 
     def read_resources(self, path):
         fp = file(path)
@@ -38,16 +97,44 @@ class ApplyResources(object):
             self.nova_client = novaclient.Client("1.1", **get_nova_creds_from_env())
         return self.nova_client
 
-    def get_existing_servers(self, project_tag=None, attr_name='name'):
+    @property
+    def resolution_cache(self):
         """
-        This method accepts an option project tag
+        Cache of image and flavor ids, shared by all threads and
+        kept per auth_url and tenant
+        """
+        with self._resolution_cache_lock:
+            if self._resolution_cache is None:
+                creds = get_nova_creds_from_env()
+                namespace = '%s %s' % (creds['auth_url'], creds['project_id'])
+                self._resolution_cache = utils.ResolutionCache(self.cache_path,
+                                                               namespace,
+                                                               self.cache_ttl)
+        return self._resolution_cache
+
+    def iter_existing_servers(self, project_tag=None):
+        """
+        Generate the servers tagged with project_tag, or all servers if
+        no tag is given. The name filter is applied by Nova and results
+        are fetched a page at a time.
         """
         # NOTE we should check for servers only in a certain state
-        nova_client = self.get_nova_client()
-        servers = nova_client.servers.list()
-        if project_tag:
-            servers = [elem for elem in servers if elem.name.endswith('_' + project_tag) ]
-        return [getattr(s, attr_name) for s in servers]
+        suffix = (project_tag and ('_' + project_tag)) or ''
+        search_opts = None
+        if suffix:
+            search_opts = {'name': re.sub(r'([\\.^$*+?{}()\[\]|])', r'\\\1', suffix) + '$'}
+        for server in utils.iter_servers(self.get_nova_client(), search_opts=search_opts,
+                                         page_size=self.page_size):
+            # Nova's name filter is a regex search, so make sure
+            # it really is a suffix match
+            if server.name.endswith(suffix):
+                yield server
+
+    def get_existing_servers(self, project_tag=None, attr_name='name'):
+        """
+        Return the set of attr_name of the servers tagged with project_tag
+        """
+        return set(getattr(s, attr_name) for s in self.iter_existing_servers(project_tag))
 
 
     def generate_desired_servers(self, resources, mappings={}, project_tag=None):
@@ -66,7 +153,11 @@ class ApplyResources(object):
                 for k_,v_ in v.iteritems():
                     if k_ == 'number':
                         continue
-                    server[k_] = mappings.get(k_, {}).get(v_, v_)
+                    mapping = mappings.get(k_, {})
+                    if isinstance(v_, list):
+                        server[k_] = [mapping.get(x, x) for x in v_]
+                    else:
+                        server[k_] = mapping.get(v_, v_)
                 servers_to_create.append(server)
         return servers_to_create
 
@@ -77,39 +168,242 @@ class ApplyResources(object):
         desired_servers = self.generate_desired_servers(resources, mappings, project_tag)
         return [elem for elem in desired_servers if elem['name'] not in existing_servers ]
 
-    def create_servers(self, servers, userdata, key_name=None):
+    def plan(self, resource_file, mappings_file=None, project_tag=None):
+        """
+        Work out what it takes to make the project's servers match the
+        resource file, using a single listing of the existing servers.
+        Returns a dict with:
+
+          create:  specs of the desired servers that do not exist
+          delete:  name and id of existing servers of a role in the
+                   resource file whose index is beyond the role's number
+          replace: name, id, spec and the flavor/image drift of existing
+                   servers that do not match their spec
+          project_tag: the project the plan is for
+
+        Servers of roles that are not in the resource file are left alone.
+        """
+        resources = self.read_resources(resource_file)
+        mappings = mappings_file and self.read_mappings(mappings_file) or {}
+        desired_servers = self.generate_desired_servers(resources, mappings, project_tag)
+        desired = dict((s['name'], s) for s in desired_servers)
+        suffix = (project_tag and ('_' + project_tag)) or ''
+        role_re = re.compile('^(%s)[0-9]+%s$' % ('|'.join([re.escape(r) for r in resources]),
+                                                  re.escape(suffix)))
+
+        existing = set()
+        delete = []
+        replace = []
+        for server in self.iter_existing_servers(project_tag):
+            spec = desired.get(server.name)
+            if spec is None:
+                if resources and role_re.match(server.name):
+                    delete.append({'name': server.name, 'id': server.id})
+                continue
+            existing.add(server.name)
+            drift = self.drift(server, spec)
+            if drift:
+                replace.append({'name': server.name, 'id': server.id,
+                                'spec': spec, 'drift': drift})
+
+        return {'create': [s for s in desired_servers if s['name'] not in existing],
+                'delete': delete,
+                'replace': replace,
+                'project_tag': project_tag}
+
+    def drift(self, server, spec):
+        """
+        Return a dict of the attributes (flavor, image) in which the server
+        differs from its spec, mapped to (actual id, desired id)
+        """
+        nova_client = self.get_nova_client()
+        lookups = {'flavor': nova_client.flavors.get,
+                   'image': nova_client.images.get}
+        drift = {}
+        for attr, lookup in lookups.items():
+            actual = getattr(server, attr, None)
+            # Servers booted from volume have no image
+            if not spec.get(attr) or not actual:
+                continue
+            wanted = self.resolution_cache.get(attr, spec[attr], lambda x: lookup(x).id)
+            if actual.get('id') != wanted:
+                drift[attr] = (actual.get('id'), wanted)
+        return drift
+
+    def apply_plan(self, plan, userdata, key_name=None, concurrency=1, rate=None, timeout=600):
+        """
+        Carry out a plan: delete surplus and drifted servers, wait for
+        them to go away and then create missing and replacement servers.
+        A server that did not go away in time is not replaced, as its
+        name would clash. Returns the failures of both steps and the ids
+        of servers that did not go away in time.
+        """
+        doomed = plan['delete'] + [{'name': r['name'], 'id': r['id']} for r in plan['replace']]
+        failures = []
+        remaining = set()
+        if doomed:
+            failures, remaining = self.destroy_servers(doomed, plan.get('project_tag'),
+                                                       concurrency=concurrency,
+                                                       rate=rate, timeout=timeout)
+        to_create = list(plan['create'])
+        for r in plan['replace']:
+            if r['id'] in remaining:
+                print "Not replacing %s (%s): it has not gone away yet" % (r['name'], r['id'])
+                failures.append((r['spec'], Exception('Old server %s was not deleted' % (r['id'],))))
+            else:
+                to_create.append(r['spec'])
+        if to_create:
+            failures += self.create_servers(to_create, userdata, key_name,
+                                            concurrency=concurrency, rate=rate,
+                                            project_tag=plan.get('project_tag'))
+        return failures, remaining
+
+    def create_servers(self, servers, userdata, key_name=None, concurrency=1, rate=None,
+                       project_tag=None):
+        """
+        Boot servers using up to `concurrency` parallel requests, and no
+        more than `rate` requests per second. A server that fails to be
+        created does not stop the rest of the batch; the failures are
+        returned as a list of (server, exception). With project_tag,
+        which the servers must be tagged with, only the project's
+        servers are listed while waiting for them to boot.
+
+        userdata is either a path or a UserData instance.
+        """
+        if not isinstance(userdata, UserData):
+            userdata = UserData(userdata)
+
+        def create(s):
+            return self.create_server(userdata.render(s), key_name, **s)
+
+        created, failures = utils.run_in_pool(create, servers,
+                                              concurrency=concurrency,
+                                              rate=rate)
+        for s, e in failures:
+            print "Failed to create server %s: %s" % (s['name'], e)
 
         ids = set()
-        floating_ip_servers = set()
-        for s in servers:
-            userdata_file = file(userdata)
-            server_id = self.create_server(userdata_file, key_name, **s)
+        floating_ip_servers = {}
+        for s, server_id in created:
             ids.add(server_id)
 
             if s.get('assign_floating_ip'):
-                floating_ip_servers.add(server_id)
+                floating_ip_servers[server_id] = s
+
+        reused, allocated = self.allocate_floating_ips(len(floating_ip_servers),
+                                                       concurrency=concurrency,
+                                                       rate=rate)
+        free_ips = reused + allocated
+
+        def assign_floating_ip(instance):
+            # Associate as soon as the server is up rather than
+            # waiting for the rest of the batch to finish booting
+            if instance.id not in floating_ip_servers or instance.status != 'ACTIVE':
+                return
+            s = floating_ip_servers.pop(instance.id)
+            if not free_ips:
+                failures.append((s, Exception('No floating IP available')))
+                return
+            ip = free_ips.pop()
+            print "Assigning %s to %s (%s)" % (ip.ip, instance.name, instance.id)
+            try:
+                instance.add_floating_ip(ip.ip)
+            except Exception, e:
+                print "Failed to assign %s to %s: %s" % (ip.ip, instance.name, e)
+                failures.append((s, e))
+
+        done = self.wait_for_servers(ids, project_tag, on_done=assign_floating_ip)
+        self.print_boot_summary(done)
+
+        # Servers that never went ACTIVE didn't get their IP
+        for server_id, s in floating_ip_servers.items():
+            status = server_id in done and done[server_id][1] or 'unknown'
+            print "Not assigning a floating ip to %s (%s): %s" % (s['name'], server_id, status)
+            failures.append((s, Exception('Server went %s, not ACTIVE' % (status,))))
+        for ip in free_ips:
+            if ip in allocated:
+                print "Releasing unused floating ip: %s" % (ip.ip,)
+                try:
+                    ip.delete()
+                except Exception, e:
+                    print "Failed to release floating ip %s: %s" % (ip.ip, e)
+            else:
+                print "Leaving unused floating ip: %s" % (ip.ip,)
+
+        return failures
 
+    def allocate_floating_ips(self, count, concurrency=1, rate=None):
+        """
+        Find `count` floating IPs, reusing the tenant's unassociated ones
+        first and allocating the rest in parallel. Returns the lists of
+        reused and newly allocated IPs, which may come up short if
+        allocations fail.
+        """
+        if not count:
+            return [], []
         nova_client = self.get_nova_client()
+        ips = [ip for ip in nova_client.floating_ips.list() if not ip.instance_id][:count]
+        if ips:
+            print "Reusing floating ip(s): %s" % (', '.join([ip.ip for ip in ips]),)
+        allocated, failures = utils.run_in_pool(lambda _: nova_client.floating_ips.create(),
+                                                range(count - len(ips)),
+                                                concurrency=concurrency,
+                                                rate=rate)
+        for _, e in failures:
+            print "Failed to allocate floating ip: %s" % (e,)
+        return ips, [ip for _, ip in allocated]
 
-        done = set()
-        while ids:
-            time.sleep(5)
-            for id in ids:
-                instance = nova_client.servers.get(id)
-                print "%s (%s): %s" % (instance.name, id, instance.status)
+    def wait_for_servers(self, ids, project_tag=None, on_done=None):
+        """
+        Wait for the given servers to leave the BUILD state, fetching the
+        status of all of them with one paginated listing per poll, of
+        project_tag's servers if given (see iter_existing_servers).
+        on_done, if given, is called with each server as it leaves BUILD.
+        Returns a dict mapping server id to (name, status, seconds spent
+        waiting for it)
+        """
+        pending = set(ids)
+        seen = {}
+        done = {}
+        start = time.time()
+        interval = self.poll_interval
+        while pending:
+            time.sleep(interval)
+            changed = False
+            listed = set()
+            for instance in self.iter_existing_servers(project_tag):
+                if instance.id not in pending:
+                    continue
+                listed.add(instance.id)
+                if seen.get(instance.id) != instance.status:
+                    print "%s (%s): %s" % (instance.name, instance.id, instance.status)
+                    seen[instance.id] = instance.status
+                    changed = True
                 if instance.status != 'BUILD':
-                    done.add(id)
-            ids = ids.difference(done)
-
-        for server_id in floating_ip_servers:
-            ip = nova_client.floating_ips.create()
-            instance = nova_client.servers.get(server_id)
-            print "Assigning %s to %s (%s)" % (ip.ip, instance.name, id)
-            instance.add_floating_ip(ip.ip)
+                    done[instance.id] = (instance.name, instance.status, time.time() - start)
+                    if on_done:
+                        on_done(instance)
+            for id in pending - listed:
+                # Deleted from under us
+                print "%s: DELETED" % (id,)
+                done[id] = (id, 'DELETED', time.time() - start)
+                changed = True
+            pending.difference_update(done)
+            if changed:
+                interval = self.poll_interval
+            else:
+                interval = min(interval * self.poll_backoff, self.max_poll_interval)
+        return done
 
+    def print_boot_summary(self, done):
+        if not done:
+            return
+        print "Time until servers left BUILD:"
+        for name, status, elapsed in sorted(done.values(), key=lambda x: x[2]):
+            print "  %-40s %-8s %6.1fs" % (name, status, elapsed)
 
     def create_server(self,
-                      userdata_file,
+                      userdata,
                       key_name,
                       name,
                       flavor,
@@ -119,58 +413,118 @@ class ApplyResources(object):
                       **keys):
         print "Creating server %s"%(name)
         nova_client = self.get_nova_client()
-        self._images[image] = self._images.get(image, nova_client.images.get(image))
-        self._flavors[flavor] = self._flavors.get(flavor, nova_client.flavors.get(flavor))
+        image_id = self.resolution_cache.get('image', image,
+                                             lambda i: nova_client.images.get(i).id)
+        flavor_id = self.resolution_cache.get('flavor', flavor,
+                                              lambda f: nova_client.flavors.get(f).id)
         net_list = networks and ([{'net-id': n} for n in networks])
         instance = nova_client.servers.create(
           name=name,
-          image=self._images[image],
-          flavor=self._flavors[flavor],
+          image=image_id,
+          flavor=flavor_id,
           nics=net_list,
-          userdata=userdata_file,
+          userdata=userdata,
           key_name=key_name,
           config_drive=config_drive,
         )
 
         return instance.id
 
-    def delete_servers(self, project_tag):
+    def delete_servers(self, project_tag, concurrency=1, rate=None, timeout=600):
+        """
+        Delete every server tagged with project_tag, along with its
+        floating IP. See destroy_servers.
+        """
+        servers = [{'name': s.name, 'id': s.id} for s in self.iter_existing_servers(project_tag)]
+        return self.destroy_servers(servers, project_tag, concurrency, rate, timeout)
+
+    def destroy_servers(self, servers, project_tag=None, concurrency=1, rate=None, timeout=600):
+        """
+        Delete the given servers (dicts with name and id), along with
+        their floating IPs, using up to `concurrency` parallel workers.
+        Then wait for up to `timeout` seconds for them to disappear.
+        Returns the list of (server, exception) that could not be
+        deleted and the set of ids of servers that were still around
+        when the timeout ran out.
+        """
         nova_client = self.get_nova_client()
-        servers = self.get_existing_servers(project_tag=project_tag, attr_name='id')
         ip_to_server_map = {ip.instance_id: ip for ip in nova_client.floating_ips.list()}
-        ips_to_delete = set()
-        for uuid in servers:
-            print "Deleting uuid: %s"%(uuid)
-            server = nova_client.servers.get(uuid)
-            if uuid in ip_to_server_map:
-                ip = ip_to_server_map[uuid]
-                server.remove_floating_ip(ip.ip)
-                ips_to_delete.add(ip)
-            server.delete()
-
-        for ip in ips_to_delete:
-            print "Deleting floating ip: %s" % (ip.ip,)
-            ip.delete()
-
-    def ssh_config(self, servers):
-        out = ''
+
+        def delete(server):
+            print "Deleting %s (%s)" % (server['name'], server['id'])
+            ip = ip_to_server_map.get(server['id'])
+            if ip:
+                nova_client.servers.remove_floating_ip(server['id'], ip.ip)
+            nova_client.servers.delete(server['id'])
+            if ip:
+                print "Deleting floating ip: %s" % (ip.ip,)
+                ip.delete()
+
+        deleted, failures = utils.run_in_pool(delete, servers,
+                                              concurrency=concurrency,
+                                              rate=rate)
+        for server, e in failures:
+            print "Failed to delete server %s: %s" % (server['name'], e)
+
+        remaining = self.wait_for_deletion([server['id'] for server, _ in deleted],
+                                           project_tag, timeout)
+        return failures, remaining
+
+    def wait_for_deletion(self, ids, project_tag=None, timeout=600):
+        """
+        Wait for the given servers to disappear, with one listing of
+        the project's servers per poll. Returns the set of ids that
+        were still present when timeout ran out.
+        """
+        pending = set(ids)
+        deadline = time.time() + timeout
+        interval = self.poll_interval
+        while pending and time.time() < deadline:
+            time.sleep(interval)
+            before = len(pending)
+            pending.intersection_update(self.get_existing_servers(project_tag, attr_name='id'))
+            if len(pending) < before:
+                print "%d server(s) left to delete" % (len(pending),)
+                interval = self.poll_interval
+            else:
+                interval = min(interval * self.poll_backoff, self.max_poll_interval)
+        return pending
+
+    def ssh_config(self, servers, out=None):
+        """
+        Write ssh config for the given servers to the file object `out`,
+        or return it as a string if `out` is not given. The addresses of
+        all the servers are looked up with a single listing.
+        """
+        if out is None:
+            out = StringIO.StringIO()
+            self.ssh_config(servers, out)
+            return out.getvalue()
+
+        ips = utils.get_ip_index(self.get_nova_client(),
+                                 set([s['name'] for s in servers]),
+                                 page_size=self.page_size)
+
+        def ip_of(name):
+            if name not in ips:
+                raise Exception('Server not found')
+            return ips[name]
+
         bastions = filter(lambda s:s.get('assign_floating_ip', False), servers)
         if bastions:
-            bastion = utils.get_ip_of_node(self.get_nova_client(), bastions[0]['name'])
+            bastion = ip_of(bastions[0]['name'])
         else:
             bastion = None
 
-        out += 'StrictHostKeyChecking no\n'
-        out += 'UserKnownHostsFile /dev/null\n'
-        out += '\n'
+        out.write('StrictHostKeyChecking no\n')
+        out.write('UserKnownHostsFile /dev/null\n')
+        out.write('\n')
         for s in servers:
-            out += 'Host %s\n' % (s['name'],)
-            ip = utils.get_ip_of_node(apply_resources.get_nova_client(),  s['name'])
-            out += '    HostName %s\n' % (ip,)
+            out.write('Host %s\n' % (s['name'],))
+            out.write('    HostName %s\n' % (ip_of(s['name']),))
             if not s.get('assign_floating_ip', False) and bastion:
-                out += '    ProxyCommand ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %%r@%s nc %%h %%p\n' % (bastion,)
-            out += '\n'
-        return out
+                out.write('    ProxyCommand ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %%r@%s nc %%h %%p\n' % (bastion,))
+            out.write('\n')
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
@@ -182,9 +536,28 @@ if __name__ == '__main__':
     apply_parser.add_argument('--mappings', help='Path to mappings file')
     apply_parser.add_argument('--project_tag', help='Project tag')
     apply_parser.add_argument('--key_name', help='Name of key pair')
+    apply_parser.add_argument('--userdata_gzip', action='store_true', help='Gzip the userdata before passing it to nova')
+    apply_parser.add_argument('--userdata_template', action='store_true',
+                              help='Substitute ${var} in the userdata with the server\'s properties, e.g. ${name}')
+    apply_parser.add_argument('--concurrency', type=int, default=1, help='Number of servers to create in parallel')
+    apply_parser.add_argument('--rate', type=float, help='Maximum number of create requests per second')
+    apply_parser.add_argument('--prune', action='store_true',
+                              help='Also delete surplus servers and replace ones whose flavor or image changed')
+    apply_parser.add_argument('--timeout', type=int, default=600, help='Seconds to wait for pruned servers to disappear')
+    apply_parser.add_argument('--cache', default=os.path.expanduser('~/.cache/jiocloud/resolution_cache.json'),
+                              help='File to cache image and flavor lookups in')
+    apply_parser.add_argument('--cache_ttl', type=int, default=86400, help='Seconds to keep cached lookups for')
+
+    plan_parser = subparsers.add_parser('plan', help='Show, as JSON, what apply --prune would do')
+    plan_parser.add_argument('resource_file_path', help='Path to resource file')
+    plan_parser.add_argument('--mappings', help='Path to mappings file')
+    plan_parser.add_argument('--project_tag', help='Project tag')
 
     delete_parser = subparsers.add_parser('delete', help='Delete a project')
     delete_parser.add_argument('project_tag', help='Id of project to delete')
+    delete_parser.add_argument('--concurrency', type=int, default=1, help='Number of servers to delete in parallel')
+    delete_parser.add_argument('--rate', type=float, help='Maximum number of delete requests per second')
+    delete_parser.add_argument('--timeout', type=int, default=600, help='Seconds to wait for servers to disappear')
 
     list_parser  = subparsers.add_parser('list', help='List servers described in resource file')
     list_parser.add_argument('resource_file_path', help='Path to resource file')
@@ -197,15 +570,54 @@ if __name__ == '__main__':
 
     args = argparser.parse_args()
     if args.action == 'apply':
+        apply_resources = ApplyResources(cache_path=args.cache, cache_ttl=args.cache_ttl)
+        userdata = UserData(args.userdata, compress=args.userdata_gzip,
+                            template=args.userdata_template)
+        remaining = set()
+        if args.prune:
+            plan = apply_resources.plan(args.resource_file_path,
+                                        args.mappings,
+                                        project_tag=args.project_tag)
+            failures, remaining = apply_resources.apply_plan(plan, userdata,
+                                                             key_name=args.key_name,
+                                                             concurrency=args.concurrency,
+                                                             rate=args.rate,
+                                                             timeout=args.timeout)
+        else:
+            servers = apply_resources.servers_to_create(args.resource_file_path,
+                                                        args.mappings,
+                                                        project_tag=args.project_tag)
+            failures = apply_resources.create_servers(servers, userdata,
+                                                      key_name=args.key_name,
+                                                      concurrency=args.concurrency,
+                                                      rate=args.rate,
+                                                      project_tag=args.project_tag)
+        cache = apply_resources.resolution_cache
+        cache.save()
+        print "Image/flavor cache: %d hits, %d misses" % (cache.hits, cache.misses)
+        if remaining:
+            print "Timed out waiting for %d server(s) to be deleted: %s" % (len(remaining), ', '.join(remaining))
+        if failures:
+            print "Failed to create or delete %d server(s): %s" % (len(failures), ', '.join([s['name'] for s, e in failures]))
+        if failures or remaining:
+            sys.exit(1)
+    elif args.action == 'plan':
         apply_resources = ApplyResources()
-        servers = apply_resources.servers_to_create(args.resource_file_path,
-                                                    args.mappings,
-                                                    project_tag=args.project_tag)
-        apply_resources.create_servers(servers, args.userdata, key_name=args.key_name)
+        plan = apply_resources.plan(args.resource_file_path,
+                                    args.mappings,
+                                    project_tag=args.project_tag)
+        print json.dumps(plan, indent=2, sort_keys=True)
     elif args.action == 'delete':
         if not args.project_tag:
             argparser.error("Must set project tag when action is delete")
-        ApplyResources().delete_servers(project_tag=args.project_tag)
+        failures, remaining = ApplyResources().delete_servers(project_tag=args.project_tag,
+                                                             concurrency=args.concurrency,
+                                                             rate=args.rate,
+                                                             timeout=args.timeout)
+        if remaining:
+            print "Timed out waiting for %d server(s) to be deleted: %s" % (len(remaining), ', '.join(remaining))
+        if failures or remaining:
+            sys.exit(1)
     elif args.action == 'list':
         apply_resources = ApplyResources()
         resources = apply_resources.read_resources(args.resource_file_path)
@@ -215,5 +627,6 @@ if __name__ == '__main__':
         apply_resources = ApplyResources()
         resources = apply_resources.read_resources(args.resource_file_path)
         mappings = apply_resources.read_mappings(args.mappings or '/dev/null')
-        servers = apply_resources.generate_desired_servers(resources, args.project_tag)
-        print apply_resources.ssh_config(servers)
+        servers = apply_resources.generate_desired_servers(resources, mappings or {},
+                                                           project_tag=args.project_tag)
+        apply_resources.ssh_config(servers, sys.stdout)
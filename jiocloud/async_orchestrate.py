@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import argparse
+import json
+import sys
+from tornado import gen
+from tornado import httpclient
+from tornado import ioloop
+from jiocloud.orchestrate import consul_url
+
+"""
+Asynchronous take on the read side of orchestrate, on tornado's HTTP
+client. Every method takes the datacenter to ask, and the *_across
+methods ask several datacenters at once and merge the answers, so a
+question about every region takes as long as the slowest one:
+
+    python -m jiocloud.async_orchestrate --datacenters all check_single_version v12
+"""
+
+# Only the first error of concurrent requests is raised; don't log the rest
+QUIET_EXCEPTIONS = (IOError, httpclient.HTTPError)
+
+class AsyncDeploymentOrchestrator(object):
+    def __init__(self, host='127.0.0.1', port=8500, request_timeout=30, max_clients=50):
+        self.host = host
+        self.port = port
+        self.request_timeout = request_timeout
+        # Enough connections for several requests to every datacenter at once
+        self.http = httpclient.AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+    @gen.coroutine
+    def _consul_request(self, path, params=None, dc=None):
+        """
+        GET a Consul HTTP API path, from datacenter dc if given. Resolves
+        to the decoded JSON body, or None if not found.
+        """
+        params = dict(params or {})
+        if dc:
+            params['dc'] = dc
+        url = 'http://%s:%d%s' % (self.host, self.port, consul_url(path, params))
+        response = yield self.http.fetch(url, request_timeout=self.request_timeout,
+                                         raise_error=False)
+        if response.code == 404:
+            raise gen.Return(None)
+        response.rethrow()
+        raise gen.Return(response.body and json.loads(response.body))
+
+    @gen.coroutine
+    def datacenters(self):
+        dcs = yield self._consul_request('catalog/datacenters')
+        raise gen.Return(dcs or [])
+
+    @gen.coroutine
+    def running_versions(self, dc=None):
+        keys = yield self._consul_request('kv/running_version/', {'keys': True, 'separator': '/'}, dc)
+        raise gen.Return(set([k.split('/')[1] for k in keys or []
+                              if len(k.split('/')) > 2 and k.split('/')[1]]))
+
+    @gen.coroutine
+    def hosts_at_version(self, version, dc=None):
+        prefix = 'running_version/%s/' % (version,)
+        keys = yield self._consul_request('kv/%s' % (prefix,), {'keys': True}, dc)
+        raise gen.Return(set([k[len(prefix):] for k in keys or []
+                              if k[len(prefix):] and '/' not in k[len(prefix):]]))
+
+    @gen.coroutine
+    def get_failures(self, show_warnings=False, dc=None):
+        """
+        Resolves to the list of critical checks (and warning ones, with
+        show_warnings), each with the datacenter it came from added
+        """
+        states = ['critical'] + (show_warnings and ['warning'] or [])
+        results = yield gen.multi([self._consul_request('health/state/%s' % (state,), dc=dc)
+                                   for state in states], quiet_exceptions=QUIET_EXCEPTIONS)
+        checks = []
+        for result in results:
+            for check in result or []:
+                check['Datacenter'] = dc
+                checks.append(check)
+        raise gen.Return(checks)
+
+    @gen.coroutine
+    def check_single_version(self, version, dc=None):
+        running_versions = yield self.running_versions(dc)
+        raise gen.Return(running_versions == set([version]))
+
+    @gen.coroutine
+    def _across(self, method, datacenters, *args):
+        """
+        Call method concurrently for each of datacenters. Resolves to a
+        dict of datacenter to result.
+        """
+        results = yield gen.multi(dict((dc, method(*args, dc=dc)) for dc in datacenters),
+                                  quiet_exceptions=QUIET_EXCEPTIONS)
+        raise gen.Return(results)
+
+    @gen.coroutine
+    def running_versions_across(self, datacenters):
+        results = yield self._across(self.running_versions, datacenters)
+        raise gen.Return(set().union(*results.values()))
+
+    @gen.coroutine
+    def hosts_at_version_across(self, version, datacenters):
+        results = yield self._across(self.hosts_at_version, datacenters, version)
+        raise gen.Return(set().union(*results.values()))
+
+    @gen.coroutine
+    def get_failures_across(self, datacenters, show_warnings=False):
+        results = yield self._across(self.get_failures, datacenters, show_warnings)
+        raise gen.Return(sum([results[dc] for dc in datacenters], []))
+
+    @gen.coroutine
+    def unconverged_datacenters(self, version, datacenters):
+        """
+        Resolves to a dict of each of datacenters where version is not the
+        only one running, including those where nothing is, to the
+        versions running there
+        """
+        results = yield self._across(self.running_versions, datacenters)
+        raise gen.Return(dict((dc, versions) for dc, versions in results.items()
+                              if versions != set([version])))
+
+    @gen.coroutine
+    def check_single_version_across(self, version, datacenters):
+        """
+        Resolves to whether version is the only one running in every one
+        of datacenters
+        """
+        unconverged = yield self.unconverged_datacenters(version, datacenters)
+        raise gen.Return(not unconverged)
+
+@gen.coroutine
+def run(args):
+    do = AsyncDeploymentOrchestrator(args.host, args.port)
+    if args.datacenters == 'all':
+        datacenters = yield do.datacenters()
+    elif args.datacenters:
+        datacenters = args.datacenters.split(',')
+    else:
+        # The local agent's own datacenter
+        datacenters = [None]
+
+    if args.subcmd == 'running_versions':
+        versions = yield do.running_versions_across(datacenters)
+        print '\n'.join(sorted(versions))
+    elif args.subcmd == 'hosts_at_version':
+        hosts = yield do.hosts_at_version_across(args.version, datacenters)
+        print '\n'.join(sorted(hosts))
+    elif args.subcmd == 'get_failures':
+        failures = yield do.get_failures_across(datacenters, args.show_warnings)
+        if args.hosts:
+            for x in failures:
+                print "  Node: %s, Check: %s%s" % (x['Node'], x['Name'],
+                                                 x['Datacenter'] and ', DC: %s' % x['Datacenter'] or '')
+        raise gen.Return(bool(failures))
+    elif args.subcmd == 'check_single_version':
+        unconverged = yield do.unconverged_datacenters(args.version, datacenters)
+        for dc in datacenters:
+            if dc in unconverged:
+                print '%s: running %s' % (dc or 'local',
+                                          ', '.join(sorted(unconverged[dc])) or 'nothing')
+            elif args.verbose:
+                print '%s: only %s' % (dc or 'local', args.version)
+        raise gen.Return(bool(unconverged))
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Query the deployment state of '
+                                                 'several consul datacenters at once')
+    parser.add_argument('--host', type=str,
+                        default='127.0.0.1', help="local consul agent")
+    parser.add_argument('--port', type=int, default=8500, help="consul port")
+    parser.add_argument('--datacenters', type=str,
+                        help="Comma separated datacenters to query, or 'all'. "
+                             "Defaults to the local agent's datacenter")
+    subparsers = parser.add_subparsers(dest='subcmd')
+
+    running_versions_parser = subparsers.add_parser('running_versions', help="List currently running versions")
+    hosts_at_version_parser = subparsers.add_parser('hosts_at_version', help="List hosts at specified version")
+    hosts_at_version_parser.add_argument('version', help="Version to look for")
+    list_failures_parser = subparsers.add_parser('get_failures', help="Return a list of every failed host. Returns non-zero if any check is failing")
+    list_failures_parser.add_argument('--hosts', action='store_true', help="list out failed hosts")
+    list_failures_parser.add_argument('--show_warnings', action='store_true', help="Whether to count warnings as failures")
+    check_single_version_parser = subparsers.add_parser('check_single_version', help="Check if the given version is the only one currently running")
+    check_single_version_parser.add_argument('version', help='The version to check for')
+    check_single_version_parser.add_argument('--verbose', '-v', action='store_true', help='Be verbose')
+    args = parser.parse_args(argv)
+
+    return ioloop.IOLoop.current().run_sync(lambda: run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
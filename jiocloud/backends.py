@@ -0,0 +1,475 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import base64
+import json
+import threading
+import time
+from jiocloud.orchestrate import consul_url
+
+"""
+Stores DeploymentOrchestrator can keep its version registry in.
+
+Keys are '/' separated paths, with or without a leading '/'. Every
+change moves the store's index forward, and the index a read returns
+can be handed back to it to wait for the next change, as with
+Consul's blocking queries. Prefixes that are listed or watched end in
+a '/', since etcd only lists whole directories.
+"""
+
+class Backend(object):
+    # Exceptions that mean the store could not be reached, and that a
+    # watch should back off and retry after
+    errors = ()
+
+    def get(self, key, index=None, wait=None, stale=False):
+        """
+        Return (value or None, index) of a key. With an index, wait until
+        the key changes past it or `wait` seconds have gone by. With
+        stale, any replica may answer.
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys, stale=False):
+        """
+        Return a dict of each of keys to its value, or None if it does not
+        exist. Backends that can read them in one request do so.
+        """
+        return dict((key, self.get(key, stale=stale)[0]) for key in keys)
+
+    def record(self, key):
+        """
+        Return (value, modify index) of a key, or (None, 0) if it does not
+        exist. 0 is also what a check-and-set to create a key expects.
+        """
+        raise NotImplementedError
+
+    def records(self, prefix):
+        """
+        Return a dict of all keys below prefix to (value, modify index)
+        """
+        raise NotImplementedError
+
+    def put(self, key, value, cas=None):
+        """
+        Set a key. With cas, only if its modify index is still cas (0
+        means only if it does not exist). Returns whether the key was set.
+        """
+        raise NotImplementedError
+
+    def delete(self, key, recursive=False):
+        raise NotImplementedError
+
+    def txn(self, ops):
+        """
+        Apply ops, tuples of ('set', key, value), ('cas', key, value,
+        index) or ('delete', key), together. Returns False, having applied
+        none of them, if a check-and-set failed.
+        """
+        raise NotImplementedError
+
+    def keys(self, prefix, separator=None):
+        """
+        List the keys below prefix without their values. With a separator,
+        only the keys up to and including the next separator are returned,
+        so e.g. 'a/' with separator '/' lists the "directories" in a/.
+        """
+        raise NotImplementedError
+
+    def iter_keys(self, prefix):
+        """
+        Generate the keys below prefix. Backends that can stream them do so
+        """
+        return iter(self.keys(prefix))
+
+    def watch_keys(self, prefix, index=None, wait=None, stale=False):
+        """
+        Return (keys below prefix, index), waiting as get does for any key
+        below prefix to change past index first
+        """
+        raise NotImplementedError
+
+class ConsulBackend(Backend):
+    """
+    Consul's KV store, over the HTTP connection of client (a
+    DeploymentOrchestrator). Listings use ?keys and watches blocking
+    queries, and txn is a single /v1/txn request.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def errors(self):
+        from urllib3.exceptions import HTTPError
+        return (IOError, HTTPError)
+
+    def get(self, key, index=None, wait=None, stale=False):
+        data, index = self.client._blocking_get('kv/%s' % key.lstrip('/'), {}, index, wait, stale)
+        value = data and data[0]['Value']
+        if value is not None:
+            value = base64.b64decode(value)
+        return value, index
+
+    def get_many(self, keys, stale=False):
+        """
+        Read keys in one read-only /v1/txn request. Its get verb fails the
+        whole transaction on a missing key, so each key is read with
+        get-tree and anything else below it is ignored.
+        """
+        payload = [{'KV': {'Verb': 'get-tree', 'Key': key.lstrip('/')}} for key in keys]
+        data, headers = self.client._consul_request('PUT', 'txn', body=json.dumps(payload), stale=stale)
+        found = dict((r['KV']['Key'], r['KV']['Value']) for r in (data or {}).get('Results') or [])
+        return dict((key, found.get(key.lstrip('/')) and base64.b64decode(found[key.lstrip('/')]))
+                    for key in keys)
+
+    def record(self, key):
+        data, headers = self.client._consul_request('GET', 'kv/%s' % key.lstrip('/'))
+        if not data:
+            return None, 0
+        value = data[0]['Value']
+        return value and base64.b64decode(value), data[0]['ModifyIndex']
+
+    def records(self, prefix):
+        data, headers = self.client._consul_request('GET', 'kv/%s' % prefix.lstrip('/'), {'recurse': True})
+        return dict((row['Key'], (row['Value'] and base64.b64decode(row['Value']), row['ModifyIndex']))
+                    for row in data or [])
+
+    def put(self, key, value, cas=None):
+        params = {}
+        if cas is not None:
+            params['cas'] = cas
+        result, headers = self.client._consul_request('PUT', 'kv/%s' % key.lstrip('/'), params, body=value)
+        return result is True
+
+    def delete(self, key, recursive=False):
+        self.client._consul_request('DELETE', 'kv/%s' % key.lstrip('/'),
+                                    recursive and {'recurse': True} or None)
+
+    def txn(self, ops):
+        """
+        Apply ops atomically in one /v1/txn request. Returns False if
+        Consul rolled the transaction back because a check-and-set failed.
+        """
+        import urllib3
+        from urllib3.exceptions import HTTPError
+        payload = []
+        for op in ops:
+            kv = {'Verb': op[0], 'Key': op[1].lstrip('/')}
+            if op[0] in ('set', 'cas'):
+                kv['Value'] = base64.b64encode(op[2])
+            if op[0] == 'cas':
+                kv['Index'] = op[3]
+            payload.append({'KV': kv})
+        response = self.client.http.urlopen('PUT', '/v1/txn', body=json.dumps(payload),
+                                            timeout=urllib3.Timeout(connect=5, read=10))
+        if response.status == 409:
+            return False
+        if response.status != 200:
+            raise HTTPError('PUT /v1/txn: %d %s' % (response.status, response.data))
+        return True
+
+    def keys(self, prefix, separator=None):
+        params = {'keys': True}
+        if separator:
+            params['separator'] = separator
+        keys, headers = self.client._consul_request('GET', 'kv/%s' % prefix.lstrip('/'), params)
+        return keys or []
+
+    def iter_keys(self, prefix):
+        """
+        Generate the keys below prefix as they are read off the wire, so
+        the response is never held in memory in full.
+        """
+        import urllib3
+        from urllib3.exceptions import HTTPError
+        url = consul_url('kv/%s' % prefix.lstrip('/'), {'keys': True})
+        response = self.client.http.urlopen('GET', url, preload_content=False,
+                                            timeout=urllib3.Timeout(connect=5, read=30))
+        try:
+            if response.status == 404:
+                return
+            if response.status != 200:
+                raise HTTPError('GET %s: %d %s' % (url, response.status, response.read()))
+            # The body is a flat JSON array of strings. Pull strings out of
+            # it one at a time, keeping any incomplete one for the next chunk
+            decoder = json.JSONDecoder()
+            buf = ''
+            for chunk in response.stream(65536):
+                buf += chunk
+                pos = 0
+                while True:
+                    while pos < len(buf) and buf[pos] in '[], \t\r\n':
+                        pos += 1
+                    if pos == len(buf):
+                        break
+                    try:
+                        key, pos = decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        break
+                    yield key
+                buf = buf[pos:]
+        finally:
+            response.release_conn()
+
+    def watch_keys(self, prefix, index=None, wait=None, stale=False):
+        keys, index = self.client._blocking_get('kv/%s' % prefix.lstrip('/'), {'keys': True},
+                                                index, wait, stale)
+        return keys or [], index
+
+class EtcdBackend(Backend):
+    """
+    etcd's v2 keys API. Watches use ?wait, directories are listed
+    without their contents, and txn is emulated, see there.
+    """
+    def __init__(self, host='127.0.0.1', port=2379, client=None):
+        import etcd
+        self.etcd = etcd
+        self.client = client or etcd.Client(host=host, port=port)
+        self.errors = (etcd.EtcdException,)
+
+    def _path(self, key):
+        return '/' + key.strip('/')
+
+    def _key(self, node):
+        return node.key.lstrip('/') + (node.dir and '/' or '')
+
+    def _read(self, key, **kwargs):
+        """
+        Return (EtcdResult or None if not found, etcd index)
+        """
+        try:
+            result = self.client.read(self._path(key), **kwargs)
+        except self.etcd.EtcdKeyNotFound, e:
+            return None, int((e.payload or {}).get('index', 0))
+        return result, result.etcd_index
+
+    def _wait(self, key, index, wait, recursive=False):
+        """
+        Wait for key (or anything below it) to change after index. Returns
+        the change, or None if there was none within wait seconds or it
+        was too long ago for etcd to tell.
+        """
+        try:
+            return self.client.read(self._path(key), wait=True, waitIndex=index + 1,
+                                    recursive=recursive, timeout=wait or 300)
+        except (self.etcd.EtcdWatchTimedOut, self.etcd.EtcdEventIndexCleared):
+            return None
+
+    def get(self, key, index=None, wait=None, stale=False):
+        if index:
+            change = self._wait(key, index, wait)
+            if change is not None:
+                return (change.action not in ('delete', 'expire') and change.value or None,
+                        change.modifiedIndex)
+        result, index = self._read(key, quorum=not stale)
+        return result and result.value, index
+
+    def record(self, key):
+        result, index = self._read(key, quorum=True)
+        if result is None:
+            return None, 0
+        return result.value, result.modifiedIndex
+
+    def records(self, prefix):
+        result, index = self._read(prefix, recursive=True, quorum=True)
+        return dict((self._key(node), (node.value, node.modifiedIndex))
+                    for node in result and result.leaves or []
+                    if not node.dir)
+
+    def put(self, key, value, cas=None):
+        kwargs = {}
+        if cas == 0:
+            kwargs['prevExist'] = False
+        elif cas is not None:
+            kwargs['prevIndex'] = cas
+        try:
+            self.client.write(self._path(key), value, **kwargs)
+        except (self.etcd.EtcdCompareFailed, self.etcd.EtcdAlreadyExist,
+                self.etcd.EtcdKeyNotFound):
+            return False
+        return True
+
+    def delete(self, key, recursive=False):
+        try:
+            self.client.delete(self._path(key), recursive=recursive or None)
+        except self.etcd.EtcdKeyNotFound:
+            pass
+
+    def txn(self, ops):
+        """
+        etcd v2 has no transactions. The check-and-sets are done first,
+        and if one fails the ones done so far are put back; the sets and
+        deletes follow once they all succeeded. A reader can see the
+        check-and-sets applied before the rest, and a failure part way
+        leaves the ops partly applied.
+        """
+        applied = []
+        for op in ops:
+            if op[0] != 'cas':
+                continue
+            old_value, old_index = self.record(op[1])
+            try:
+                if old_index != op[3]:
+                    raise self.etcd.EtcdCompareFailed()
+                kwargs = op[3] and {'prevIndex': op[3]} or {'prevExist': False}
+                result = self.client.write(self._path(op[1]), op[2], **kwargs)
+            except (self.etcd.EtcdCompareFailed, self.etcd.EtcdAlreadyExist,
+                    self.etcd.EtcdKeyNotFound):
+                for key, value, index in reversed(applied):
+                    if value is None:
+                        self.client.delete(self._path(key), prevIndex=index)
+                    else:
+                        self.client.write(self._path(key), value, prevIndex=index)
+                return False
+            applied.append((op[1], old_value, result.modifiedIndex))
+        for op in ops:
+            if op[0] == 'set':
+                self.client.write(self._path(op[1]), op[2])
+            elif op[0] == 'delete':
+                self.delete(op[1])
+        return True
+
+    def keys(self, prefix, separator=None):
+        if separator:
+            # etcd's directories are what the separator gives consul
+            result, index = self._read(prefix, quorum=True)
+            return sorted([self._key(self.etcd.EtcdResult(None, node))
+                           for node in result and result._children or []])
+        return sorted(self.records(prefix))
+
+    def watch_keys(self, prefix, index=None, wait=None, stale=False):
+        if index:
+            self._wait(prefix, index, wait, recursive=True)
+        result, index = self._read(prefix, recursive=True, quorum=not stale)
+        return sorted([self._key(node) for node in result and result.leaves or []
+                       if not node.dir]), index
+
+class MemoryBackend(Backend):
+    """
+    In-process store for tests and benchmarks. It behaves like consul's
+    KV store, transactions and blocking reads included. Every call is
+    counted in calls and takes `latency` seconds.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = {}
+        # Key to (value, modify index)
+        self._data = {}
+        # Key to the index it last changed at, deletes included
+        self._changes = {}
+        # Like consul's, the index of an empty store is 1
+        self._index = 1
+        self._cond = threading.Condition()
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _set(self, key, value):
+        self._index += 1
+        self._data[key] = (value, self._index)
+        self._changes[key] = self._index
+
+    def _delete(self, key):
+        if key in self._data:
+            self._index += 1
+            del self._data[key]
+            self._changes[key] = self._index
+
+    def _below(self, prefix):
+        return sorted([k for k in self._data if k.startswith(prefix)])
+
+    def _wait_past(self, changed_at, index, wait):
+        """
+        With the lock held, wait until changed_at() is past index or wait
+        seconds have gone by. Returns the index to report.
+        """
+        deadline = time.time() + (wait or 300)
+        while index and changed_at() <= index:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        return changed_at() or self._index
+
+    def get(self, key, index=None, wait=None, stale=False):
+        self._call('get')
+        key = key.lstrip('/')
+        with self._cond:
+            index = self._wait_past(lambda: self._changes.get(key, 0), index, wait)
+            return self._data.get(key, (None, 0))[0], index
+
+    def get_many(self, keys, stale=False):
+        self._call('get_many')
+        with self._cond:
+            return dict((key, self._data.get(key.lstrip('/'), (None, 0))[0]) for key in keys)
+
+    def record(self, key):
+        self._call('record')
+        with self._cond:
+            return self._data.get(key.lstrip('/'), (None, 0))
+
+    def records(self, prefix):
+        self._call('records')
+        with self._cond:
+            return dict((k, self._data[k]) for k in self._below(prefix.lstrip('/')))
+
+    def put(self, key, value, cas=None):
+        self._call('put')
+        return self._apply([cas is None and ('set', key, value) or ('cas', key, value, cas)])
+
+    def delete(self, key, recursive=False):
+        self._call('delete')
+        key = key.lstrip('/')
+        with self._cond:
+            for k in recursive and self._below(key) or [key]:
+                self._delete(k)
+            self._cond.notify_all()
+
+    def txn(self, ops):
+        self._call('txn')
+        return self._apply(ops)
+
+    def _apply(self, ops):
+        with self._cond:
+            for op in ops:
+                if op[0] == 'cas' and self._data.get(op[1].lstrip('/'), (None, 0))[1] != op[3]:
+                    return False
+            for op in ops:
+                if op[0] == 'delete':
+                    self._delete(op[1].lstrip('/'))
+                else:
+                    self._set(op[1].lstrip('/'), op[2])
+            self._cond.notify_all()
+        return True
+
+    def keys(self, prefix, separator=None):
+        self._call('keys')
+        prefix = prefix.lstrip('/')
+        with self._cond:
+            keys = self._below(prefix)
+        if separator:
+            keys = sorted(set([separator in k[len(prefix):] and
+                               prefix + k[len(prefix):].split(separator)[0] + separator or k
+                               for k in keys]))
+        return keys
+
+    def watch_keys(self, prefix, index=None, wait=None, stale=False):
+        self._call('watch_keys')
+        prefix = prefix.lstrip('/')
+        def changed_at():
+            return max([i for k, i in self._changes.items() if k.startswith(prefix)] or [0])
+        with self._cond:
+            index = self._wait_past(changed_at, index, wait)
+            return self._below(prefix), index
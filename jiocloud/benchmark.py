@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+import yaml
+from jiocloud import apply_resources
+from jiocloud import fakenova
+from jiocloud import utils
+
+"""
+Runs the apply_resources subcommands against a fake nova at
+increasing numbers of servers and reports wall time, API calls
+and peak memory for each run.
+
+    python -m jiocloud.benchmark --sizes 10,100,1000 --latency 0.001
+"""
+
+ROLES = ['cp', 'ct', 'st', 'gw']
+
+def write_resources(path, size):
+    resources = {}
+    for i, role in enumerate(ROLES):
+        resources[role] = {'number': size / len(ROLES) + (i < size % len(ROLES)),
+                           'flavor': 'm1.medium',
+                           'image': 'trusty',
+                           'networks': ['private']}
+    resources['gw']['assign_floating_ip'] = True
+    with open(path, 'w') as fp:
+        yaml.dump({'resources': resources}, fp)
+
+def setup(workdir, size, options):
+    nova_client = fakenova.FakeNovaClient(latency=options.latency,
+                                          build_time=options.build_time,
+                                          max_limit=options.max_limit)
+    ar = apply_resources.ApplyResources()
+    ar.nova_client = nova_client
+    ar._resolution_cache = utils.ResolutionCache()
+    ar.poll_interval = options.poll_interval
+    ar.page_size = options.max_limit
+    resource_file = os.path.join(workdir, 'resources_%d.yaml' % (size,))
+    write_resources(resource_file, size)
+    userdata = os.path.join(workdir, 'userdata')
+    with open(userdata, 'w') as fp:
+        fp.write('#!/bin/sh\necho hello\n')
+    return ar, nova_client, resource_file, userdata
+
+def populate(ar, nova_client, resource_file):
+    servers = ar.generate_desired_servers(ar.read_resources(resource_file), project_tag='bench')
+    nova_client.add_servers([s['name'] for s in servers])
+    return servers
+
+def run_apply(ar, nova_client, resource_file, userdata, options):
+    servers = ar.servers_to_create(resource_file, project_tag='bench')
+    ar.create_servers(servers, userdata, concurrency=options.concurrency, project_tag='bench')
+
+def run_delete(ar, nova_client, resource_file, userdata, options):
+    populate(ar, nova_client, resource_file)
+    nova_client.calls.clear()
+    ar.delete_servers('bench', concurrency=options.concurrency)
+
+def run_list(ar, nova_client, resource_file, userdata, options):
+    resources = ar.read_resources(resource_file)
+    desired_servers = ar.generate_desired_servers(resources, project_tag='bench')
+    '\n'.join([s['name'] for s in desired_servers])
+
+def run_ssh_config(ar, nova_client, resource_file, userdata, options):
+    servers = populate(ar, nova_client, resource_file)
+    nova_client.calls.clear()
+    ar.ssh_config(servers, StringIO.StringIO())
+
+ACTIONS = {'apply': run_apply,
+           'delete': run_delete,
+           'list': run_list,
+           'ssh_config': run_ssh_config}
+
+def measure(action, size, options, workdir):
+    """
+    Run one action at one size and return (seconds, api calls, peak rss in KB)
+    """
+    ar, nova_client, resource_file, userdata = setup(workdir, size, options)
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        start = time.time()
+        ACTIONS[action](ar, nova_client, resource_file, userdata, options)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+    return (elapsed, dict(nova_client.calls),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def _measure_in_child(queue, *args):
+    try:
+        queue.put(measure(*args))
+    except Exception, e:
+        queue.put(e)
+        raise
+
+def measure_in_subprocess(*args):
+    """
+    Run measure() in a fresh process so peak memory is per run
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure_in_child, args=(queue,) + args)
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark apply_resources against a fake nova')
+    parser.add_argument('--sizes', default='10,100,1000,5000',
+                        help='Comma separated numbers of servers')
+    parser.add_argument('--actions', default=','.join(sorted(ACTIONS)),
+                        help='Comma separated subcommands to run')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds per fake API call')
+    parser.add_argument('--build_time', type=float, default=0, help='Seconds servers stay in BUILD')
+    parser.add_argument('--max_limit', type=int, default=1000, help='Maximum page size of listings')
+    parser.add_argument('--poll_interval', type=float, default=0.01, help='Initial status poll interval')
+    parser.add_argument('--concurrency', type=int, default=10, help='Parallel API requests')
+    parser.add_argument('--in_process', action='store_true',
+                        help="Don't fork per run (peak memory is then cumulative)")
+    args = parser.parse_args(argv)
+
+    run = args.in_process and measure or measure_in_subprocess
+    workdir = tempfile.mkdtemp()
+    try:
+        print '%-10s %6s %9s %7s %9s  %s' % ('action', 'size', 'seconds', 'calls', 'peak KB', 'calls by type')
+        for action in args.actions.split(','):
+            for size in [int(s) for s in args.sizes.split(',')]:
+                elapsed, calls, maxrss = run(action, size, args, workdir)
+                print '%-10s %6d %9.3f %7d %9d  %s' % (action, size, elapsed, sum(calls.values()), maxrss,
+                                                      ', '.join(['%s=%d' % c for c in sorted(calls.items())]))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
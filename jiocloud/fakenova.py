@@ -0,0 +1,214 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import collections
+import itertools
+import re
+import threading
+import time
+
+"""
+In-process stand-in for the parts of the nova client used by
+apply_resources, for tests and benchmarks.
+
+Every API call is counted in FakeNovaClient.calls and takes `latency`
+seconds. Servers stay in BUILD for `build_time` seconds and linger as
+DELETED for `delete_time` seconds after being deleted. Listings return
+at most `max_limit` servers per page, like Nova's osapi_max_limit.
+"""
+
+class NotFound(Exception):
+    pass
+
+class FakeResource(object):
+    def __init__(self, manager, **attrs):
+        self.manager = manager
+        self.__dict__.update(attrs)
+
+class FakeServer(FakeResource):
+    @property
+    def status(self):
+        now = time.time()
+        if self.deleted_at is not None:
+            return 'DELETED'
+        if now < self.created_at + self.manager.client.build_time:
+            return 'BUILD'
+        return 'ACTIVE'
+
+    def add_floating_ip(self, address):
+        self.manager.add_floating_ip(self, address)
+
+    def remove_floating_ip(self, address):
+        self.manager.remove_floating_ip(self, address)
+
+    def delete(self):
+        self.manager.delete(self)
+
+class FakeFloatingIP(FakeResource):
+    def delete(self):
+        self.manager.delete(self)
+
+def getid(obj):
+    return getattr(obj, 'id', obj)
+
+class FakeServerManager(object):
+    def __init__(self, client):
+        self.client = client
+        self._servers = collections.OrderedDict()
+        self._ids = itertools.count(1)
+
+    def _visible(self):
+        now = time.time()
+        for server in self._servers.values():
+            if server.deleted_at is not None and \
+               now >= server.deleted_at + self.client.delete_time:
+                del self._servers[server.id]
+                continue
+            yield server
+
+    def create(self, name, image, flavor, nics=None, userdata=None,
+               key_name=None, config_drive=False, **kwargs):
+        self.client._call('servers.create')
+        with self.client.lock:
+            n = self._ids.next()
+            server = FakeServer(self,
+                                id='server-%08d' % n,
+                                name=name,
+                                image={'id': getid(image)},
+                                flavor={'id': getid(flavor)},
+                                networks={'private': ['10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)]},
+                                userdata=userdata,
+                                key_name=key_name,
+                                created_at=time.time(),
+                                deleted_at=None)
+            self._servers[server.id] = server
+        return server
+
+    def get(self, server):
+        self.client._call('servers.get')
+        with self.client.lock:
+            for s in self._visible():
+                if s.id == getid(server):
+                    return s
+        raise NotFound(getid(server))
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None):
+        self.client._call('servers.list')
+        name_re = search_opts and search_opts.get('name') and re.compile(search_opts['name'])
+        limit = min(limit or self.client.max_limit, self.client.max_limit)
+        with self.client.lock:
+            servers = list(self._visible())
+        if marker is not None:
+            ids = [s.id for s in servers]
+            servers = servers[ids.index(marker) + 1:]
+        page = []
+        for server in servers:
+            if len(page) == limit:
+                break
+            if not name_re or name_re.search(server.name):
+                page.append(server)
+        return page
+
+    def delete(self, server):
+        self.client._call('servers.delete')
+        with self.client.lock:
+            server = self._servers[getid(server)]
+            server.deleted_at = time.time()
+            for ip in self.client.floating_ips._ips.values():
+                if ip.instance_id == server.id:
+                    ip.instance_id = None
+
+    def add_floating_ip(self, server, address):
+        self.client._call('servers.add_floating_ip')
+        with self.client.lock:
+            self.client.floating_ips._by_address(address).instance_id = getid(server)
+            self._servers[getid(server)].networks['private'].append(address)
+
+    def remove_floating_ip(self, server, address):
+        self.client._call('servers.remove_floating_ip')
+        with self.client.lock:
+            self.client.floating_ips._by_address(address).instance_id = None
+            self._servers[getid(server)].networks['private'].remove(address)
+
+class FakeLookupManager(object):
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+
+    def get(self, name):
+        self.client._call('%s.get' % (self.kind,))
+        return FakeResource(self, id='%s-%s' % (self.kind, name), name=name)
+
+class FakeFloatingIPManager(object):
+    def __init__(self, client):
+        self.client = client
+        self._ips = collections.OrderedDict()
+        self._ids = itertools.count(1)
+
+    def _by_address(self, address):
+        for ip in self._ips.values():
+            if ip.ip == address:
+                return ip
+        raise NotFound(address)
+
+    def list(self):
+        self.client._call('floating_ips.list')
+        with self.client.lock:
+            return list(self._ips.values())
+
+    def create(self, pool=None):
+        self.client._call('floating_ips.create')
+        with self.client.lock:
+            n = self._ids.next()
+            ip = FakeFloatingIP(self, id=n, ip='198.51.%d.%d' % (n >> 8 & 255, n & 255),
+                                instance_id=None)
+            self._ips[n] = ip
+        return ip
+
+    def delete(self, ip):
+        self.client._call('floating_ips.delete')
+        with self.client.lock:
+            del self._ips[getid(ip)]
+
+class FakeNovaClient(object):
+    def __init__(self, latency=0, build_time=0, delete_time=0, max_limit=1000):
+        self.latency = latency
+        self.build_time = build_time
+        self.delete_time = delete_time
+        self.max_limit = max_limit
+        self.lock = threading.RLock()
+        self.calls = collections.Counter()
+        self.servers = FakeServerManager(self)
+        self.images = FakeLookupManager(self, 'images')
+        self.flavors = FakeLookupManager(self, 'flavors')
+        self.floating_ips = FakeFloatingIPManager(self)
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_servers(self, names, image='image', flavor='flavor'):
+        """
+        Populate the fake with ACTIVE servers, without counting API calls
+        """
+        latency, self.latency = self.latency, 0
+        try:
+            servers = [self.servers.create(name, image, flavor) for name in names]
+            for server in servers:
+                server.created_at = 0
+        finally:
+            self.latency = latency
+            self.calls.clear()
+        return servers
@@ -19,15 +19,21 @@ import errno
 import sys
 import socket
 import time
-import urllib3
-import urlparse
 import os
-import netifaces
-import re
+import random
 import json
-import yaml
-import consulate
-from urllib3.exceptions import HTTPError
+
+def consul_url(path, params=None):
+    """
+    Build the URL of a Consul HTTP API path below /v1/. Params with a
+    value of True are sent as bare flags (e.g. ?recurse), and ones with
+    a list value are repeated for each item.
+    """
+    import urllib
+    query = '&'.join([v is True and k or '%s=%s' % (k, urllib.quote(str(v), safe=''))
+                      for k, values in sorted((params or {}).items())
+                      for v in (isinstance(values, list) and values or [values])])
+    return '/v1/%s%s' % (path, query and '?' + query or '')
 
 class DeploymentOrchestrator(object):
     UPDATE_AVAILABLE = 0
@@ -35,25 +41,145 @@ class DeploymentOrchestrator(object):
     NO_CLUE = 2
     NO_CLUE_BUT_WERE_JUST_GETTING_STARTED = 3
 
-    def __init__(self, host='127.0.0.1', port=8500):
+    # Longest and shortest time to back off for after a failed poll
+    max_backoff = 60
+    min_backoff = 1
+
+    # Hosts' roles are the start of their names, e.g. cp in cp1_abc
+    role_pattern = r'^(\D+)\d'
+
+    # Where the state of a rollout is kept
+    rollout_key = 'rollout/state'
+
+    # Consul takes at most this many operations per transaction
+    max_txn_ops = 64
+
+    # In fleet mode, how far behind the leader (in seconds) a server may
+    # be before a stale read from it is redone against the leader
+    max_stale = 5
+
+    def __init__(self, host='127.0.0.1', port=8500, fleet=False, backend=None):
         self.host = host
         self.port = port
+        # Fleet mode spreads the load of many nodes polling at once: reads
+        # may be served by any consul server and retries are jittered
+        self.fleet = fleet
         self._consul = None
         self._kv = None
+        self._http = None
+        # Where the version registry is kept, consul's KV store by default
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if not self._backend:
+            from jiocloud.backends import ConsulBackend
+            self._backend = ConsulBackend(self)
+        return self._backend
 
     @property
     def consul(self):
         if not self._consul:
+            import consulate
             self._consul = session = consulate.Consulate(self.host, self.port)
         return self._consul
 
+    @property
+    def http(self):
+        if not self._http:
+            import urllib3
+            self._http = urllib3.HTTPConnectionPool(self.host, self.port,
+                                                    maxsize=4, retries=False)
+        return self._http
+
+    def _consul_request(self, method, path, params=None, body=None, read_timeout=10,
+                        stale=False):
+        """
+        Make a request to Consul's HTTP API. Returns (decoded JSON body
+        or None if not found, response headers). With stale in fleet
+        mode, any consul server may answer, unless it has lost touch
+        with the leader for longer than max_stale.
+        """
+        import urllib3
+        from urllib3.exceptions import HTTPError
+        if stale and self.fleet:
+            data, headers = self._consul_request(method, path, dict(params or {}, stale=True),
+                                                 body, read_timeout)
+            if headers.get('X-Consul-KnownLeader') != 'false' and \
+               int(headers.get('X-Consul-LastContact', 0)) <= self.max_stale * 1000:
+                return data, headers
+        url = consul_url(path, params)
+        response = self.http.urlopen(method, url, body=body,
+                                     timeout=urllib3.Timeout(connect=5, read=read_timeout))
+        if response.status == 404:
+            return None, response.headers
+        if response.status != 200:
+            raise HTTPError('%s %s: %d %s' % (method, url, response.status, response.data))
+        return response.data and json.loads(response.data), response.headers
+
+    def _blocking_get(self, path, params, index=None, wait=None, stale=False):
+        """
+        GET path, as a blocking query if index is given. Returns (decoded
+        JSON body or None if not found, X-Consul-Index).
+        """
+        params = dict(params)
+        read_timeout = 10
+        if index is not None:
+            params['index'] = index
+        if wait is not None:
+            params['wait'] = '%ds' % wait
+            # Consul adds up to wait/16 of jitter to blocking queries
+            read_timeout += wait + wait / 16.0
+        data, headers = self._consul_request('GET', path, params,
+                                             read_timeout=read_timeout, stale=stale)
+        return data, int(headers.get('X-Consul-Index', 0))
+
+    def _follow(self, fetch, callback, stop, wait=300):
+        """
+        Call callback with what fetch(index, wait) returns now and every
+        time it changes, until the stop event is set. fetch returns
+        (data, index) and, given an index, waits up to wait seconds for
+        the data to change past it, as a blocking query does.
+        """
+        from urllib3.exceptions import HTTPError
+        errors = (IOError, HTTPError) + tuple(self.backend.errors)
+        index = 0
+        failures = 0
+        while not stop.is_set():
+            try:
+                data, new_index = fetch(index, wait)
+            except errors:
+                time.sleep(self.backoff(failures))
+                failures += 1
+                continue
+            failures = 0
+            if index == 0 or new_index != index:
+                callback(data)
+            # As in watch_update, start over if the index goes backwards
+            index = new_index >= index and new_index or 0
+
+    def backoff(self, attempt, jitter=False):
+        """
+        Seconds to wait before retrying after `attempt` failures in a row.
+        Jittered in fleet mode, or with jitter.
+        """
+        delay = min(self.min_backoff * 2 ** attempt, self.max_backoff)
+        if self.fleet or jitter:
+            # Keep nodes that failed together from retrying together
+            delay = random.uniform(delay / 2.0, delay)
+        return delay
+
     def trigger_update(self, new_version):
-        self.consul.kv.set('/current_version', new_version)
+        self.backend.put('current_version', new_version)
 
-    def pending_update(self):
+    def pending_update(self, hostname=None):
         local_version = self.local_version()
         try:
-            if (self.current_version() == local_version):
+            if hostname:
+                wanted_version = self.target_version(hostname)
+            else:
+                wanted_version = self.current_version()
+            if (wanted_version == local_version):
                 return self.UP_TO_DATE
             else:
                 return self.UPDATE_AVAILABLE
@@ -64,85 +190,447 @@ class DeploymentOrchestrator(object):
                 return self.NO_CLUE_BUT_WERE_JUST_GETTING_STARTED
 
     def current_version(self):
-        return str(self.consul.kv.get('/current_version')).strip()
+        value, index = self.backend.get('/current_version', stale=True)
+        return str(value).strip()
+
+    def target_version(self, hostname):
+        """
+        The version hostname should run: the one a rollout has set in
+        /target_version/<hostname>, or else /current_version. Both keys
+        are read at once.
+        """
+        return str(self._target_value(hostname)).strip()
+
+    def _target_value(self, hostname):
+        target_key = 'target_version/%s' % (hostname,)
+        values = self.backend.get_many([target_key, 'current_version'], stale=True)
+        return values[target_key] or values['current_version']
+
+    def watch_target_version(self, hostname, known_version=None, wait=300, timeout=None, splay=0):
+        """
+        Like watch_update, but for the version hostname should run (see
+        target_version).
+        """
+        return self.watch_update(known_version, wait, timeout, splay, hostname=hostname)
+
+    def watch_update(self, known_version=None, wait=300, timeout=None, splay=0, hostname=None):
+        """
+        Wait until /current_version differs from known_version (the local
+        version by default), holding a single Consul blocking query open
+        at a time instead of polling. Returns the new version, after a
+        random delay of up to `splay` seconds so that watchers don't all
+        act on it at once, or None if `timeout` seconds pass first.
+
+        With hostname, wait for the version hostname should run instead.
+        Rollouts touch /current_version as they admit each wave, so the
+        same single query notices them, and hostname's target is only
+        read when /current_version has changed or been touched.
+        """
+        from urllib3.exceptions import HTTPError
+        if known_version is None:
+            known_version = self.local_version()
+        deadline = timeout and time.time() + timeout
+        index = 0
+        failures = 0
+        target = None
+        while True:
+            remaining = deadline and deadline - time.time()
+            if deadline and remaining <= 0:
+                return None
+            try:
+                value, new_index = self.backend.get('/current_version', index=index,
+                                                    wait=max(int(min(wait, remaining or wait)), 1),
+                                                    stale=True)
+                if hostname:
+                    # A query that timed out leaves the index alone, and
+                    # the target we last read still holds
+                    if index == 0 or new_index != index:
+                        target = self._target_value(hostname)
+                    value = target
+            except (IOError, HTTPError) + tuple(self.backend.errors):
+                time.sleep(self.backoff(failures))
+                failures += 1
+                continue
+            failures = 0
+            if value is not None and value.strip() != known_version:
+                if splay:
+                    time.sleep(random.uniform(0, splay))
+                return value.strip()
+            # The index can go backwards, e.g. after a leader election;
+            # start over rather than waiting on an index that won't come
+            index = new_index >= index and new_index or 0
+
+    def _touch_current_version(self):
+        """
+        Rewrite /current_version with the value it has, to wake whoever
+        is watching it (see watch_update) without changing it. If it is
+        changed meanwhile, its watchers are woken anyway.
+        """
+        value, index = self.backend.record('current_version')
+        if index:
+            self.backend.put('current_version', value or '', cas=index)
 
     # TODO this does not work yet...
     def ping(self):
+        from urllib3.exceptions import HTTPError
         try:
             return bool(self.consul.agent.members())
         except (IOError, HTTPError):
             return False
 
-    def update_own_status(self, hostname, status_type, status_result):
-        status_dir = '/status/%s' % status_type
+    def check_state(self, status_type, status_result):
+        """
+        Map a command's exit code to the state of its TTL check
+        """
         if status_type == 'puppet':
             if int(status_result) in (4, 6, 1):
-                self.consul.agent.check.ttl_fail('puppet')
+                state = 'fail'
             elif int(status_result) == -1:
-                self.consul.agent.check.ttl_warn('puppet')
+                state = 'warn'
             else:
-                self.consul.agent.check.ttl_pass('puppet')
+                state = 'pass'
         elif status_type == 'validation':
             if int(status_result) == 0:
-                self.consul.agent.check.ttl_pass('validation')
+                state = 'pass'
             else:
-                self.consul.agent.check.ttl_fail('validation')
+                state = 'fail'
         else:
             raise Exception('Invalid status_type:%s' % status_type)
+        return state
+
+    def update_own_status(self, hostname, status_type, status_result):
+        # The TTL check endpoints are hit directly rather than through
+        # consulate, which takes longer to import than the update takes
+        state = self.check_state(status_type, status_result)
+        self._consul_request('PUT', 'agent/check/%s/%s' % (state, status_type))
 
-    # this is not removing outdated versions?
-    def update_own_info(self, hostname, version=None):
+    def report(self, hostname, statuses, version=None):
+        """
+        Do what update_own_status does for each (status_type,
+        status_result) in statuses and then what update_own_info does,
+        over one connection. Check updates go to the local agent, which
+        has no batch API for them; the registration is one transaction
+        (and only reads if the version has not changed).
+        """
+        # Fail on a bad status before updating anything
+        states = [(status_type, self.check_state(status_type, status_result))
+                  for status_type, status_result in statuses]
+        for status_type, state in states:
+            self._consul_request('PUT', 'agent/check/%s/%s' % (state, status_type))
+        return self.update_own_info(hostname, version)
+
+    def update_own_info(self, hostname, version=None, attempts=10):
+        """
+        Register hostname as running version and remove it from the
+        version it ran before, along with the matching changes to the
+        version counters, in a single transaction. The version each host
+        is registered at is kept in /host_version/<hostname>. Conflicts
+        are retried after a jittered backoff; if they go on for
+        `attempts` tries, the host is registered without touching the
+        counters, which reconcile_version_counts can then put right.
+        A host already registered at version is left as it is, so
+        reporting an unchanged version only reads.
+        """
         version = version or self.local_version()
         if not version:
             return
-        version_dir = '/running_version/%s' % version
-        self.consul.kv.set('%s/%s' % (version_dir, hostname), str(time.time()))
+        for attempt in range(attempts):
+            if attempt:
+                # Hosts that conflicted with each other shouldn't retry together
+                time.sleep(self.backoff(attempt - 1, jitter=True))
+            ops = self._register_version_ops(hostname, version)
+            if not ops or self.backend.txn(ops):
+                return
+        ops = self._register_version_ops(hostname, version, counters=False)
+        if ops:
+            self.backend.txn(ops)
 
-    # this call may not scale
-    # if pulls down all host version records as
-    # a single hash
-    def running_versions(self):
-        try:
-            res = self.consul.kv.find('/running_version')
-            return set([x.split('/')[2] for x in res])
-        except (KeyError, IndexError):
-            return set()
-
-    # this call may not scale
-    # if pulls down all host version records as
-    # a single hash
-    def hosts_at_version(self, version):
-        version_dir = '/running_version/%s' % (version,)
-        try:
-            res = self.consul.kv.find(version_dir)
-        except KeyError:
+    def _register_version_ops(self, hostname, version, counters=True):
+        pointer = 'host_version/%s' % hostname
+        entry = 'running_version/%s/%s' % (version, hostname)
+        old_version, pointer_index = self.backend.record(pointer)
+        if old_version == version and self.backend.record(entry)[1]:
+            # Already registered, nothing to do
             return []
+        # The check-and-set on the pointer makes the transaction fail if
+        # anything else moved this host since we read it
+        ops = [('set', entry, str(time.time())),
+               counters and ('cas', pointer, version, pointer_index) or ('set', pointer, version)]
+        if old_version == version:
+            return ops
+
+        if old_version:
+            stale = [old_version]
+            registered = False
+        else:
+            # Registered before /host_version was kept, or never.
+            # This is a one-off per host, so look at every version.
+            def is_registered(v):
+                return self.backend.record('running_version/%s/%s' % (v, hostname))[1] != 0
+            stale = [v for v in self.running_versions() if v != version and is_registered(v)]
+            registered = is_registered(version)
+
+        counts = counters and self.backend.records('version_count/') or {}
+        def count_op(v, delta):
+            key = 'version_count/%s' % v
+            value, index = counts.get(key, (None, 0))
+            return ('cas', key, str(max(int(value or 0) + delta, 0)), index)
+
+        for v in stale:
+            ops.append(('delete', 'running_version/%s/%s' % (v, hostname)))
+            if counters:
+                ops.append(count_op(v, -1))
+        if counters and not registered:
+            ops.append(count_op(version, 1))
+        return ops
+
+    def version_counts(self):
+        """
+        Return a dict of version to the number of hosts running it,
+        from the counters kept by update_own_info
+        """
+        prefix = 'version_count/'
+        return dict((key[len(prefix):], int(value or 0))
+                    for key, (value, index) in self.backend.records(prefix).items()
+                    if key[len(prefix):])
+
+    def reconcile_version_counts(self):
+        """
+        Rebuild the version counters from the hosts registered under
+        /running_version. Returns a dict of version to (old, new) count
+        for the counters that were wrong.
+        """
+        counts = self.version_counts()
+        actual = dict((version, len(self.hosts_at_version(version)))
+                      for version in self.running_versions())
+        fixed = {}
+        for version in set(counts) | set(actual):
+            old, new = counts.get(version, 0), actual.get(version, 0)
+            if version not in actual:
+                self.backend.delete('/version_count/%s' % version)
+            elif old != new or version not in counts:
+                self.backend.put('/version_count/%s' % version, str(new))
+            else:
+                continue
+            fixed[version] = (old, new)
+        return fixed
+
+    def live_nodes(self):
+        nodes, headers = self._consul_request('GET', 'catalog/nodes')
+        return set([n['Node'] for n in nodes or []])
+
+    def gc_versions(self, dry_run=False, batch_size=None, verbose=False):
+        """
+        Remove the /running_version entries (and /host_version pointers)
+        of hosts that are no longer in Consul's catalog. Versions are
+        walked one at a time and their keys streamed, so apart from the
+        catalog only one batch of hosts is held at a time. Each batch is
+        deleted in one transaction along with the matching change to the
+        version's counter. Returns a dict of version to the number of
+        hosts removed, or that would be with dry_run. batch_size defaults
+        to, and raises ValueError if above, the most hosts that fit in
+        one transaction.
+        """
+        from urllib3.exceptions import HTTPError
+        # Two deletes per host and the counter's check-and-set
+        max_batch_size = (self.max_txn_ops - 1) // 2
+        batch_size = batch_size or max_batch_size
+        if not 1 <= batch_size <= max_batch_size:
+            raise ValueError('The batch size must be between 1 and %d, not %d' %
+                             (max_batch_size, batch_size))
+        live = self.live_nodes()
+        if not live:
+            # Don't take an empty or failed catalog to mean every host is gone
+            raise HTTPError('No nodes in the catalog, refusing to collect garbage')
+        reclaimed = {}
+        for version in sorted(self.running_versions()):
+            prefix = 'running_version/%s/' % version
+            batch = []
+            for key in self.backend.iter_keys(prefix):
+                host = key[len(prefix):]
+                if not host or '/' in host or host in live:
+                    continue
+                if verbose:
+                    print '%s: %s' % (version, host)
+                reclaimed[version] = reclaimed.get(version, 0) + 1
+                if not dry_run:
+                    batch.append(host)
+                if len(batch) == batch_size:
+                    self._delete_registrations(version, batch)
+                    batch = []
+            if batch:
+                self._delete_registrations(version, batch)
+        return reclaimed
+
+    def _delete_registrations(self, version, hosts, attempts=10):
+        """
+        Delete hosts' registrations at version and take them off its
+        counter, backing off between conflicts as update_own_info does.
+        If they go on for `attempts` tries, the counter is left to
+        reconcile_version_counts.
+        """
+        counter = 'version_count/%s' % version
+        ops = []
+        for host in hosts:
+            ops.append(('delete', 'running_version/%s/%s' % (version, host)))
+            ops.append(('delete', 'host_version/%s' % host))
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(self.backoff(attempt - 1, jitter=True))
+            value, index = self.backend.record(counter)
+            if not index:
+                break
+            if self.backend.txn(ops + [('cas', counter, str(max(int(value or 0) - len(hosts), 0)), index)]):
+                return
+        self.backend.txn(ops)
+
+    def running_versions(self, use_counts=False):
+        if use_counts:
+            return set([v for v, count in self.version_counts().items() if count > 0])
+        # Only the version "directories" are returned, not every host's key
+        keys = self.backend.keys('/running_version/', separator='/')
+        return set([k.split('/')[1] for k in keys if len(k.split('/')) > 2 and k.split('/')[1]])
+
+    def hosts_at_version(self, version):
+        prefix = 'running_version/%s/' % (version,)
         result_set = set()
-        for x in res:
-            if x.split('/')[-2] == version:
-                result_set.add(x.split('/')[-1])
+        for key in self.backend.iter_keys(prefix):
+            host = key[len(prefix):]
+            if host and '/' not in host:
+                result_set.add(host)
         return result_set
 
-    def get_failures(self, hosts=False, show_warnings=False):
-        failures = self.consul.health.state('critical')
+    def _health_state(self, state, params=None):
+        checks, headers = self._consul_request('GET', 'health/state/%s' % state, params, stale=True)
+        return checks or []
+
+    def _follow_all(self, followers, changed, timeout=None, wait=300):
+        """
+        Follow each (name, fetch) of followers (see _follow) on a thread
+        of its own, calling changed(name, data) on this thread whenever
+        one of them changes. Returns the first result of changed that
+        isn't None, or None if timeout seconds pass first.
+        """
+        import Queue
+        import threading
+        events = Queue.Queue()
+        done = threading.Event()
+        for name, fetch in followers:
+            thread = threading.Thread(target=self._follow,
+                                      args=(fetch, lambda data, name=name: events.put((name, data)),
+                                            done, wait))
+            # A blocking query can't be cut short, so don't keep the
+            # process alive for one that is still open when we're done
+            thread.daemon = True
+            thread.start()
+
+        deadline = timeout and time.time() + timeout
+        try:
+            while True:
+                remaining = deadline and deadline - time.time()
+                if deadline and remaining <= 0:
+                    return None
+                try:
+                    # With a timeout, so that the wait can be interrupted
+                    name, data = events.get(timeout=remaining or 60)
+                except Queue.Empty:
+                    continue
+                result = changed(name, data)
+                if result is not None:
+                    return result
+        finally:
+            done.set()
+
+    def _check_params(self, service=None, node_prefix=None, node_meta=None):
+        """
+        Query parameters having consul scope health checks to a service,
+        node name prefix or node metadata
+        """
+        params = {}
+        expressions = []
+        if service:
+            expressions.append('ServiceName == %s' % (json.dumps(service),))
+        if node_prefix:
+            import re
+            expressions.append('Node matches %s' % (json.dumps('^' + re.escape(node_prefix)),))
+        if expressions:
+            params['filter'] = ' and '.join(expressions)
+        if node_meta:
+            params['node-meta'] = list(node_meta)
+        return params
+
+    def failing_checks(self, show_warnings=False, service=None, node_prefix=None, node_meta=None):
+        """
+        Return the critical checks, and the warning ones with
+        show_warnings, fetching both at once. They can be scoped by
+        consul to a service, to nodes whose name starts with node_prefix
+        (both need consul 1.5) or to nodes with all of the node_meta
+        "key:value" pairs.
+        """
+        import threading
+        params = self._check_params(service, node_prefix, node_meta)
+        states = ['critical'] + (show_warnings and ['warning'] or [])
+        results = {}
+        def fetch(state):
+            try:
+                results[state] = self._health_state(state, params)
+            except Exception, e:
+                results[state] = e
+        threads = [threading.Thread(target=fetch, args=(state,)) for state in states[1:]]
+        for thread in threads:
+            thread.start()
+        fetch(states[0])
+        for thread in threads:
+            thread.join()
+
+        checks = []
+        for state in states:
+            if isinstance(results[state], Exception):
+                raise results[state]
+            checks += results[state]
+        return checks
+
+    def get_failures(self, hosts=False, show_warnings=False, **scope):
+        checks = self.failing_checks(show_warnings, **scope)
         if hosts:
-            if len(failures) != 0: print "Failures:"
-            for x in failures:
-                print "  Node: %s, Check: %s" % (x['Node'], x['Name'])
-        if show_warnings:
-            warnings = self.consul.health.state('warning')
-            if hosts:
-                if len(warnings) != 0: print "Warnings:"
-                for x in warnings:
+            for status, title in [('critical', 'Failures:'), ('warning', 'Warnings:')]:
+                matching = [x for x in checks if x['Status'] == status]
+                if matching: print title
+                for x in matching:
                     print "  Node: %s, Check: %s" % (x['Node'], x['Name'])
-            failures = failures + warnings
-        return len(failures) == 0
+        return len(checks) == 0
+
+    def failure_summary(self, checks):
+        """
+        Count checks by status, by check name and by node
+        """
+        summary = {'total': len(checks), 'by_status': {}, 'by_check': {}, 'by_node': {}}
+        for check in checks:
+            for group, key in [('by_status', check['Status']),
+                               ('by_check', check['Name']),
+                               ('by_node', check['Node'])]:
+                summary[group][key] = summary[group].get(key, 0) + 1
+        return summary
+
+    def missing_hosts(self, version, hosts, fail_fast=False):
+        """
+        Generate the hosts from the iterable `hosts` that are not running
+        version. With fail_fast, stop at the first one.
+        """
+        present = self.hosts_at_version(version)
+        for host in hosts:
+            if host not in present:
+                yield host
+                if fail_fast:
+                    return
 
     def verify_hosts(self, version, hosts):
-        return set(hosts).issubset(self.hosts_at_version(version))
+        for host in self.missing_hosts(version, hosts, fail_fast=True):
+            return False
+        return True
 
-    def check_single_version(self, version, verbose=False):
-        running_versions = self.running_versions()
+    def check_single_version(self, version, verbose=False, use_counts=False):
+        running_versions = self.running_versions(use_counts)
         unwanted_versions = filter(lambda x: x != version,
                                    running_versions)
         wanted_version_found = version in running_versions
@@ -151,6 +639,205 @@ class DeploymentOrchestrator(object):
             print 'Unwanted versions found:', ', '.join(unwanted_versions)
         return wanted_version_found and not unwanted_versions
 
+    def wait_for_version(self, version, expect, timeout=None, use_counts=True,
+                         progress=None, wait=300, **scope):
+        """
+        Wait for `expect` hosts to run version, following its counter
+        and the critical checks (see failing_checks for scope) with
+        blocking queries. progress, if given, is called with the number
+        of hosts at version and the critical checks whenever either
+        changes. Returns True once expect hosts run version, False as
+        soon as a check is critical, or None if timeout seconds pass
+        first.
+
+        As the counter can drift (see reconcile_version_counts), the
+        hosts registered at version are listed to confirm it once it
+        reaches expect, and once more on timeout. Without use_counts,
+        they are listed instead of the counter being followed, which
+        fetches every key at version each time a host registers.
+        """
+        prefix = 'running_version/%s/' % (version,)
+        if use_counts:
+            counter = 'version_count/%s' % (version,)
+            hosts = lambda index, wait: self.backend.get(counter, index, wait, stale=True)
+        else:
+            hosts = lambda index, wait: self.backend.watch_keys(prefix, index, wait, stale=True)
+        params = self._check_params(**scope)
+        checks = lambda index, wait: self._blocking_get('health/state/critical', params,
+                                                        index, wait, stale=True)
+        state = {}
+        def changed(name, data):
+            if name == 'checks':
+                state['checks'] = data or []
+            elif use_counts:
+                state['hosts'] = int(data or 0)
+            else:
+                state['hosts'] = len([k for k in data or []
+                                      if k[len(prefix):] and '/' not in k[len(prefix):]])
+            if len(state) < 2:
+                return None
+            if progress:
+                progress(state['hosts'], state['checks'])
+            if state['checks']:
+                return False
+            if state['hosts'] >= expect and (not use_counts or
+                                             len(self.hosts_at_version(version)) >= expect):
+                return True
+        converged = self._follow_all([('hosts', hosts), ('checks', checks)], changed, timeout, wait)
+        if (converged is None and use_counts and not state.get('checks') and
+                len(self.hosts_at_version(version)) >= expect):
+            # The counter fell behind
+            return True
+        return converged
+
+    def role_of(self, hostname):
+        import re
+        match = re.match(self.role_pattern, hostname)
+        return match and match.group(1) or hostname
+
+    def plan_waves(self, hosts, wave_size, max_per_role=None, first_wave=None):
+        """
+        Split hosts into waves of wave_size hosts, or wave_size percent
+        of them if it ends with '%'. No wave has more than max_per_role
+        hosts of one role, and with first_wave, the first (canary) wave
+        has that many hosts. Raises ValueError unless the sizes are at
+        least 1.
+        """
+        hosts = sorted(hosts)
+        if str(wave_size).endswith('%'):
+            if float(wave_size[:-1]) <= 0:
+                raise ValueError('The wave size must be more than 0%%, not %s' % (wave_size,))
+            size = max(1, int(len(hosts) * float(wave_size[:-1]) / 100))
+        else:
+            size = int(wave_size)
+        for name, value in [('wave size', size), ('first wave', first_wave),
+                            ('most hosts per role', max_per_role)]:
+            if value is not None and value < 1:
+                raise ValueError('The %s must be at least 1, not %s' % (name, value))
+        waves = []
+        while hosts:
+            wave, rest, roles = [], [], {}
+            limit = (not waves and first_wave) or size
+            for host in hosts:
+                role = self.role_of(host)
+                if len(wave) < limit and (not max_per_role or roles.get(role, 0) < max_per_role):
+                    wave.append(host)
+                    roles[role] = roles.get(role, 0) + 1
+                else:
+                    rest.append(host)
+            if not wave:
+                # Can't happen with the sizes checked, but would loop forever
+                raise ValueError('No host fits in wave %d' % (len(waves) + 1,))
+            waves.append(wave)
+            hosts = rest
+        return waves
+
+    def registered_hosts(self):
+        return set([k[len('host_version/'):] for k in self.backend.iter_keys('host_version/')])
+
+    def rollout_state(self):
+        """
+        Return (state of the last rollout or None, its ModifyIndex)
+        """
+        value, index = self.backend.record(self.rollout_key)
+        return value and json.loads(value), index
+
+    def _save_rollout(self, state, index):
+        if not self.backend.put(self.rollout_key, json.dumps(state), cas=index):
+            raise Exception('The rollout changed underneath us. Is another one running?')
+        return self.backend.record(self.rollout_key)[1]
+
+    def start_rollout(self, version, wave_size, max_per_role=None, first_wave=None,
+                      wave_timeout=1800, pause=0, hosts=None, **scope):
+        """
+        Plan a rollout of version to hosts (every registered host by
+        default) in waves and record it in consul, ready for
+        run_rollout. Hosts already running version are left out.
+        """
+        state, index = self.rollout_state()
+        if state and state['status'] in ('running', 'halted'):
+            raise Exception('The rollout of %s is %s. Resume or abort it first' %
+                            (state['version'], state['status']))
+        if hosts is None:
+            hosts = self.registered_hosts()
+        at_version = self.hosts_at_version(version)
+        state = {'version': version,
+                 'status': 'running',
+                 'reason': None,
+                 # Index of the last wave admitted
+                 'wave': -1,
+                 'waves': self.plan_waves([h for h in hosts if h not in at_version],
+                                          wave_size, max_per_role, first_wave),
+                 'already_at_version': len(at_version),
+                 'wave_timeout': wave_timeout,
+                 'pause': pause,
+                 'scope': scope}
+        self._save_rollout(state, index)
+        return state
+
+    def run_rollout(self, progress=None):
+        """
+        Run (or resume, after a halt or a crash) the rollout recorded in
+        consul. Each wave's hosts get the new version in their
+        /target_version/<host> key; the next wave is admitted once every
+        host so far runs it, with no critical checks. The rollout halts
+        if a check goes critical or a wave takes longer than its
+        timeout. Once every wave is done, /current_version is set and
+        the per host keys removed. Returns whether the rollout is done.
+        progress, if given, is called with the state and the numbers of
+        hosts done and expected as they change.
+        """
+        state, index = self.rollout_state()
+        if not state or state['status'] not in ('running', 'halted'):
+            raise Exception('There is no rollout to run')
+        if state['status'] == 'halted':
+            state['status'], state['reason'] = 'running', None
+            index = self._save_rollout(state, index)
+        version = state['version']
+        expect = state['already_at_version']
+        for i, wave in enumerate(state['waves']):
+            expect += len(wave)
+            if i > state['wave']:
+                if i > 0 and state['pause']:
+                    time.sleep(state['pause'])
+                for start in range(0, len(wave), self.max_txn_ops):
+                    self.backend.txn([('set', 'target_version/%s' % (host,), version)
+                                      for host in wave[start:start + self.max_txn_ops]])
+                self._touch_current_version()
+                state['wave'] = i
+                index = self._save_rollout(state, index)
+            converged = self.wait_for_version(version, expect, state['wave_timeout'],
+                                              progress=progress and (lambda hosts, checks:
+                                                                     progress(state, hosts, expect)),
+                                              **state['scope'])
+            if not converged:
+                state['status'] = 'halted'
+                state['reason'] = (converged is None and 'Wave %d timed out' or
+                                   'A check went critical during wave %d') % (i + 1,)
+                self._save_rollout(state, index)
+                return False
+        # Every host runs version now; make that the default and drop the
+        # per host keys, in that order so no host sees the old version
+        self.trigger_update(version)
+        self.backend.delete('target_version/', recursive=True)
+        state['status'] = 'done'
+        self._save_rollout(state, index)
+        return True
+
+    def abort_rollout(self):
+        """
+        Stop the rollout and remove the per host target versions, so
+        hosts go back to /current_version
+        """
+        state, index = self.rollout_state()
+        if not state or state['status'] not in ('running', 'halted'):
+            raise Exception('There is no rollout to abort')
+        self.backend.delete('target_version/', recursive=True)
+        self._touch_current_version()
+        state['status'] = 'aborted'
+        self._save_rollout(state, index)
+        return state
+
     def local_version(self, new_value=None):
         mode = new_value is None and 'r' or 'w'
 
@@ -166,13 +853,69 @@ class DeploymentOrchestrator(object):
                 return ''
             raise
 
+DEFAULT_AGENT_SOCKET = '/var/run/jiocloud-orchestrate.sock'
 
-def main(argv=sys.argv[1:]):
+# Subcommands that are short lived and don't read stdin, and so can be
+# run by a persistent agent on behalf of a client. They must also be
+# safe to run twice: a client that gives up on the agent runs the
+# command itself, even though the agent may have run it already.
+AGENT_COMMANDS = set(['trigger_update', 'current_version', 'ping',
+                      'pending_update', 'local_version', 'update_own_status',
+                      'get_failures', 'update_own_info', 'report', 'running_versions',
+                      'version_counts', 'hosts_at_version',
+                      'check_single_version'])
+
+# Subcommands typically run from cron on every node at once
+POLL_COMMANDS = set(['current_version', 'pending_update', 'get_failures'])
+
+def call_agent(path, argv, timeout=60):
+    """
+    Run a subcommand in the agent listening on the unix socket path.
+    Returns a dict with its rc, stdout and stderr, or None if no agent
+    is running or it did not answer in full within timeout seconds, in
+    which case it may or may not have run the command.
+    """
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'argv': argv}) + '\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(''.join(chunks))
+    except (socket.error, ValueError):
+        # socket.timeout is a socket.error, and a reply cut short by the
+        # agent dying doesn't decode
+        return None
+    finally:
+        sock.close()
+
+
+def main(argv=sys.argv[1:], do=None):
     parser = argparse.ArgumentParser(description='Utility for '
                                                  'orchestrating updates')
     parser.add_argument('--host', type=str,
                         default='127.0.0.1', help="local consul agent")
     parser.add_argument('--port', type=int, default=8500, help="consul port")
+    parser.add_argument('--agent_socket', default=DEFAULT_AGENT_SOCKET,
+                        help="Unix socket of the orchestrate agent")
+    parser.add_argument('--no_agent', action='store_true',
+                        help="Don't hand the command to a running agent")
+    parser.add_argument('--fleet', action='store_true',
+                        help="Spread load on the consul servers: allow stale reads and jitter retries")
+    parser.add_argument('--backend', choices=['consul', 'etcd'], default='consul',
+                        help="Where to keep the version registry. Health checks always come from consul")
+    parser.add_argument('--etcd_host', type=str, default='127.0.0.1', help="etcd host, with --backend etcd")
+    parser.add_argument('--etcd_port', type=int, default=2379, help="etcd port, with --backend etcd")
+    parser.add_argument('--splay', type=float, default=0,
+                        help="Wait a random time up to this many seconds before polling, or before "
+                             "acting on a new version in watch_update")
     subparsers = parser.add_subparsers(dest='subcmd')
 
     trigger_parser = subparsers.add_parser('trigger_update',
@@ -186,6 +929,8 @@ def main(argv=sys.argv[1:]):
 
     pending_update = subparsers.add_parser('pending_update',
                                            help='Check for pending update')
+    pending_update.add_argument('--hostname', type=str, default=socket.gethostname(),
+                                help="This system's hostname")
 
     local_version_parser = subparsers.add_parser('local_version',
                                                  help='Get or set local version')
@@ -198,35 +943,126 @@ def main(argv=sys.argv[1:]):
     list_failures_parser = subparsers.add_parser('get_failures', help="Return a list of every failed host. Returns the number of hosts in a failed state")
     list_failures_parser.add_argument('--hosts', action='store_true', help="list out all hosts in each state and not just the number in each state")
     list_failures_parser.add_argument('--show_warnings', action='store_true', help="Whether to count warnings as failures")
+    list_failures_parser.add_argument('--service', help="Only checks of this service")
+    list_failures_parser.add_argument('--node_prefix', help="Only checks of nodes whose name starts with this")
+    list_failures_parser.add_argument('--node_meta', action='append', metavar='KEY:VALUE',
+                                      help="Only checks of nodes with this metadata. May be repeated")
+    list_failures_parser.add_argument('--summary', action='store_true',
+                                      help="Print counts by status, check and node instead of each failure")
+    list_failures_parser.add_argument('--json', action='store_true', help="Print as JSON")
+    report_parser = subparsers.add_parser('report', help="Update the status checks and the host's own info at once")
+    report_parser.add_argument('--hostname', type=str, default=socket.gethostname(),
+                               help="This system's hostname")
+    report_parser.add_argument('--puppet', type=int, metavar='RC', help="Exit code of the puppet run")
+    report_parser.add_argument('--validation', type=int, metavar='RC', help="Exit code of the validation")
+    report_parser.add_argument('--version', type=str,
+                               help="Override version to report into consul")
     update_own_info_parser = subparsers.add_parser('update_own_info', help="Update host's own info")
     update_own_info_parser.add_argument('--hostname', type=str, default=socket.gethostname(),
                                         help="This system's hostname")
     update_own_info_parser.add_argument('--version', type=str,
                                         help="Override version to report into consul")
 
+    watch_update_parser = subparsers.add_parser('watch_update', help="Wait for a new version to become available")
+    watch_update_parser.add_argument('--exec', dest='hook', help="Command to run when a new version is available. "
+                                     "The version is passed in the NEW_VERSION environment variable.")
+    watch_update_parser.add_argument('--once', action='store_true', help="Exit after running the command once")
+    watch_update_parser.add_argument('--timeout', type=int, help="Give up after this many seconds")
+    watch_update_parser.add_argument('--wait', type=int, default=300, help="Seconds each blocking query is held for")
+    watch_update_parser.add_argument('--hostname', type=str, default=socket.gethostname(),
+                                     help="This system's hostname")
+
+    rollout_parser = subparsers.add_parser('rollout', help="Roll a version out in waves, or resume, show or abort the rollout")
+    rollout_parser.add_argument('action', choices=['start', 'resume', 'status', 'abort'])
+    rollout_parser.add_argument('version', nargs='?', help="Version to roll out")
+    rollout_parser.add_argument('--wave_size', default='10%', help="Hosts per wave, or percentage of them with a %%")
+    rollout_parser.add_argument('--first_wave', type=int, help="Hosts in the first (canary) wave")
+    rollout_parser.add_argument('--max_per_role', type=int, help="Most hosts of one role in a wave")
+    rollout_parser.add_argument('--wave_timeout', type=int, default=1800, help="Halt if a wave takes longer than this many seconds")
+    rollout_parser.add_argument('--pause', type=int, default=0, help="Seconds to wait between waves")
+    rollout_parser.add_argument('--service', help="Only halt on checks of this service")
+    rollout_parser.add_argument('--node_prefix', help="Only halt on checks of nodes whose name starts with this")
+    rollout_parser.add_argument('--node_meta', action='append', metavar='KEY:VALUE',
+                                help="Only halt on checks of nodes with this metadata. May be repeated")
+    rollout_parser.add_argument('--quiet', '-q', action='store_true', help="Don't print progress")
+
     running_versions_parser = subparsers.add_parser('running_versions', help="List currently running versions")
+    running_versions_parser.add_argument('--use_counts', action='store_true', help="Use the per-version host counters")
+    gc_versions_parser = subparsers.add_parser('gc_versions', help="Remove running_version entries of hosts that no longer exist")
+    gc_versions_parser.add_argument('--dry_run', action='store_true', help="Only report what would be removed")
+    gc_versions_parser.add_argument('--batch_size', type=int,
+                                    help="Hosts to remove per transaction. Defaults to, and "
+                                         "can't be more than, the most that fit in one")
+    gc_versions_parser.add_argument('--verbose', '-v', action='store_true', help="List every host removed")
+    version_counts_parser = subparsers.add_parser('version_counts', help="List the number of hosts running each version")
+    reconcile_parser = subparsers.add_parser('reconcile_version_counts',
+                                             help="Rebuild the per-version host counters from the registered hosts")
     hosts_at_version_parser = subparsers.add_parser('hosts_at_version', help="List hosts at specified version")
     hosts_at_version_parser.add_argument('version', type=str, help="Version to retrieve list of hosts for")
 
     verify_hosts_parser = subparsers.add_parser('verify_hosts', help="Verify that list of hosts are all available")
     verify_hosts_parser.add_argument('version', help="Version to look for")
+    verify_hosts_parser.add_argument('--fail_fast', action='store_true', help="Stop at the first missing host")
 
+    wait_for_version_parser = subparsers.add_parser('wait_for_version', help="Wait for a number of hosts to run a version. "
+                                                    "Exits 1 if a check goes critical first, or 2 on timeout")
+    wait_for_version_parser.add_argument('version', help='The version to wait for')
+    wait_for_version_parser.add_argument('--expect', type=int, required=True, help="Number of hosts to wait for")
+    wait_for_version_parser.add_argument('--timeout', type=int, help="Give up after this many seconds")
+    wait_for_version_parser.add_argument('--list_keys', dest='use_counts', action='store_false',
+                                         help="Follow the hosts registered at the version instead of its "
+                                              "counter. Lists all of them each time one registers")
+    wait_for_version_parser.add_argument('--service', help="Only fail on checks of this service")
+    wait_for_version_parser.add_argument('--node_prefix', help="Only fail on checks of nodes whose name starts with this")
+    wait_for_version_parser.add_argument('--node_meta', action='append', metavar='KEY:VALUE',
+                                         help="Only fail on checks of nodes with this metadata. May be repeated")
+    wait_for_version_parser.add_argument('--quiet', '-q', action='store_true', help="Don't print progress")
     check_single_version_parser = subparsers.add_parser('check_single_version', help="Check if the given version is the only one currently running")
     check_single_version_parser.add_argument('version', help='The version to check for')
     check_single_version_parser.add_argument('--verbose', '-v', action='store_true', help='Be verbose')
+    check_single_version_parser.add_argument('--use_counts', action='store_true', help="Use the per-version host counters")
+    agent_parser = subparsers.add_parser('agent', help="Serve the other subcommands over a unix socket")
     args = parser.parse_args(argv)
 
-    do = DeploymentOrchestrator(args.host, args.port)
-    if args.subcmd == 'trigger_update':
+    # The splay is the client's to wait out. An agent running this on a
+    # client's behalf (with do given) would hold up every other client
+    if args.splay and args.subcmd in POLL_COMMANDS and do is None:
+        time.sleep(random.uniform(0, args.splay))
+
+    # The agent keeps its registry in consul
+    if do is None and args.subcmd in AGENT_COMMANDS and not args.no_agent and args.backend == 'consul':
+        result = call_agent(args.agent_socket, argv)
+        if result is not None:
+            sys.stdout.write(result['stdout'])
+            sys.stderr.write(result['stderr'])
+            return result['rc']
+
+    if args.backend == 'etcd':
+        from jiocloud.backends import EtcdBackend
+        do = DeploymentOrchestrator(args.host, args.port,
+                                    backend=EtcdBackend(args.etcd_host, args.etcd_port))
+    elif do is None or (do.host, do.port) != (args.host, args.port):
+        do = DeploymentOrchestrator(args.host, args.port)
+    do.fleet = args.fleet
+    if args.subcmd == 'agent':
+        # Only the agent itself needs the server side
+        from jiocloud import orchestrate_agent
+        orchestrate_agent.serve(args.agent_socket, do)
+    elif args.subcmd == 'trigger_update':
         do.trigger_update(args.version)
     elif args.subcmd == 'current_version':
         print do.current_version()
     elif args.subcmd == 'check_single_version':
-        sys.exit(not do.check_single_version(args.version, args.verbose))
+        sys.exit(not do.check_single_version(args.version, args.verbose, args.use_counts))
     elif args.subcmd == 'update_own_status':
         do.update_own_status(args.hostname, args.status_type, args.status_result)
     elif args.subcmd == 'update_own_info':
         do.update_own_info(args.hostname, version=args.version)
+    elif args.subcmd == 'report':
+        statuses = [(status_type, getattr(args, status_type))
+                    for status_type in ['puppet', 'validation']
+                    if getattr(args, status_type) is not None]
+        do.report(args.hostname, statuses, version=args.version)
     elif args.subcmd == 'ping':
         did_it_work = do.ping()
         if did_it_work:
@@ -235,20 +1071,127 @@ def main(argv=sys.argv[1:]):
         else:
             print 'Connection failed'
             return 1
+    elif args.subcmd == 'watch_update':
+        version = None
+        while True:
+            # After running the hook, wait for a version newer than the one
+            # it was run for, even if it didn't update the local version
+            version = do.watch_target_version(args.hostname, known_version=version, wait=args.wait,
+                                              timeout=args.timeout, splay=args.splay)
+            if version is None:
+                return 1
+            print version
+            if not args.hook:
+                return 0
+            env = dict(os.environ, NEW_VERSION=version)
+            import subprocess
+            rc = subprocess.call(args.hook, shell=True, env=env)
+            if args.once:
+                return rc
+    elif args.subcmd == 'wait_for_version':
+        last = {}
+        def progress(hosts, checks):
+            last['checks'] = checks
+            if not args.quiet:
+                print '%s: %d/%d hosts, %d critical checks' % (args.version, hosts, args.expect, len(checks))
+                sys.stdout.flush()
+        converged = do.wait_for_version(args.version, args.expect, args.timeout, args.use_counts,
+                                        progress=progress, service=args.service,
+                                        node_prefix=args.node_prefix, node_meta=args.node_meta)
+        if converged is None:
+            print 'Timed out waiting for %d hosts to run %s' % (args.expect, args.version)
+            return 2
+        if not converged:
+            print 'Failures:'
+            for x in last['checks']:
+                print "  Node: %s, Check: %s" % (x['Node'], x['Name'])
+            return 1
+        return 0
+    elif args.subcmd == 'rollout':
+        if args.action == 'start':
+            if not args.version:
+                parser.error('rollout start needs a version')
+            try:
+                state = do.start_rollout(args.version, args.wave_size, args.max_per_role, args.first_wave,
+                                         args.wave_timeout, args.pause, service=args.service,
+                                         node_prefix=args.node_prefix, node_meta=args.node_meta)
+            except ValueError, e:
+                parser.error(str(e))
+            print 'Rolling %s out in %d wave(s)' % (state['version'], len(state['waves']))
+        elif args.action == 'abort':
+            state = do.abort_rollout()
+            print 'Aborted the rollout of %s after %d wave(s)' % (state['version'], state['wave'] + 1)
+            return 0
+        elif args.action == 'status':
+            state, index = do.rollout_state()
+            if not state:
+                print 'No rollout'
+                return 0
+            print '%s: %s, wave %d of %d%s' % (state['version'], state['status'], state['wave'] + 1,
+                                              len(state['waves']), state['reason'] and ': ' + state['reason'] or '')
+            return state['status'] not in ('running', 'done')
+        def progress(state, hosts, expect):
+            if not args.quiet:
+                print '%s: wave %d of %d, %d/%d hosts' % (state['version'], state['wave'] + 1,
+                                                          len(state['waves']), hosts, expect)
+                sys.stdout.flush()
+        if do.run_rollout(progress):
+            print 'Rolled out'
+            return 0
+        state, index = do.rollout_state()
+        print 'Halted: %s' % (state['reason'],)
+        return 1
     elif args.subcmd == 'local_version':
         print do.local_version(args.version)
     elif args.subcmd == 'running_versions':
-        print '\n'.join(do.running_versions())
+        print '\n'.join(do.running_versions(args.use_counts))
+    elif args.subcmd == 'gc_versions':
+        try:
+            reclaimed = do.gc_versions(args.dry_run, args.batch_size, args.verbose)
+        except ValueError, e:
+            parser.error(str(e))
+        for version, count in sorted(reclaimed.items()):
+            print '%s: %d host(s) %s' % (version, count, args.dry_run and 'to remove' or 'removed')
+        print 'Total: %d key(s) %s' % (sum(reclaimed.values()), args.dry_run and 'to reclaim' or 'reclaimed')
+    elif args.subcmd == 'version_counts':
+        for version, count in sorted(do.version_counts().items()):
+            print '%s %d' % (version, count)
+    elif args.subcmd == 'reconcile_version_counts':
+        for version, (old, new) in sorted(do.reconcile_version_counts().items()):
+            print '%s: %d -> %d' % (version, old, new)
     elif args.subcmd == 'hosts_at_version':
         print '\n'.join(do.hosts_at_version(args.version))
     elif args.subcmd == 'verify_hosts':
-        buffer = sys.stdin.read().strip()
-        hosts = buffer.split('\n')
-        return not do.verify_hosts(args.version, hosts)
+        hosts = (line.strip() for line in sys.stdin)
+        missing = 0
+        for host in do.missing_hosts(args.version, (h for h in hosts if h), args.fail_fast):
+            print 'Missing: %s' % (host,)
+            missing += 1
+        return bool(missing)
     elif args.subcmd == 'get_failures':
-        return not do.get_failures(args.hosts, args.show_warnings)
+        scope = {'service': args.service, 'node_prefix': args.node_prefix,
+                 'node_meta': args.node_meta}
+        if not (args.summary or args.json):
+            return not do.get_failures(args.hosts, args.show_warnings, **scope)
+        checks = do.failing_checks(args.show_warnings, **scope)
+        if args.summary:
+            summary = do.failure_summary(checks)
+            if args.json:
+                print json.dumps(summary, indent=2, sort_keys=True)
+            else:
+                print 'Total: %d' % (summary['total'],)
+                for group in ['by_status', 'by_check', 'by_node']:
+                    if summary[group]:
+                        print '%s:' % (group.replace('_', ' ').capitalize(),)
+                    for key, count in sorted(summary[group].items(), key=lambda x: (-x[1], x[0])):
+                        print '  %s: %d' % (key, count)
+        else:
+            print json.dumps([dict((k, x.get(k)) for k in ['Node', 'CheckID', 'Name', 'Status',
+                                                           'ServiceName', 'Output'])
+                              for x in checks], indent=2, sort_keys=True)
+        return bool(checks)
     elif args.subcmd == 'pending_update':
-        pending_update = do.pending_update()
+        pending_update = do.pending_update(args.hostname)
         msg = {do.UPDATE_AVAILABLE: "Yes, there is an update pending",
                do.UP_TO_DATE: "No updates pending",
                do.NO_CLUE: "Could not get current_version",
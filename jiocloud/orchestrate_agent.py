@@ -0,0 +1,76 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import os
+import signal
+import SocketServer
+import StringIO
+import sys
+import traceback
+import json
+from jiocloud import orchestrate
+
+"""
+Server side of `orchestrate agent`, kept apart from orchestrate.py so
+that clients handing a subcommand to the agent don't import it.
+"""
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        self.wfile.write(json.dumps(self.server.run(request['argv'])))
+
+class Agent(SocketServer.UnixStreamServer):
+    """
+    Serves subcommands over a unix socket using one long lived
+    DeploymentOrchestrator, so clients skip interpreter startup and
+    reuse its connections to consul. Requests are handled one at a time.
+    """
+    def __init__(self, path, do):
+        self.do = do
+        if os.path.exists(path):
+            if orchestrate.call_agent(path, ['ping'], timeout=5) is not None:
+                raise Exception('An agent is already listening on %s' % (path,))
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, AgentHandler)
+        os.chmod(path, 0600)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+    def run(self, argv):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            try:
+                rc = orchestrate.main(argv, do=self.do)
+            except SystemExit, e:
+                rc = e.code
+            except Exception:
+                traceback.print_exc()
+                rc = 1
+            return {'rc': rc,
+                    'stdout': sys.stdout.getvalue(),
+                    'stderr': sys.stderr.getvalue()}
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+def serve(path, do):
+    agent = Agent(path, do)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        agent.serve_forever()
+    finally:
+        agent.server_close()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import __builtin__
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Measures how long orchestrate subcommands take to start, and checks
+them against a budget.
+
+For each subcommand it reports the best wall clock time of a number of
+runs of `python -m jiocloud.orchestrate --no_agent ...`, over that of a
+bare interpreter, and a breakdown of the time spent importing modules
+along the lines of python3's `-X importtime`:
+
+    python -m jiocloud.startup_benchmark --runs 10 --imports
+
+Exits non-zero if a subcommand takes longer than its budget.
+"""
+
+# Milliseconds on top of bare interpreter startup
+BUDGETS = {'local_version': 60,
+           'update_own_status': 120}
+
+COMMANDS = {'local_version': ['local_version'],
+            'update_own_status': ['update_own_status', 'puppet', '0'],
+            'pending_update': ['pending_update'],
+            'current_version': ['current_version']}
+
+class ImportTimer(object):
+    """
+    Records the time spent importing each module while active. times is
+    a list of (depth, name, self seconds, cumulative seconds) in the
+    order the imports completed.
+    """
+    def __init__(self):
+        self.times = []
+        self._stack = []
+        self._import = None
+
+    def __enter__(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._import
+
+    def timed_import(self, name, *args, **kwargs):
+        loaded = len(sys.modules)
+        self._stack.append(0)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            # Imports of modules that were already loaded aren't interesting
+            if len(sys.modules) > loaded:
+                self.times.append((len(self._stack), name, elapsed - nested, elapsed))
+
+def format_import_times(times):
+    lines = ['import time: self [us] | cumulative | imported package']
+    for depth, name, self_secs, cumulative in times:
+        lines.append('import time: %9d | %10d | %s%s' % (self_secs * 1e6, cumulative * 1e6,
+                                                         '  ' * depth, name))
+    return '\n'.join(lines)
+
+def wall_clock(argv, runs):
+    """
+    Best time in seconds of `runs` runs of argv
+    """
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call(argv, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            best = best is None and elapsed or min(best, elapsed)
+    return best
+
+def import_times(args):
+    """
+    Run orchestrate with args in a fresh interpreter and return the
+    times of the imports it did
+    """
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call([sys.executable, '-m', 'jiocloud.startup_benchmark',
+                             '--child', path, '--'] + args,
+                            stdout=devnull, stderr=devnull)
+        with open(path) as fp:
+            return [tuple(t) for t in json.load(fp)]
+    finally:
+        os.unlink(path)
+
+def run_child(path, args):
+    timer = ImportTimer()
+    try:
+        with timer:
+            from jiocloud import orchestrate
+            orchestrate.main(args)
+    except BaseException:
+        pass
+    finally:
+        with open(path, 'w') as fp:
+            json.dump(timer.times, fp)
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Measure orchestrate startup time')
+    parser.add_argument('--commands', default=','.join(sorted(BUDGETS)),
+                        help='Comma separated subcommands to run (%s)' % (', '.join(sorted(COMMANDS)),))
+    parser.add_argument('--runs', type=int, default=5, help='Runs per subcommand, the best is used')
+    parser.add_argument('--imports', action='store_true', help='Show where import time goes')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('args', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return run_child(args.child, args.args)
+
+    baseline = wall_clock([sys.executable, '-c', 'pass'], args.runs)
+    print 'interpreter startup: %.1fms' % (baseline * 1000,)
+    over_budget = []
+    for command in args.commands.split(','):
+        cmd_args = ['--no_agent'] + COMMANDS[command]
+        elapsed = wall_clock([sys.executable, '-m', 'jiocloud.orchestrate'] + cmd_args, args.runs) - baseline
+        budget = BUDGETS.get(command)
+        print '%-20s %7.1fms  budget %s' % (command, elapsed * 1000, budget and '%dms' % budget or '-')
+        if budget and elapsed * 1000 > budget:
+            over_budget.append(command)
+        if args.imports:
+            print format_import_times(import_times(cmd_args))
+    if over_budget:
+        print 'Over budget: %s' % (', '.join(over_budget),)
+    return bool(over_budget)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,10 +15,16 @@
 #
 import mock
 import os
+import gzip
 import StringIO
+import threading
+import time
 import unittest
 from contextlib import nested
-from jiocloud.apply_resources import ApplyResources
+from jiocloud.apply_resources import ApplyResources, UserData
+
+def fail(msg):
+    raise Exception(msg)
 
 class TestApplyResources(unittest.TestCase):
     server_data = [('foo1_abc123', '93138146-2275-4e18-b41e-3957aa13e73a'),
@@ -48,15 +54,26 @@ class TestApplyResources(unittest.TestCase):
         with mock.patch.object(apply_resources, 'get_nova_client') as get_nova_client:
             nova_client = get_nova_client.return_value
             self.fake_server_data(nova_client)
-            self.assertEquals(apply_resources.get_existing_servers(), [s[0] for s in self.server_data])
+            self.assertEquals(apply_resources.get_existing_servers(), set([s[0] for s in self.server_data]))
             self.assertEquals(apply_resources.get_existing_servers(project_tag='abc123'),
-                              ['foo1_abc123'])
+                              set(['foo1_abc123']))
             self.assertEquals(apply_resources.get_existing_servers(project_tag='abc124'),
-                              ['foo2_abc124'])
+                              set(['foo2_abc124']))
             self.assertEquals(apply_resources.get_existing_servers(project_tag='bc124'),
-                              ['foo4_bc124'])
+                              set(['foo4_bc124']))
             self.assertEquals(apply_resources.get_existing_servers(project_tag='bc124', attr_name='id'),
-                              ['677388b7-b5ac-418b-b671-6b930dc8003a'])
+                              set(['677388b7-b5ac-418b-b671-6b930dc8003a']))
+
+    def test_get_existing_servers_filters_in_nova(self):
+        apply_resources = ApplyResources()
+        with mock.patch.object(apply_resources, 'get_nova_client') as get_nova_client:
+            nova_client = get_nova_client.return_value
+            nova_client.servers.list.return_value = []
+            apply_resources.get_existing_servers(project_tag='ci.42')
+            nova_client.servers.list.assert_called_with(detailed=True,
+                                                        search_opts={'name': r'_ci\.42$'},
+                                                        marker=None,
+                                                        limit=mock.ANY)
 
     def test_generate_desired_servers(self):
         apply_resources = ApplyResources()
@@ -86,6 +103,10 @@ class TestApplyResources(unittest.TestCase):
                                                                     'bar': {'number': 2 }}),
                           [{'name': 'bar1'},
                            {'name': 'bar2'}])
+        self.assertEquals(apply_resources.generate_desired_servers({'foo': {'number': 1,
+                                                                            'networks': ['private', 'other']}},
+                                                                   mappings={'networks': {'private': 'uuid1'}}),
+                          [{'name': 'foo1', 'networks': ['uuid1', 'other']}])
 
     def test_servers_to_create(self):
         apply_resources = ApplyResources()
@@ -107,11 +128,11 @@ class TestApplyResources(unittest.TestCase):
     def test_create_servers(self):
         apply_resources = ApplyResources()
         with nested(
-               mock.patch('__builtin__.file'),
+               mock.patch('__builtin__.open', mock.mock_open(read_data='test user data')),
                mock.patch('time.sleep'),
                mock.patch.object(apply_resources, 'create_server'),
                mock.patch.object(apply_resources, 'get_nova_client')
-            ) as (file_mock, sleep, create_server, get_nova_client):
+            ) as (open_mock, sleep, create_server, get_nova_client):
             ids = [10,11,12]
             status = {10: ['ACTIVE', 'BUILD', 'BUILD'], 11: ['ACTIVE', 'BUILD'], 12: ['ACTIVE', 'BUILD']}
 
@@ -124,23 +145,24 @@ class TestApplyResources(unittest.TestCase):
             create_server.side_effect = fake_create_server
             self.add_floating_ip_called = False
 
-            def server_get(id):
-                mm = mock.MagicMock()
-                if status[id]:
-                    mm.status = status[id].pop()
-                    mm.add_floating_ip.side_effect = Exception
-                else:
-                    def add_floating_ip(ip):
-                        self.assertEquals(ip, '1.2.3.4')
-                        self.add_floating_ip_called = True
+            def fake_server(id, status):
+                s = mock.Mock()
+                s.configure_mock(id=id, name='server%d' % id, status=status)
 
-                    mm.add_floating_ip.side_effect = add_floating_ip
-                return mm
+                def add_floating_ip(ip):
+                    self.assertEquals(ip, '1.2.3.4')
+                    self.assertEquals(s.status, 'ACTIVE')
+                    self.assertEquals(id, servers['foo3'])
+                    self.add_floating_ip_called = True
+                s.add_floating_ip.side_effect = add_floating_ip
+                return s
 
-            get_nova_client.return_value.servers.get.side_effect = server_get
-            get_nova_client.return_value.floating_ips.create.return_value.ip = '1.2.3.4'
+            def server_list(**kwargs):
+                return [fake_server(id, s.pop()) for id, s in status.items() if s]
 
-            file_mock.side_effect = lambda f: StringIO.StringIO('test user data')
+            get_nova_client.return_value.servers.list.side_effect = server_list
+            get_nova_client.return_value.floating_ips.list.return_value = []
+            get_nova_client.return_value.floating_ips.create.return_value.ip = '1.2.3.4'
 
             apply_resources.create_servers([{'name': 'foo1', 'networks':  ['someid']},
                                             {'name': 'foo2', 'networks':  ['someid']},
@@ -151,9 +173,385 @@ class TestApplyResources(unittest.TestCase):
             create_server.assert_any_call(mock.ANY, 'somekey', name='foo2', networks=['someid'])
             create_server.assert_any_call(mock.ANY, 'somekey', name='foo3', assign_floating_ip=True)
 
+            open_mock.assert_called_once_with('somefile')
             for call in create_server.call_args_list:
-                self.assertEquals(call[0][0].read(), 'test user data')
+                self.assertEquals(call[0][0], 'test user data')
 
             for s in status.values():
                 self.assertEquals(s, [], 'create_servers stopped polling before server left BUILD state')
             self.assertTrue(self.add_floating_ip_called)
+            self.assertFalse(get_nova_client.return_value.servers.get.called)
+
+    def test_create_servers_error_bastion(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('__builtin__.open', mock.mock_open(read_data='test user data')),
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'create_server'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (open_mock, sleep, create_server, get_nova_client):
+            create_server.side_effect = lambda userdata, key_name, name, **kwargs: name + '-id'
+            bastion = mock.Mock()
+            bastion.configure_mock(id='gw1-id', name='gw1', status='ERROR')
+            nova_client = get_nova_client.return_value
+            nova_client.servers.list.return_value = [bastion]
+            nova_client.floating_ips.list.return_value = []
+            ip = mock.Mock(ip='1.2.3.4')
+            nova_client.floating_ips.create.return_value = ip
+
+            failures = apply_resources.create_servers([{'name': 'gw1', 'assign_floating_ip': True}],
+                                                      'somefile')
+
+            self.assertEquals([(s['name'], str(e)) for s, e in failures],
+                              [('gw1', 'Server went ERROR, not ACTIVE')])
+            self.assertFalse(bastion.add_floating_ip.called)
+            # The IP allocated for it is given back
+            ip.delete.assert_called_once_with()
+
+    def test_create_servers_parallel(self):
+        apply_resources = ApplyResources()
+        real_sleep = time.sleep
+        with nested(
+               mock.patch('__builtin__.open', mock.mock_open(read_data='test user data')),
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'create_server'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (open_mock, sleep, create_server, get_nova_client):
+            lock = threading.Lock()
+            self.in_flight = self.max_in_flight = 0
+
+            def fake_create_server(userdata, key_name, name, **kwargs):
+                with lock:
+                    self.in_flight += 1
+                    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                real_sleep(0.02)
+                with lock:
+                    self.in_flight -= 1
+                if name == 'foo3':
+                    raise Exception('No valid host was found')
+                return name
+
+            create_server.side_effect = fake_create_server
+            get_nova_client.return_value.servers.list.return_value = []
+
+            servers = [{'name': 'foo%d' % i} for i in range(10)]
+            failures = apply_resources.create_servers(servers, 'somefile',
+                                                      concurrency=4)
+
+            self.assertEquals(create_server.call_count, 10)
+            self.assertEquals(self.max_in_flight, 4)
+            self.assertEquals([s['name'] for s, e in failures], ['foo3'])
+
+    def test_wait_for_servers(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch('time.time'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, time_mock, get_nova_client):
+            clock = [0]
+            def fake_sleep(interval):
+                clock[0] += interval
+            sleep.side_effect = fake_sleep
+            time_mock.side_effect = lambda: clock[0]
+
+            status = {'a': ['ACTIVE', 'BUILD', 'BUILD', 'BUILD', 'BUILD'],
+                      'b': ['ERROR', 'BUILD']}
+            def server_list(**kwargs):
+                if kwargs.get('marker'):
+                    return []
+                servers = []
+                for id in ('a', 'b', 'other'):
+                    s = mock.Mock()
+                    s.configure_mock(id=id, name='name_' + id,
+                                     status=status.get(id) and status[id].pop() or 'ACTIVE')
+                    servers.append(s)
+                return servers
+            nova_client = get_nova_client.return_value
+            nova_client.servers.list.side_effect = server_list
+
+            done = apply_resources.wait_for_servers(['a', 'b'])
+
+            # Five polls of one page each
+            self.assertEquals(len([c for c in nova_client.servers.list.call_args_list
+                                   if not c[1].get('marker')]), 5)
+            self.assertEquals([c[0][0] for c in sleep.call_args_list],
+                              [1, 1, 1, 1.5, 2.25])
+            self.assertEquals(done, {'a': ('name_a', 'ACTIVE', 6.75),
+                                     'b': ('name_b', 'ERROR', 2)})
+
+    def test_wait_for_servers_in_project(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, get_nova_client):
+            server = mock.Mock()
+            server.configure_mock(id='a', name='foo1_ci', status='ACTIVE')
+            nova_client = get_nova_client.return_value
+            nova_client.servers.list.side_effect = lambda **kwargs: not kwargs['marker'] and [server] or []
+
+            done = apply_resources.wait_for_servers(['a'], 'ci')
+
+            self.assertEquals(done.keys(), ['a'])
+            # Nova only lists the project's servers
+            for c in nova_client.servers.list.call_args_list:
+                self.assertEquals(c[1]['search_opts'], {'name': '_ci$'})
+
+    def test_ssh_config(self):
+        apply_resources = ApplyResources()
+        with mock.patch.object(apply_resources, 'get_nova_client') as get_nova_client:
+            def fake_server(name, networks):
+                s = mock.Mock()
+                s.configure_mock(name=name, id=name, networks=networks)
+                return s
+            nova_client = get_nova_client.return_value
+            nova_client.servers.list.return_value = [
+                fake_server('gw1', {'private': ['10.0.0.2', '203.0.113.7']}),
+                fake_server('db1', {'private': ['10.0.0.3']}),
+                fake_server('unrelated', {'private': ['10.0.0.4']})]
+
+            config = apply_resources.ssh_config([{'name': 'gw1', 'assign_floating_ip': True},
+                                                 {'name': 'db1'}])
+
+            # One page, then the check for another
+            self.assertEquals(nova_client.servers.list.call_count, 2)
+            self.assertEquals(config,
+                              'StrictHostKeyChecking no\n'
+                              'UserKnownHostsFile /dev/null\n'
+                              '\n'
+                              'Host gw1\n'
+                              '    HostName 203.0.113.7\n'
+                              '\n'
+                              'Host db1\n'
+                              '    HostName 10.0.0.3\n'
+                              '    ProxyCommand ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %r@203.0.113.7 nc %h %p\n'
+                              '\n')
+
+            self.assertRaises(Exception, apply_resources.ssh_config, [{'name': 'missing1'}])
+
+    def test_create_server_caches_lookups(self):
+        apply_resources = ApplyResources()
+        with mock.patch.object(apply_resources, 'get_nova_client') as get_nova_client:
+            nova_client = get_nova_client.return_value
+            nova_client.images.get.return_value.id = 'image-uuid'
+            nova_client.flavors.get.return_value.id = 'flavor-uuid'
+            for name in ('foo1', 'foo2', 'foo3'):
+                apply_resources.create_server('userdata', None, name, 'm1.medium', 'ubuntu')
+
+            nova_client.images.get.assert_called_once_with('ubuntu')
+            nova_client.flavors.get.assert_called_once_with('m1.medium')
+            nova_client.servers.create.assert_called_with(name='foo3',
+                                                          image='image-uuid',
+                                                          flavor='flavor-uuid',
+                                                          nics=None,
+                                                          userdata='userdata',
+                                                          key_name=None,
+                                                          config_drive=False)
+            self.assertEquals(apply_resources.resolution_cache.hits, 4)
+
+    def test_resolution_cache_created_once(self):
+        apply_resources = ApplyResources()
+        with mock.patch('jiocloud.utils.ResolutionCache') as cache_class:
+            def slow_cache(*args):
+                time.sleep(0.01)
+                return mock.Mock()
+            cache_class.side_effect = slow_cache
+            caches = []
+            threads = [threading.Thread(target=lambda: caches.append(apply_resources.resolution_cache))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEquals(cache_class.call_count, 1)
+            self.assertEquals(len(set(caches)), 1)
+
+    def test_delete_servers(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, get_nova_client):
+            nova_client = get_nova_client.return_value
+
+            def fake_server(name, uuid):
+                s = mock.Mock()
+                s.configure_mock(name=name, id=uuid)
+                return s
+            servers = [fake_server('foo%d_ci' % i, 'uuid%d' % i) for i in range(4)]
+            nova_client.servers.delete.side_effect = lambda id: id == 'uuid2' and fail('Conflict')
+            ip = mock.Mock(instance_id='uuid1', ip='1.2.3.4')
+            nova_client.floating_ips.list.return_value = [ip]
+            # Each listing ends with an empty page
+            nova_client.servers.list.side_effect = [servers, [],
+                                                    servers[1:], [],
+                                                    [servers[2]], []]
+
+            failures, remaining = apply_resources.delete_servers('ci', concurrency=2)
+
+            self.assertEquals([s['name'] for s, e in failures], ['foo2_ci'])
+            self.assertEquals(remaining, set())
+            self.assertFalse(nova_client.servers.get.called)
+            self.assertEquals(sorted(nova_client.servers.delete.call_args_list),
+                              [mock.call('uuid%d' % i) for i in range(4)])
+            nova_client.servers.remove_floating_ip.assert_called_once_with('uuid1', '1.2.3.4')
+            ip.delete.assert_called_once_with()
+            self.assertEquals(nova_client.servers.list.call_count, 6)
+
+    def test_delete_servers_timeout(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch('time.time'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, time_mock, get_nova_client):
+            time_mock.side_effect = [0, 0, 5, 11]
+            server = mock.Mock()
+            server.configure_mock(name='foo1_ci', id='uuid1')
+            nova_client = get_nova_client.return_value
+            nova_client.floating_ips.list.return_value = []
+            nova_client.servers.list.return_value = [server]
+
+            failures, remaining = apply_resources.delete_servers('ci', timeout=10)
+
+            self.assertEquals(failures, [])
+            self.assertEquals(remaining, set(['uuid1']))
+
+    def test_userdata(self):
+        with mock.patch('__builtin__.open', mock.mock_open(read_data='#!/bin/sh\necho $HOME\n')) as open_mock:
+            userdata = UserData('somefile')
+            self.assertEquals(userdata.render({'name': 'foo1'}), '#!/bin/sh\necho $HOME\n')
+            self.assertEquals(userdata.render({'name': 'foo2'}), '#!/bin/sh\necho $HOME\n')
+            self.assertEquals(open_mock.call_count, 1)
+
+    def test_userdata_template(self):
+        data = 'hostname ${name}; echo $HOME $flavor\n'
+        with mock.patch('__builtin__.open', mock.mock_open(read_data=data)):
+            userdata = UserData('somefile', template=True)
+        self.assertEquals(userdata.render({'name': 'foo1', 'flavor': 'big'}),
+                          'hostname foo1; echo $HOME big\n')
+
+        with mock.patch('__builtin__.open', mock.mock_open(read_data='flavor=${flavor}')):
+            userdata = UserData('somefile', template=True)
+        self.assertTrue(userdata.render({'name': 'foo1', 'flavor': 'big'}) is
+                        userdata.render({'name': 'foo2', 'flavor': 'big'}))
+
+    def test_userdata_gzip(self):
+        with mock.patch('__builtin__.open', mock.mock_open(read_data='test user data')):
+            userdata = UserData('somefile', compress=True)
+        payload = userdata.render({'name': 'foo1'})
+        self.assertEquals(payload[:2], '\x1f\x8b')
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO.StringIO(payload)).read(), 'test user data')
+
+    def test_allocate_floating_ips(self):
+        apply_resources = ApplyResources()
+        with mock.patch.object(apply_resources, 'get_nova_client') as get_nova_client:
+            nova_client = get_nova_client.return_value
+            nova_client.floating_ips.list.return_value = [
+                mock.Mock(ip='1.1.1.1', instance_id='someserver'),
+                mock.Mock(ip='2.2.2.2', instance_id=None),
+                mock.Mock(ip='3.3.3.3', instance_id=None)]
+            new_ips = [mock.Mock(ip='4.4.4.4'), mock.Mock(ip='5.5.5.5')]
+            nova_client.floating_ips.create.side_effect = new_ips
+
+            self.assertEquals(apply_resources.allocate_floating_ips(0), ([], []))
+            reused, allocated = apply_resources.allocate_floating_ips(4, concurrency=2)
+
+            self.assertEquals(sorted([ip.ip for ip in reused]), ['2.2.2.2', '3.3.3.3'])
+            self.assertEquals(sorted([ip.ip for ip in allocated]), ['4.4.4.4', '5.5.5.5'])
+            self.assertEquals(nova_client.floating_ips.create.call_count, 2)
+            self.assertEquals(nova_client.floating_ips.list.call_count, 1)
+
+    def test_plan(self):
+        apply_resources = ApplyResources()
+        with mock.patch.multiple(apply_resources,
+                                 get_nova_client=mock.DEFAULT,
+                                 read_resources=mock.DEFAULT) as mocks:
+            mocks['read_resources'].return_value = {
+                'foo': {'number': 2, 'flavor': 'small', 'image': 'trusty'},
+                'bar': {'number': 1, 'flavor': 'small', 'image': 'trusty'}}
+            nova_client = mocks['get_nova_client'].return_value
+            nova_client.flavors.get.side_effect = lambda f: mock.Mock(id=f + '-id')
+            nova_client.images.get.side_effect = lambda i: mock.Mock(id=i + '-id')
+
+            def fake_server(name, flavor, image):
+                s = mock.Mock()
+                s.configure_mock(name=name, id=name + '-uuid',
+                                 flavor={'id': flavor}, image=image and {'id': image})
+                return s
+            nova_client.servers.list.return_value = [
+                fake_server('foo1_ci', 'small-id', 'trusty-id'),
+                fake_server('foo2_ci', 'large-id', ''),
+                fake_server('foo3_ci', 'small-id', 'trusty-id'),
+                fake_server('foo12_ci', 'small-id', 'trusty-id'),
+                fake_server('baz1_ci', 'small-id', 'trusty-id')]
+
+            plan = apply_resources.plan('fake_path', project_tag='ci')
+
+            self.assertEquals(plan['create'], [{'name': 'bar1_ci', 'flavor': 'small', 'image': 'trusty'}])
+            self.assertEquals(plan['delete'], [{'name': 'foo3_ci', 'id': 'foo3_ci-uuid'},
+                                               {'name': 'foo12_ci', 'id': 'foo12_ci-uuid'}])
+            self.assertEquals(plan['replace'], [{'name': 'foo2_ci', 'id': 'foo2_ci-uuid',
+                                                 'spec': {'name': 'foo2_ci', 'flavor': 'small', 'image': 'trusty'},
+                                                 'drift': {'flavor': ('large-id', 'small-id')}}])
+            self.assertEquals(plan['project_tag'], 'ci')
+            # One page, then the check for another
+            self.assertEquals(nova_client.servers.list.call_count, 2)
+            nova_client.flavors.get.assert_called_once_with('small')
+            nova_client.images.get.assert_called_once_with('trusty')
+
+    def test_apply_plan(self):
+        apply_resources = ApplyResources()
+        with mock.patch.multiple(apply_resources,
+                                 destroy_servers=mock.DEFAULT,
+                                 create_servers=mock.DEFAULT) as mocks:
+            mocks['destroy_servers'].return_value = ([], set())
+            mocks['create_servers'].return_value = []
+            plan = {'create': [{'name': 'bar1'}],
+                    'delete': [{'name': 'foo3', 'id': 'uuid3'}],
+                    'replace': [{'name': 'foo2', 'id': 'uuid2', 'spec': {'name': 'foo2'},
+                                 'drift': {'flavor': ('a', 'b')}}],
+                    'project_tag': 'ci'}
+
+            self.assertEquals(apply_resources.apply_plan(plan, 'userdata'), ([], set()))
+
+            mocks['destroy_servers'].assert_called_once_with([{'name': 'foo3', 'id': 'uuid3'},
+                                                              {'name': 'foo2', 'id': 'uuid2'}], 'ci',
+                                                             concurrency=1, rate=None, timeout=600)
+            mocks['create_servers'].assert_called_once_with([{'name': 'bar1'}, {'name': 'foo2'}],
+                                                            'userdata', None,
+                                                            concurrency=1, rate=None,
+                                                            project_tag='ci')
+
+    def test_apply_plan_old_server_remains(self):
+        apply_resources = ApplyResources()
+        with mock.patch.multiple(apply_resources,
+                                 destroy_servers=mock.DEFAULT,
+                                 create_servers=mock.DEFAULT) as mocks:
+            mocks['destroy_servers'].return_value = ([], set(['uuid2']))
+            mocks['create_servers'].return_value = []
+            plan = {'create': [{'name': 'bar1'}],
+                    'delete': [],
+                    'replace': [{'name': 'foo2', 'id': 'uuid2', 'spec': {'name': 'foo2'},
+                                 'drift': {'flavor': ('a', 'b')}}],
+                    'project_tag': 'ci'}
+
+            failures, remaining = apply_resources.apply_plan(plan, 'userdata')
+
+            self.assertEquals([(s['name'], str(e)) for s, e in failures],
+                              [('foo2', 'Old server uuid2 was not deleted')])
+            self.assertEquals(remaining, set(['uuid2']))
+            mocks['create_servers'].assert_called_once_with([{'name': 'bar1'}],
+                                                            'userdata', None,
+                                                            concurrency=1, rate=None,
+                                                            project_tag='ci')
+
+    def test_apply_plan_converged(self):
+        apply_resources = ApplyResources()
+        with mock.patch.object(apply_resources, 'get_nova_client') as get_nova_client:
+            self.assertEquals(apply_resources.apply_plan({'create': [], 'delete': [], 'replace': []},
+                                                         'userdata'),
+                              ([], set()))
+            self.assertEquals(get_nova_client.return_value.method_calls, [])
@@ -0,0 +1,115 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import json
+import time
+from tornado import gen
+from tornado import httpclient
+from tornado import testing
+from tornado import web
+from jiocloud.async_orchestrate import AsyncDeploymentOrchestrator
+
+DELAY = 0.2
+
+# Keys and health checks of each fake datacenter
+DATACENTERS = {
+    'dc1': {'keys': ['running_version/v1/a', 'running_version/v2/b'],
+            'critical': [{'Node': 'a', 'Name': 'puppet'}],
+            'warning': []},
+    'dc2': {'keys': ['running_version/v2/c', 'running_version/v2/d'],
+            'critical': [],
+            'warning': [{'Node': 'c', 'Name': 'validation'}]},
+    'dc3': {'keys': [],
+            'critical': [],
+            'warning': []},
+}
+
+class FakeConsulHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self, path):
+        # Every datacenter is slow to answer
+        yield gen.sleep(DELAY)
+        dc = DATACENTERS.get(self.get_argument('dc', 'dc1'))
+        if dc is None:
+            raise web.HTTPError(500, 'No path to datacenter')
+        if path == 'catalog/datacenters':
+            result = sorted(DATACENTERS)
+        elif path.startswith('health/state/'):
+            result = dc[path[len('health/state/'):]]
+        elif path.startswith('kv/'):
+            prefix = path[len('kv/'):]
+            keys = [k for k in dc['keys'] if k.startswith(prefix)]
+            if self.get_argument('separator', None):
+                keys = sorted(set([prefix + k[len(prefix):].split('/')[0] + '/'
+                                   for k in keys if '/' in k[len(prefix):]]))
+            if not keys:
+                raise web.HTTPError(404)
+            result = keys
+        self.write(json.dumps(result))
+
+class AsyncOrchestrateTests(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application([(r'/v1/(.*)', FakeConsulHandler)])
+
+    def setUp(self):
+        super(AsyncOrchestrateTests, self).setUp()
+        self.do = AsyncDeploymentOrchestrator('127.0.0.1', self.get_http_port())
+
+    @testing.gen_test
+    def test_running_versions(self):
+        versions = yield self.do.running_versions('dc1')
+        self.assertEquals(versions, set(['v1', 'v2']))
+        versions = yield self.do.running_versions('dc3')
+        self.assertEquals(versions, set())
+
+    @testing.gen_test
+    def test_hosts_at_version_across(self):
+        hosts = yield self.do.hosts_at_version_across('v2', ['dc1', 'dc2', 'dc3'])
+        self.assertEquals(hosts, set(['b', 'c', 'd']))
+
+    @testing.gen_test
+    def test_get_failures_across(self):
+        failures = yield self.do.get_failures_across(['dc1', 'dc2'])
+        self.assertEquals(failures, [{'Node': 'a', 'Name': 'puppet', 'Datacenter': 'dc1'}])
+        failures = yield self.do.get_failures_across(['dc1', 'dc2'], show_warnings=True)
+        self.assertEquals(len(failures), 2)
+        self.assertEquals(failures[1]['Datacenter'], 'dc2')
+
+    @testing.gen_test
+    def test_check_single_version_across(self):
+        result = yield self.do.check_single_version_across('v2', ['dc2'])
+        self.assertTrue(result)
+        result = yield self.do.check_single_version_across('v2', ['dc1', 'dc2'])
+        self.assertFalse(result)
+        # A datacenter with nothing registered hasn't converged either
+        result = yield self.do.check_single_version_across('v2', ['dc2', 'dc3'])
+        self.assertFalse(result)
+
+    @testing.gen_test
+    def test_unconverged_datacenters(self):
+        unconverged = yield self.do.unconverged_datacenters('v2', ['dc1', 'dc2', 'dc3'])
+        self.assertEquals(unconverged, {'dc1': set(['v1', 'v2']), 'dc3': set()})
+
+    @testing.gen_test
+    def test_across_is_concurrent(self):
+        datacenters = yield self.do.datacenters()
+        start = time.time()
+        versions = yield self.do.running_versions_across(datacenters)
+        elapsed = time.time() - start
+        self.assertEquals(versions, set(['v1', 'v2']))
+        self.assertTrue(elapsed < DELAY * 2, elapsed)
+
+    @testing.gen_test
+    def test_unreachable_datacenter(self):
+        with self.assertRaises(httpclient.HTTPError):
+            yield self.do.running_versions_across(['dc1', 'dc9'])
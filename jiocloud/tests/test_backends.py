@@ -0,0 +1,217 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import etcd
+import mock
+import threading
+import time
+import unittest
+from jiocloud.backends import EtcdBackend
+from jiocloud.backends import MemoryBackend
+from jiocloud.orchestrate import DeploymentOrchestrator
+
+def etcd_result(node, etcd_index=100, action='get'):
+    result = etcd.EtcdResult(action, node)
+    result.etcd_index = etcd_index
+    return result
+
+class MemoryBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+
+    def test_put_and_record(self):
+        self.assertEquals(self.backend.record('a'), (None, 0))
+        self.assertTrue(self.backend.put('/a', 'x'))
+        value, index = self.backend.record('a')
+        self.assertEquals(value, 'x')
+        self.assertFalse(self.backend.put('a', 'y', cas=index - 1))
+        self.assertTrue(self.backend.put('a', 'y', cas=index))
+        self.assertFalse(self.backend.put('a', 'z', cas=0))
+        self.assertEquals(self.backend.record('a')[0], 'y')
+        self.assertEquals(self.backend.calls, {'put': 4, 'record': 3})
+
+    def test_txn_is_all_or_nothing(self):
+        self.backend.put('count', '1')
+        value, index = self.backend.record('count')
+        self.assertFalse(self.backend.txn([('set', 'a', '1'), ('cas', 'count', '2', index + 1)]))
+        self.assertEquals(self.backend.keys(''), ['count'])
+        self.assertTrue(self.backend.txn([('set', 'a', '1'), ('cas', 'count', '2', index),
+                                          ('delete', 'count')]))
+        self.assertEquals(self.backend.keys(''), ['a'])
+
+    def test_keys(self):
+        for key in ['r/v1/a', 'r/v1/b', 'r/v2/c', 'r/x', 'other']:
+            self.backend.put(key, '')
+        self.assertEquals(self.backend.keys('r/'), ['r/v1/a', 'r/v1/b', 'r/v2/c', 'r/x'])
+        self.assertEquals(self.backend.keys('/r/', separator='/'), ['r/v1/', 'r/v2/', 'r/x'])
+        self.assertEquals(list(self.backend.iter_keys('r/v1/')), ['r/v1/a', 'r/v1/b'])
+        self.backend.delete('r/', recursive=True)
+        self.assertEquals(self.backend.keys(''), ['other'])
+
+    def test_get_blocks_until_changed(self):
+        value, index = self.backend.get('a')
+        self.assertEquals(value, None)
+        threading.Timer(0.1, self.backend.put, ('a', 'x')).start()
+        start = time.time()
+        value, new_index = self.backend.get('a', index, wait=5)
+        self.assertEquals(value, 'x')
+        self.assertTrue(new_index > index)
+        self.assertTrue(time.time() - start < 5)
+        # Changes to other keys don't end the wait
+        self.backend.put('b', 'y')
+        self.assertEquals(self.backend.get('a', new_index, wait=0.1), ('x', new_index))
+
+    def test_watch_keys(self):
+        self.backend.put('r/v1/a', '')
+        keys, index = self.backend.watch_keys('r/v1/')
+        self.assertEquals(keys, ['r/v1/a'])
+        threading.Timer(0.1, self.backend.delete, ('r/v1/a',)).start()
+        keys, new_index = self.backend.watch_keys('r/v1/', index, wait=5)
+        self.assertEquals(keys, [])
+        self.assertTrue(new_index > index)
+
+class MemoryBackendOrchestrateTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.do = DeploymentOrchestrator('somehost', 10000, backend=self.backend)
+
+    def test_versions(self):
+        self.do.trigger_update('v2')
+        self.assertEquals(self.do.current_version(), 'v2')
+        self.do.update_own_info('a', 'v1')
+        self.do.update_own_info('b', 'v1')
+        self.do.update_own_info('a', 'v2')
+        self.assertEquals(self.do.running_versions(), set(['v1', 'v2']))
+        self.assertEquals(self.do.hosts_at_version('v1'), set(['b']))
+        self.assertEquals(self.do.version_counts(), {'v1': 1, 'v2': 1})
+        self.assertEquals(self.do.reconcile_version_counts(), {})
+
+    def test_concurrent_registrations(self):
+        self.backend.latency = 0.002
+        self.do.min_backoff = 0.01
+        self.do.max_backoff = 0.05
+        hosts = ['cp%d' % i for i in range(100)]
+        threads = [threading.Thread(target=self.do.update_own_info, args=(host, 'v1'))
+                   for host in hosts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Every host is registered, even if the counter had to give way
+        self.assertEquals(self.do.hosts_at_version('v1'), set(hosts))
+        self.do.reconcile_version_counts()
+        self.assertEquals(self.do.version_counts(), {'v1': 100})
+
+    def test_concurrent_counter_writers(self):
+        self.backend.latency = 0.002
+        self.do.min_backoff = 0.01
+        self.do.max_backoff = 0.05
+        old = ['cp%d' % i for i in range(20)]
+        new = ['ct%d' % i for i in range(20)]
+        for host in old:
+            self.do.update_own_info(host, 'v1')
+        # Hosts being collected and hosts registering fight over one counter
+        threads = [threading.Thread(target=self.do._delete_registrations, args=('v1', [host]))
+                   for host in old]
+        threads += [threading.Thread(target=self.do.update_own_info, args=(host, 'v1'))
+                    for host in new]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(self.do.hosts_at_version('v1'), set(new))
+        self.assertEquals(self.do.version_counts(), {'v1': 20})
+
+    def test_watch_target_version(self):
+        self.do.trigger_update('v1')
+        def admit():
+            self.backend.put('target_version/a', 'v2')
+            self.do._touch_current_version()
+        threading.Timer(0.1, admit).start()
+        self.assertEquals(self.do.watch_target_version('a', known_version='v1', timeout=5, wait=2), 'v2')
+        self.assertEquals(self.backend.calls['get_many'], 2)
+
+    def test_watch_target_version_timeout(self):
+        self.do.trigger_update('v1')
+        self.backend.put('target_version/a', 'v2')
+        self.assertEquals(self.do.watch_target_version('a', known_version='v2', timeout=0.5, wait=0.1),
+                          None)
+
+    def test_wait_for_version(self):
+        threading.Timer(0.1, self.do.update_own_info, ('a', 'v2')).start()
+        with mock.patch.object(self.do, '_blocking_get', return_value=([], 1)):
+            self.assertTrue(self.do.wait_for_version('v2', 1, timeout=5, wait=0.1))
+
+class EtcdBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.backend = EtcdBackend(client=self.client)
+
+    def test_get(self):
+        self.client.read.return_value = etcd_result({'key': '/current_version', 'value': 'v1',
+                                                     'modifiedIndex': 7}, etcd_index=9)
+        self.assertEquals(self.backend.get('/current_version', stale=True), ('v1', 9))
+        self.client.read.assert_called_with('/current_version', quorum=False)
+        self.client.read.side_effect = etcd.EtcdKeyNotFound(payload={'index': 12})
+        self.assertEquals(self.backend.get('current_version'), (None, 12))
+
+    def test_get_watches(self):
+        self.client.read.return_value = etcd_result({'key': '/current_version', 'value': 'v2',
+                                                     'modifiedIndex': 10}, action='set')
+        self.assertEquals(self.backend.get('current_version', 9, wait=60), ('v2', 10))
+        self.client.read.assert_called_with('/current_version', wait=True, waitIndex=10,
+                                            recursive=False, timeout=60)
+        # After a quiet wait, the current value is read
+        self.client.read.side_effect = [etcd.EtcdWatchTimedOut(),
+                                        etcd_result({'key': '/current_version', 'value': 'v2',
+                                                     'modifiedIndex': 10}, etcd_index=10)]
+        self.assertEquals(self.backend.get('current_version', 10, wait=60), ('v2', 10))
+
+    def test_put(self):
+        self.assertTrue(self.backend.put('rollout/state', '{}', cas=0))
+        self.client.write.assert_called_with('/rollout/state', '{}', prevExist=False)
+        self.client.write.side_effect = etcd.EtcdCompareFailed()
+        self.assertFalse(self.backend.put('rollout/state', '{}', cas=5))
+        self.client.write.assert_called_with('/rollout/state', '{}', prevIndex=5)
+
+    def test_keys(self):
+        self.client.read.return_value = etcd_result(
+            {'key': '/running_version', 'dir': True,
+             'nodes': [{'key': '/running_version/v1', 'dir': True,
+                        'nodes': [{'key': '/running_version/v1/a', 'value': '1', 'modifiedIndex': 3}]},
+                       {'key': '/running_version/v2', 'dir': True}]})
+        self.assertEquals(self.backend.keys('/running_version/', separator='/'),
+                          ['running_version/v1/', 'running_version/v2/'])
+        self.assertEquals(self.backend.keys('/running_version/'), ['running_version/v1/a'])
+        self.client.read.assert_called_with('/running_version', recursive=True, quorum=True)
+
+    def test_txn(self):
+        self.client.read.side_effect = [etcd_result({'key': '/host_version/a', 'value': 'v1',
+                                                     'modifiedIndex': 4}),
+                                        etcd.EtcdKeyNotFound(payload={'index': 12})]
+        self.client.write.return_value = etcd_result({'key': '/host_version/a', 'value': 'v2',
+                                                      'modifiedIndex': 13})
+        self.assertFalse(self.backend.txn([('set', 'running_version/v2/a', '1'),
+                                           ('cas', 'host_version/a', 'v2', 4),
+                                           ('cas', 'version_count/v2', '1', 8)]))
+        # The check-and-set that went through is put back, and nothing else done
+        self.assertEquals(self.client.write.call_args_list,
+                          [mock.call('/host_version/a', 'v2', prevIndex=4),
+                           mock.call('/host_version/a', 'v1', prevIndex=13)])
+
+        self.client.reset_mock()
+        self.client.read.side_effect = [etcd.EtcdKeyNotFound(payload={'index': 12})]
+        self.assertTrue(self.backend.txn([('delete', 'running_version/v1/a'),
+                                          ('cas', 'host_version/a', 'v2', 0)]))
+        self.client.write.assert_called_once_with('/host_version/a', 'v2', prevExist=False)
+        self.client.delete.assert_called_once_with('/running_version/v1/a', recursive=None)
@@ -0,0 +1,65 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import argparse
+import shutil
+import tempfile
+import unittest
+from jiocloud import benchmark
+from jiocloud import fakenova
+
+class TestFakeNova(unittest.TestCase):
+    def test_list_paginates_and_filters(self):
+        nova_client = fakenova.FakeNovaClient(max_limit=2)
+        nova_client.add_servers(['a1_x', 'b1_y', 'a2_x', 'a3_x'])
+        page = nova_client.servers.list(search_opts={'name': '_x$'}, limit=10)
+        self.assertEquals([s.name for s in page], ['a1_x', 'a2_x'])
+        page = nova_client.servers.list(search_opts={'name': '_x$'}, marker=page[-1].id)
+        self.assertEquals([s.name for s in page], ['a3_x'])
+        self.assertEquals(nova_client.calls, {'servers.list': 2})
+
+    def test_build_and_delete(self):
+        nova_client = fakenova.FakeNovaClient(build_time=3600)
+        server = nova_client.servers.create('foo', 'image', 'flavor')
+        self.assertEquals(server.status, 'BUILD')
+        server.delete()
+        self.assertEquals(nova_client.servers.list(), [])
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.options = argparse.Namespace(latency=0, build_time=0, max_limit=50,
+                                          poll_interval=0, concurrency=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def calls(self, action, size):
+        return benchmark.measure(action, size, self.options, self.workdir)[1]
+
+    def test_apply(self):
+        calls = self.calls('apply', 40)
+        self.assertEquals(calls['servers.create'], 40)
+        self.assertEquals(calls['images.get'], 1)
+        self.assertEquals(calls['flavors.get'], 1)
+        self.assertEquals(calls['servers.add_floating_ip'], 10)
+
+    def test_ssh_config_lists_once_per_page(self):
+        # A lone short page might be capped, so the next one is asked for
+        self.assertEquals(self.calls('ssh_config', 10), {'servers.list': 2})
+        self.assertEquals(self.calls('ssh_config', 120), {'servers.list': 3})
+
+    def test_delete(self):
+        calls = self.calls('delete', 20)
+        self.assertEquals(calls['servers.delete'], 20)
+        self.assertFalse('servers.get' in calls)
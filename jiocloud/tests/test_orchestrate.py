@@ -15,11 +15,22 @@
 #
 import errno
 import mock
+import os
+import shutil
+import socket
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
 import consulate
 import unittest
 import json
 from contextlib import nested
+from jiocloud import orchestrate
+from jiocloud import orchestrate_agent
 from jiocloud.orchestrate import DeploymentOrchestrator
+from urllib3.exceptions import HTTPError
 
 class OrchestrateTests(unittest.TestCase):
     def setUp(self, *args, **kwargs):
@@ -66,92 +77,366 @@ class OrchestrateTests(unittest.TestCase):
             self.assertFalse(self.do.verify_hosts('', ['cp2', 'ctrl1']))
 
     def test_hosts_at_version_none(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.side_effect = KeyError
+        with mock.patch.object(self.do.backend, 'iter_keys') as iter_kv_keys:
+            iter_kv_keys.return_value = iter([])
 
-            self.assertEquals(self.do.hosts_at_version('foo'), [])
+            self.assertEquals(self.do.hosts_at_version('foo'), set())
 
     def test_hosts_at_version_none_but_dir_exists(self):
-        with mock.patch.object(self.do, '_consul') as consul:
-            consul.return_value.kv.find.return_value = [
-                '/running_version/foo/'
-                ]
+        with mock.patch.object(self.do.backend, 'iter_keys') as iter_kv_keys:
+            iter_kv_keys.return_value = iter([
+                'running_version/foo/'
+                ])
             self.assertEquals(self.do.hosts_at_version('foo'), set([]))
 
     def test_hosts_at_version(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.return_value = [
-                '/running_version/foo/node1',
-                '/running_version/foo/node2'
-                ]
+        with mock.patch.object(self.do.backend, 'iter_keys') as iter_kv_keys:
+            iter_kv_keys.return_value = iter([
+                'running_version/foo/node1',
+                'running_version/foo/node2'
+                ])
             self.assertEquals(self.do.hosts_at_version('foo'), set(['node1', 'node2']))
-            consul.return_value.kv.find.assert_called_with('/running_version/foo')
+            iter_kv_keys.assert_called_with('running_version/foo/')
+
+    def test_iter_kv_keys(self):
+        with mock.patch.object(self.do, '_http') as http:
+            response = http.urlopen.return_value
+            response.status = 200
+            response.stream.return_value = iter(['[\n"running_version/v1/no',
+                                                 'de1", "running_version/v1/node2"',
+                                                 ',"running_version/v1/n\\u00e9"', ']'])
+            self.assertEquals(list(self.do.backend.iter_keys('/running_version/v1/')),
+                              ['running_version/v1/node1',
+                               'running_version/v1/node2',
+                               u'running_version/v1/n\xe9'])
+            self.assertEquals(http.urlopen.call_args[0], ('GET', '/v1/kv/running_version/v1/?keys'))
+            response.release_conn.assert_called_once_with()
+
+            response.status = 404
+            self.assertEquals(list(self.do.backend.iter_keys('/running_version/v1/')), [])
+
+    def test_missing_hosts(self):
+        with mock.patch.object(self.do, 'hosts_at_version') as hav:
+            hav.return_value = set(['cp1', 'ctrl1', 'st1'])
+            self.assertEquals(list(self.do.missing_hosts('', iter(['cp1', 'cp2', 'st1', 'st2']))),
+                              ['cp2', 'st2'])
+            self.assertEquals(list(self.do.missing_hosts('', iter(['cp1', 'cp2', 'st1', 'st2']),
+                                                         fail_fast=True)),
+                              ['cp2'])
 
     def test_running_versions(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.return_value = [
-                '/running_version/v10',
-                '/running_version/v11',
-                '/running_version/v12'
-                ]
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.return_value = ([
+                'running_version/v10/',
+                'running_version/v11/',
+                'running_version/v12/'
+                ], {})
             self.assertEquals(self.do.running_versions(),
                               set(['v10', 'v11', 'v12']))
+            request.assert_called_with('GET', 'kv/running_version/',
+                                       {'keys': True, 'separator': '/'})
 
     def test_running_versions_none(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.return_value = [
-                '/running_version',
-                ]
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.return_value = (['running_version/'], {})
             self.assertEquals(self.do.running_versions(), set())
 
     def test_running_versions_none2(self):
-        with mock.patch.object(self.do, '_consul') as consul:
-            consul.read.side_effect = KeyError
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.return_value = (None, {})
             self.assertEquals(self.do.running_versions(), set())
 
     def test_get_failures_failing(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.get_value.health.state.return_value = [1,2]
-            self.assertTrue(self.do.get_failures())
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.return_value = ([{'Node': 'host1', 'Name': 'puppet', 'Status': 'critical'}], {})
+            self.assertFalse(self.do.get_failures())
+            request.assert_called_with('GET', 'health/state/critical', {}, stale=True)
 
     def test_get_failures_passing(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.get_value.health.state.return_value = []
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.return_value = ([], {})
             self.assertTrue(self.do.get_failures())
 
+    def test_get_failures_warnings(self):
+        checks = {'health/state/critical': [],
+                  'health/state/warning': [{'Node': 'host1', 'Name': 'puppet', 'Status': 'warning'}]}
+        with nested(mock.patch.object(self.do, '_consul_request'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+          ) as (request, stdout):
+            request.side_effect = lambda method, path, params, stale: (checks[path], {})
+            self.assertFalse(self.do.get_failures(hosts=True, show_warnings=True))
+            self.assertEquals(sorted(c[0][1] for c in request.call_args_list),
+                              ['health/state/critical', 'health/state/warning'])
+            self.assertEquals(stdout.getvalue(), 'Warnings:\n  Node: host1, Check: puppet\n')
+
+    def test_failing_checks_concurrent(self):
+        # Each fetch waits for the other to have started
+        started = [threading.Event(), threading.Event()]
+        def request(method, path, params, stale):
+            started[path.endswith('warning')].set()
+            self.assertTrue(started[not path.endswith('warning')].wait(5))
+            return [{'Node': 'host1', 'Name': path, 'Status': path.split('/')[-1]}], {}
+        with mock.patch.object(self.do, '_consul_request') as consul_request:
+            consul_request.side_effect = request
+            self.assertEquals([c['Status'] for c in self.do.failing_checks(show_warnings=True)],
+                              ['critical', 'warning'])
+
+    def test_failing_checks_error(self):
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.side_effect = HTTPError('rpc error')
+            self.assertRaises(HTTPError, self.do.failing_checks, show_warnings=True)
+
+    def test_failing_checks_scoped(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value = mock.Mock(status=200, data='[]', headers={})
+            self.do.failing_checks(service='nova-api', node_prefix='cp1.',
+                                   node_meta=['project:p1', 'role:cp'])
+            self.assertEquals(http.urlopen.call_args[0],
+                              ('GET', '/v1/health/state/critical?'
+                                      'filter=ServiceName%20%3D%3D%20%22nova-api%22%20and%20'
+                                      'Node%20matches%20%22%5Ecp1%5C%5C.%22&'
+                                      'node-meta=project%3Ap1&node-meta=role%3Acp'))
 
-#    def test_update_own_status(self):
+    def test_failure_summary(self):
+        checks = [{'Node': 'a', 'Name': 'puppet', 'Status': 'critical'},
+                  {'Node': 'a', 'Name': 'validation', 'Status': 'critical'},
+                  {'Node': 'b', 'Name': 'puppet', 'Status': 'warning'}]
+        self.assertEquals(self.do.failure_summary(checks),
+                          {'total': 3,
+                           'by_status': {'critical': 2, 'warning': 1},
+                           'by_check': {'puppet': 2, 'validation': 1},
+                           'by_node': {'a': 2, 'b': 1}})
+
+    def test_main_get_failures_summary(self):
+        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.failing_checks'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+          ) as (failing_checks, stdout):
+            failing_checks.return_value = [{'Node': 'a', 'Name': 'puppet', 'Status': 'critical'}]
+            self.assertTrue(orchestrate.main(['--no_agent', 'get_failures', '--summary', '--json',
+                                              '--node_meta', 'project:p1']))
+            failing_checks.assert_called_with(False, service=None, node_prefix=None,
+                                              node_meta=['project:p1'])
+            self.assertEquals(json.loads(stdout.getvalue())['by_check'], {'puppet': 1})
+    def test_update_own_status(self):
+        with mock.patch.object(self.do, '_consul_request') as consul_request:
+            consul_request.return_value = (None, {})
+            for status_type, status_result, state in [('puppet', 0, 'pass'),
+                                                      ('puppet', 2, 'pass'),
+                                                      ('puppet', 6, 'fail'),
+                                                      ('puppet', -1, 'warn'),
+                                                      ('validation', 0, 'pass'),
+                                                      ('validation', 1, 'fail')]:
+                self.do.update_own_status('host1', status_type, status_result)
+                consul_request.assert_called_with('PUT', 'agent/check/%s/%s' % (state, status_type))
+            self.assertRaises(Exception, self.do.update_own_status, 'host1', 'bogus', 0)
+
+    def test_report(self):
+        with nested(mock.patch.object(self.do, '_consul_request'),
+                    mock.patch.object(self.do, 'update_own_info')
+          ) as (consul_request, update_own_info):
+            consul_request.return_value = (None, {})
+            update_own_info.return_value = True
+            self.assertTrue(self.do.report('host1', [('puppet', 2), ('validation', 1)], 'v3'))
+            self.assertEquals(consul_request.call_args_list,
+                              [mock.call('PUT', 'agent/check/pass/puppet'),
+                               mock.call('PUT', 'agent/check/fail/validation')])
+            update_own_info.assert_called_with('host1', 'v3')
+
+    def test_report_invalid_status(self):
+        with nested(mock.patch.object(self.do, '_consul_request'),
+                    mock.patch.object(self.do, 'update_own_info')
+          ) as (consul_request, update_own_info):
+            self.assertRaises(Exception, self.do.report, 'host1', [('puppet', 0), ('bogus', 0)])
+            self.assertFalse(consul_request.called)
+            self.assertFalse(update_own_info.called)
+
+    def test_main_report(self):
+        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.report') as report:
+            orchestrate.main(['--no_agent', 'report', '--hostname', 'host1', '--puppet', '-1'])
+            report.assert_called_with('host1', [('puppet', -1)], version=None)
+
+    def test_lazy_imports(self):
+        # Local subcommands must not pay for the consul client libraries
+        code = ('import sys; from jiocloud import orchestrate; '
+                'orchestrate.main(["--no_agent", "local_version"]); '
+                'print sorted(m for m in ["consulate", "urllib3", "requests", "SocketServer", "subprocess"] '
+                'if m in sys.modules)')
+        proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+        self.assertEquals(proc.communicate()[0].strip().split('\n')[-1], '[]')
 
     def test_update_own_info(self):
-        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock),
+        with nested(mock.patch.object(self.do.backend, 'record'),
+                    mock.patch.object(self.do.backend, 'records'),
+                    mock.patch.object(self.do.backend, 'txn'),
+                    mock.patch('time.time')
+          ) as (kv_record, kv_records, kv_txn, time):
+            time.return_value = 12345678
+            kv_record.return_value = ('v12', 40)
+            kv_records.return_value = {'version_count/v12': ('7', 50)}
+            kv_txn.return_value = True
+
+            self.do.update_own_info(hostname='testhost',
+                                    version='v13')
+
+            kv_record.assert_called_once_with('host_version/testhost')
+            kv_txn.assert_called_once_with([
+                ('set', 'running_version/v13/testhost', '12345678'),
+                ('cas', 'host_version/testhost', 'v13', 40),
+                ('delete', 'running_version/v12/testhost'),
+                ('cas', 'version_count/v12', '6', 50),
+                ('cas', 'version_count/v13', '1', 0)])
+
+    def test_update_own_info_same_version(self):
+        with nested(mock.patch.object(self.do.backend, 'record'),
+                    mock.patch.object(self.do.backend, 'records'),
+                    mock.patch.object(self.do.backend, 'txn'),
                     mock.patch('time.time')
-          ) as (consul, time):
+          ) as (kv_record, kv_records, kv_txn, time):
             time.return_value = 12345678
+            kv_record.return_value = ('v13', 40)
+            kv_txn.return_value = True
 
             self.do.update_own_info(hostname='testhost',
                                     version='v13')
-            expected_calls = [mock.call('/running_version/v13/testhost',
-                                        '12345678')]
-            self.assertEquals(consul.return_value.kv.set.call_args_list, expected_calls)
+
+            # Already registered: only reads
+            self.assertEquals(kv_record.call_args_list,
+                              [mock.call('host_version/testhost'),
+                               mock.call('running_version/v13/testhost')])
+            self.assertFalse(kv_txn.called)
+            self.assertFalse(kv_records.called)
+
+            # The entry went missing behind the pointer's back
+            kv_record.side_effect = [('v13', 40), (None, 0)]
+            self.do.update_own_info(hostname='testhost',
+                                    version='v13')
+
+            kv_txn.assert_called_once_with([
+                ('set', 'running_version/v13/testhost', '12345678'),
+                ('cas', 'host_version/testhost', 'v13', 40)])
+            self.assertFalse(kv_records.called)
+
+    def test_update_own_info_unknown_host(self):
+        with nested(mock.patch.object(self.do.backend, 'record'),
+                    mock.patch.object(self.do.backend, 'records'),
+                    mock.patch.object(self.do, 'running_versions'),
+                    mock.patch.object(self.do.backend, 'txn'),
+                    mock.patch('time.time')
+          ) as (kv_record, kv_records, running_versions, kv_txn, time):
+            time.return_value = 12345678
+            registered = set(['running_version/v11/testhost', 'running_version/v13/testhost'])
+            kv_record.side_effect = lambda key: key in registered and ('1', 9) or (None, 0)
+            running_versions.return_value = set(['v11', 'v12', 'v13'])
+            kv_records.return_value = {'version_count/v11': ('3', 20),
+                                       'version_count/v13': ('5', 21)}
+            kv_txn.return_value = True
+
+            self.do.update_own_info(hostname='testhost',
+                                    version='v13')
+
+            kv_txn.assert_called_once_with([
+                ('set', 'running_version/v13/testhost', '12345678'),
+                ('cas', 'host_version/testhost', 'v13', 0),
+                ('delete', 'running_version/v11/testhost'),
+                ('cas', 'version_count/v11', '2', 20)])
+
+    def test_update_own_info_retries(self):
+        with nested(mock.patch.object(self.do, '_register_version_ops'),
+                    mock.patch.object(self.do.backend, 'txn'),
+                    mock.patch('time.sleep')
+          ) as (register_version_ops, kv_txn, sleep):
+            kv_txn.side_effect = [False, False, True]
+            self.do.update_own_info(hostname='testhost', version='v13')
+            self.assertEquals(register_version_ops.call_count, 3)
+            self.assertEquals(sleep.call_count, 2)
+
+            # Once out of attempts, the host is registered without the counters
+            register_version_ops.reset_mock()
+            kv_txn.side_effect = [False, False, True]
+            self.do.update_own_info(hostname='testhost', version='v13', attempts=2)
+            self.assertEquals(register_version_ops.call_args_list,
+                              [mock.call('testhost', 'v13'), mock.call('testhost', 'v13'),
+                               mock.call('testhost', 'v13', counters=False)])
+
+    def test_register_version_ops_without_counters(self):
+        with nested(mock.patch.object(self.do.backend, 'record'),
+                    mock.patch.object(self.do.backend, 'records'),
+                    mock.patch('time.time')
+          ) as (kv_record, kv_records, time):
+            time.return_value = 12345678
+            kv_record.return_value = ('v12', 40)
+            self.assertEquals(self.do._register_version_ops('testhost', 'v13', counters=False),
+                              [('set', 'running_version/v13/testhost', '12345678'),
+                               ('set', 'host_version/testhost', 'v13'),
+                               ('delete', 'running_version/v12/testhost')])
+            self.assertFalse(kv_records.called)
 
     def test_update_own_info_no_version_noop(self):
-        with nested(mock.patch.object(self.do, '_consul'),
+        with nested(mock.patch.object(self.do, '_consul_request'),
                     mock.patch.object(self.do, 'local_version')
-                    ) as (consul, local_version):
+                    ) as (consul_request, local_version):
             local_version.return_value = None
 
             self.do.update_own_info(hostname='testhost')
 
-            self.assertEquals(consul.write.call_args_list, [])
+            self.assertEquals(consul_request.call_args_list, [])
 
     def test_update_own_info_defaults_to_local_version(self):
-        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock),
+        with nested(mock.patch.object(self.do, '_register_version_ops'),
+                    mock.patch.object(self.do.backend, 'txn'),
                     mock.patch.object(self.do, 'local_version')
-          ) as (consul, local_version):
+          ) as (register_version_ops, kv_txn, local_version):
             local_version.return_value = 'v674'
             self.do.update_own_info(hostname='testhost')
-            self.assertEquals(consul.return_value.kv.set.call_args[0][0],
-                              '/running_version/v674/testhost')
+            register_version_ops.assert_called_once_with('testhost', 'v674')
+
+    def test_kv_txn(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value = mock.Mock(status=200, data='{"Results": []}')
+            self.assertTrue(self.do.backend.txn([('set', '/a/b', 'v1'),
+                                             ('cas', 'c', '2', 7),
+                                             ('delete', 'd')]))
+            method, url = http.urlopen.call_args[0]
+            self.assertEquals((method, url), ('PUT', '/v1/txn'))
+            self.assertEquals(json.loads(http.urlopen.call_args[1]['body']),
+                              [{'KV': {'Verb': 'set', 'Key': 'a/b', 'Value': 'djE='}},
+                               {'KV': {'Verb': 'cas', 'Key': 'c', 'Value': 'Mg==', 'Index': 7}},
+                               {'KV': {'Verb': 'delete', 'Key': 'd'}}])
+
+            http.urlopen.return_value = mock.Mock(status=409, data='{"Errors": []}')
+            self.assertFalse(self.do.backend.txn([('set', 'a', 'b')]))
+
+            http.urlopen.return_value = mock.Mock(status=500, data='oops')
+            self.assertRaises(HTTPError, self.do.backend.txn, [('set', 'a', 'b')])
+
+    def test_version_counts(self):
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.return_value = ([{'Key': 'version_count/', 'Value': None, 'ModifyIndex': 3},
+                                     {'Key': 'version_count/v1', 'Value': 'MTI=', 'ModifyIndex': 4},
+                                     {'Key': 'version_count/v2', 'Value': 'MA==', 'ModifyIndex': 5}], {})
+            self.assertEquals(self.do.version_counts(), {'v1': 12, 'v2': 0})
+            request.assert_called_with('GET', 'kv/version_count/', {'recurse': True})
+            self.assertEquals(self.do.running_versions(use_counts=True), set(['v1']))
+
+    def test_reconcile_version_counts(self):
+        with nested(mock.patch.object(self.do, 'version_counts'),
+                    mock.patch.object(self.do, 'running_versions'),
+                    mock.patch.object(self.do, 'hosts_at_version'),
+                    mock.patch.object(self.do.backend, 'put'),
+                    mock.patch.object(self.do.backend, 'delete')
+          ) as (version_counts, running_versions, hosts_at_version, kv_put, kv_delete):
+            version_counts.return_value = {'v1': 2, 'v2': 5, 'v3': 1}
+            running_versions.return_value = set(['v1', 'v2', 'v4'])
+            hosts_at_version.side_effect = lambda v: {'v1': set(['a', 'b']),
+                                                      'v2': set(['c']),
+                                                      'v4': set(['d'])}[v]
+
+            self.assertEquals(self.do.reconcile_version_counts(),
+                              {'v2': (5, 1), 'v3': (1, 0), 'v4': (0, 1)})
+            self.assertEquals(sorted(kv_put.call_args_list),
+                              [mock.call('/version_count/v2', '1'),
+                               mock.call('/version_count/v4', '1')])
+            kv_delete.assert_called_once_with('/version_count/v3')
 
     def test_ping_succesful(self):
         with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
@@ -169,10 +454,10 @@ class OrchestrateTests(unittest.TestCase):
             self.assertFalse(self.do.ping())
 
     def test_current_version(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.get.return_value = 'v673 '
+        with mock.patch.object(self.do.backend, 'get') as kv_get:
+            kv_get.return_value = ('v673 ', 12)
             self.assertEquals(self.do.current_version(), 'v673')
-            consul.return_value.kv.get.assert_called_with('/current_version')
+            kv_get.assert_called_with('/current_version', stale=True)
 
     def test_pending_update(self):
         with nested(
@@ -210,10 +495,587 @@ class OrchestrateTests(unittest.TestCase):
                               self.do.NO_CLUE_BUT_WERE_JUST_GETTING_STARTED)
 
     def test_trigger_update(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
+        with mock.patch.object(self.do.backend, 'put') as kv_put:
             self.do.trigger_update('v673')
 
-            consul.return_value.kv.set.assert_called_with('/current_version', 'v673')
+            kv_put.assert_called_with('current_version', 'v673')
+
+    def test_consul_request(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value = mock.Mock(status=200, data='["a/", "b/"]',
+                                                  headers={'X-Consul-Index': '7'})
+            self.assertEquals(self.do._consul_request('GET', 'kv/running_version/',
+                                                      {'keys': True, 'separator': '/'}),
+                              ([u'a/', u'b/'], {'X-Consul-Index': '7'}))
+            self.assertEquals(http.urlopen.call_args[0],
+                              ('GET', '/v1/kv/running_version/?keys&separator=%2F'))
+
+            http.urlopen.return_value = mock.Mock(status=404, data='', headers={})
+            self.assertEquals(self.do._consul_request('GET', 'kv/foo'), (None, {}))
+
+            http.urlopen.return_value = mock.Mock(status=500, data='rpc error', headers={})
+            self.assertRaises(HTTPError, self.do._consul_request, 'GET', 'kv/foo')
+
+    def test_consul_request_stale(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value = mock.Mock(status=200, data='[]',
+                                                  headers={'X-Consul-LastContact': '10',
+                                                           'X-Consul-KnownLeader': 'true'})
+            self.do._consul_request('GET', 'health/state/critical', stale=True)
+            self.assertEquals(http.urlopen.call_args[0], ('GET', '/v1/health/state/critical'))
+
+            self.do.fleet = True
+            self.do._consul_request('GET', 'health/state/critical', stale=True)
+            self.assertEquals(http.urlopen.call_args[0], ('GET', '/v1/health/state/critical?stale'))
 
+    def test_consul_request_too_stale(self):
+        self.do.fleet = True
+        for headers in [{'X-Consul-LastContact': '9000', 'X-Consul-KnownLeader': 'true'},
+                        {'X-Consul-LastContact': '0', 'X-Consul-KnownLeader': 'false'}]:
+            with mock.patch.object(self.do, '_http') as http:
+                http.urlopen.return_value = mock.Mock(status=200, data='[]', headers=headers)
+                self.do._consul_request('GET', 'kv/current_version', {'index': 3}, stale=True)
+                self.assertEquals([c[0] for c in http.urlopen.call_args_list],
+                                  [('GET', '/v1/kv/current_version?index=3&stale'),
+                                   ('GET', '/v1/kv/current_version?index=3')])
 
+    def test_backoff_jitter(self):
+        self.assertEquals([self.do.backoff(a) for a in range(8)], [1, 2, 4, 8, 16, 32, 60, 60])
+        self.do.fleet = True
+        with mock.patch('random.uniform') as uniform:
+            uniform.return_value = 3
+            self.assertEquals(self.do.backoff(2), 3)
+            uniform.assert_called_with(2, 4)
+
+    def test_kv_get(self):
+        with mock.patch.object(self.do, '_consul_request') as request:
+            request.return_value = ([{'Key': 'current_version', 'Value': 'djEy'}],
+                                    {'X-Consul-Index': '42'})
+            self.assertEquals(self.do.backend.get('/current_version', index=40, wait=60), ('v12', 42))
+            request.assert_called_with('GET', 'kv/current_version', {'index': 40, 'wait': '60s'},
+                                       read_timeout=73.75, stale=False)
+
+            request.return_value = (None, {'X-Consul-Index': '43'})
+            self.assertEquals(self.do.backend.get('/current_version'), (None, 43))
+
+    def test_watch_update(self):
+        with nested(mock.patch.object(self.do.backend, 'get'),
+                    mock.patch.object(self.do, 'local_version'),
+                    mock.patch('time.sleep')
+          ) as (kv_get, local_version, sleep):
+            local_version.return_value = 'v1'
+            kv_get.side_effect = [('v1', 10), IOError, ('v1', 12), ('v1', 5), ('v2 ', 11)]
+
+            self.assertEquals(self.do.watch_update(wait=30), 'v2')
+
+            self.assertEquals([c[1]['index'] for c in kv_get.call_args_list], [0, 10, 10, 12, 0])
+            sleep.assert_called_once_with(1)
+
+    def test_watch_update_splay(self):
+        with nested(mock.patch.object(self.do.backend, 'get'),
+                    mock.patch('random.uniform'),
+                    mock.patch('time.sleep')
+          ) as (kv_get, uniform, sleep):
+            kv_get.return_value = ('v2', 10)
+            uniform.return_value = 7
+            self.assertEquals(self.do.watch_update(known_version='v1', splay=30), 'v2')
+            uniform.assert_called_with(0, 30)
+            sleep.assert_called_with(7)
+            self.assertTrue(kv_get.call_args[1]['stale'])
+
+    def test_main_fleet_splay(self):
+        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator'),
+                    mock.patch('random.uniform'),
+                    mock.patch('time.sleep'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+          ) as (DO, uniform, sleep, stdout):
+            uniform.return_value = 12
+            DO.return_value.current_version.return_value = 'v2'
+            orchestrate.main(['--no_agent', '--fleet', '--splay', '30', 'current_version'])
+            uniform.assert_called_with(0, 30)
+            sleep.assert_called_with(12)
+            self.assertTrue(DO.return_value.fleet)
+            self.assertEquals(stdout.getvalue(), 'v2\n')
+
+    def fake_blocking_get(self, responses):
+        """
+        Stand-in for _blocking_get answering each path with its list of
+        (data, index) in turn, then with the last one again after a
+        while, as when a blocking query times out
+        """
+        responses = dict((path, list(r)) for path, r in responses.items())
+        calls = []
+        def blocking_get(path, params, index=None, wait=None, stale=False):
+            calls.append((path, index))
+            if len(responses[path]) == 1:
+                threading.Event().wait(0.05)
+                return responses[path][0]
+            response = responses[path].pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return blocking_get, calls
+
+    def test_wait_for_version(self):
+        blocking_get, calls = self.fake_blocking_get({
+            'kv/running_version/v2/': [(['running_version/v2/a'], 10),
+                                      (['running_version/v2/a', 'running_version/v2/b'], 12),
+                                      (['running_version/v2/a', 'running_version/v2/b',
+                                        'running_version/v2/c'], 15)],
+            'health/state/critical': [([], 7)]})
+        progress = mock.Mock()
+        with mock.patch.object(self.do, '_blocking_get', side_effect=blocking_get):
+            self.assertTrue(self.do.wait_for_version('v2', 3, timeout=5, use_counts=False,
+                                                     progress=progress))
+        self.assertEquals([c[0][0] for c in progress.call_args_list][-1], 3)
+        self.assertTrue(('kv/running_version/v2/', 12) in calls)
+
+    def test_wait_for_version_failure(self):
+        blocking_get, calls = self.fake_blocking_get({
+            'kv/version_count/v2': [([{'Value': 'MQ=='}], 10)],
+            'health/state/critical': [([], 7), ([{'Node': 'a', 'Name': 'puppet'}], 8)]})
+        progress = mock.Mock()
+        with mock.patch.object(self.do, '_blocking_get', side_effect=blocking_get):
+            self.assertEquals(self.do.wait_for_version('v2', 3, timeout=5,
+                                                       progress=progress), False)
+        progress.assert_called_with(1, [{'Node': 'a', 'Name': 'puppet'}])
+
+    def test_wait_for_version_timeout(self):
+        blocking_get, calls = self.fake_blocking_get({
+            'kv/running_version/v2/': [(None, 10)],
+            'health/state/critical': [([], 7)]})
+        with mock.patch.object(self.do, '_blocking_get', side_effect=blocking_get):
+            self.assertEquals(self.do.wait_for_version('v2', 3, timeout=0.2, use_counts=False), None)
+
+    def test_wait_for_version_counts(self):
+        blocking_get, calls = self.fake_blocking_get({
+            'kv/version_count/v2': [([{'Value': 'Mg=='}], 10), ([{'Value': 'Mw=='}], 12)],
+            'health/state/critical': [([], 7)]})
+        with nested(mock.patch.object(self.do, '_blocking_get', side_effect=blocking_get),
+                    mock.patch.object(self.do, 'hosts_at_version')
+          ) as (_, hosts_at_version):
+            hosts_at_version.return_value = set(['a', 'b', 'c'])
+            self.assertTrue(self.do.wait_for_version('v2', 3, timeout=5))
+            # The hosts are only listed to confirm the counter
+            hosts_at_version.assert_called_once_with('v2')
+
+    def test_wait_for_version_counter_behind(self):
+        blocking_get, calls = self.fake_blocking_get({
+            'kv/version_count/v2': [([{'Value': 'Mg=='}], 10)],
+            'health/state/critical': [([], 7)]})
+        with nested(mock.patch.object(self.do, '_blocking_get', side_effect=blocking_get),
+                    mock.patch.object(self.do, 'hosts_at_version')
+          ) as (_, hosts_at_version):
+            hosts_at_version.return_value = set(['a', 'b', 'c'])
+            self.assertTrue(self.do.wait_for_version('v2', 3, timeout=0.2))
+            hosts_at_version.return_value = set(['a', 'b'])
+            self.assertEquals(self.do.wait_for_version('v2', 3, timeout=0.2), None)
+
+    def test_main_wait_for_version(self):
+        def wait_for_version(version, expect, timeout, use_counts, progress, **scope):
+            progress(1, [{'Node': 'a', 'Name': 'puppet'}])
+            return False
+        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.wait_for_version'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+          ) as (wait, stdout):
+            wait.side_effect = wait_for_version
+            self.assertEquals(orchestrate.main(['wait_for_version', 'v2', '--expect', '3']), 1)
+            self.assertEquals(stdout.getvalue(), 'v2: 1/3 hosts, 1 critical checks\n'
+                                                 'Failures:\n  Node: a, Check: puppet\n')
+            wait.side_effect = None
+            wait.return_value = None
+            self.assertEquals(orchestrate.main(['wait_for_version', 'v2', '--expect', '3',
+                                                '--timeout', '10']), 2)
+            self.assertEquals(wait.call_args[0], ('v2', 3, 10, True))
+            orchestrate.main(['wait_for_version', 'v2', '--expect', '3', '--list_keys'])
+            self.assertEquals(wait.call_args[0], ('v2', 3, None, False))
+
+    def test_target_version(self):
+        with mock.patch.object(self.do, '_consul_request') as consul_request:
+            consul_request.return_value = ({'Results': [
+                {'KV': {'Key': 'current_version', 'Value': 'djE='}},
+                {'KV': {'Key': 'target_version/host1', 'Value': 'djIK'}},
+                {'KV': {'Key': 'target_version/host10', 'Value': 'djM='}}]}, {})
+            self.assertEquals(self.do.target_version('host1'), 'v2')
+            # Both keys are read in one request
+            consul_request.assert_called_once_with(
+                'PUT', 'txn', body=json.dumps([{'KV': {'Verb': 'get-tree', 'Key': 'target_version/host1'}},
+                                               {'KV': {'Verb': 'get-tree', 'Key': 'current_version'}}]),
+                stale=True)
+            self.assertEquals(self.do.target_version('host2'), 'v1')
+
+    def test_pending_update_target_version(self):
+        with nested(mock.patch.object(self.do, 'local_version'),
+                    mock.patch.object(self.do, 'target_version')
+          ) as (local_version, target_version):
+            local_version.return_value = 'v1'
+            target_version.return_value = 'v2'
+            self.assertEquals(self.do.pending_update('host1'), self.do.UPDATE_AVAILABLE)
+            target_version.assert_called_with('host1')
+
+    def test_watch_target_version(self):
+        with nested(mock.patch.object(self.do.backend, 'get'),
+                    mock.patch.object(self.do.backend, 'get_many')
+          ) as (kv_get, get_many):
+            # Nothing for host1, a quiet wait, then a touch as its wave is admitted
+            kv_get.side_effect = [('v1', 7), ('v1', 7), ('v1', 9)]
+            get_many.side_effect = [{'target_version/host1': None, 'current_version': 'v1'},
+                                    {'target_version/host1': 'v3', 'current_version': 'v1'}]
+            self.assertEquals(self.do.watch_target_version('host1', known_version='v1', timeout=5), 'v3')
+            # Only the one query on /current_version is held
+            self.assertEquals([c[0][0] for c in kv_get.call_args_list], ['/current_version'] * 3)
+            # and the target is only read when it changes
+            self.assertEquals(get_many.call_count, 2)
+
+    def test_watch_target_version_quiet(self):
+        with nested(mock.patch.object(self.do.backend, 'get'),
+                    mock.patch.object(self.do.backend, 'get_many')
+          ) as (kv_get, get_many):
+            # Host1 is already at its target; quiet waits don't fall back to /current_version
+            kv_get.return_value = ('v1', 7)
+            get_many.return_value = {'target_version/host1': 'v2', 'current_version': 'v1'}
+            with mock.patch('time.time', side_effect=[0, 0, 1, 2, 6]):
+                self.assertEquals(self.do.watch_target_version('host1', known_version='v2',
+                                                               wait=1, timeout=5), None)
+            self.assertEquals(kv_get.call_count, 3)
+            self.assertEquals(get_many.call_count, 1)
+
+    def test_touch_current_version(self):
+        with nested(mock.patch.object(self.do.backend, 'record'),
+                    mock.patch.object(self.do.backend, 'put')
+          ) as (kv_record, kv_put):
+            kv_record.return_value = ('v1', 7)
+            self.do._touch_current_version()
+            kv_put.assert_called_with('current_version', 'v1', cas=7)
+            kv_put.reset_mock()
+            kv_record.return_value = (None, 0)
+            self.do._touch_current_version()
+            self.assertFalse(kv_put.called)
+
+    def test_plan_waves(self):
+        hosts = ['cp1_x', 'cp2_x', 'cp3_x', 'ct1_x', 'ct2_x', 'gw1_x']
+        self.assertEquals(self.do.plan_waves(hosts, 4, max_per_role=1),
+                          [['cp1_x', 'ct1_x', 'gw1_x'], ['cp2_x', 'ct2_x'], ['cp3_x']])
+        self.assertEquals(self.do.plan_waves(hosts, '50%', first_wave=1),
+                          [['cp1_x'], ['cp2_x', 'cp3_x', 'ct1_x'], ['ct2_x', 'gw1_x']])
+        self.assertEquals(self.do.plan_waves([], '10%'), [])
+
+    def test_plan_waves_bad_sizes(self):
+        hosts = ['cp1_a', 'cp2_a']
+        self.assertRaises(ValueError, self.do.plan_waves, hosts, '0')
+        self.assertRaises(ValueError, self.do.plan_waves, hosts, -1)
+        self.assertRaises(ValueError, self.do.plan_waves, hosts, '0%')
+        self.assertRaises(ValueError, self.do.plan_waves, hosts, 1, first_wave=0)
+        self.assertRaises(ValueError, self.do.plan_waves, hosts, 1, max_per_role=-1)
+
+    def test_main_rollout_bad_wave_size(self):
+        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator'),
+                    mock.patch('sys.stderr', new_callable=StringIO.StringIO)
+          ) as (DO, stderr):
+            DO.return_value.start_rollout.side_effect = ValueError('The wave size must be at least 1, not 0')
+            self.assertRaises(SystemExit, orchestrate.main,
+                              ['--no_agent', 'rollout', 'start', 'v2', '--wave_size', '0'])
+            self.assertIn('The wave size must be at least 1', stderr.getvalue())
+
+    def test_start_rollout(self):
+        with nested(mock.patch.object(self.do, 'rollout_state'),
+                    mock.patch.object(self.do, 'registered_hosts'),
+                    mock.patch.object(self.do, 'hosts_at_version'),
+                    mock.patch.object(self.do, '_save_rollout')
+          ) as (rollout_state, registered_hosts, hosts_at_version, save_rollout):
+            rollout_state.return_value = ({'version': 'v1', 'status': 'done'}, 5)
+            registered_hosts.return_value = set(['cp1', 'cp2', 'cp3'])
+            hosts_at_version.return_value = set(['cp2'])
+            state = self.do.start_rollout('v2', 1, node_prefix='cp')
+            self.assertEquals(state['waves'], [['cp1'], ['cp3']])
+            self.assertEquals(state['already_at_version'], 1)
+            self.assertEquals(state['scope'], {'node_prefix': 'cp'})
+            save_rollout.assert_called_with(state, 5)
+
+            rollout_state.return_value = ({'version': 'v1', 'status': 'halted'}, 5)
+            self.assertRaises(Exception, self.do.start_rollout, 'v2', 1)
+
+    def rollout(self, **kwargs):
+        state = {'version': 'v2', 'status': 'running', 'reason': None, 'wave': -1,
+                 'waves': [['cp1', 'cp2'], ['cp3']], 'already_at_version': 1,
+                 'wave_timeout': 60, 'pause': 0, 'scope': {'service': 'nova'}}
+        state.update(kwargs)
+        return state
+
+    def test_run_rollout(self):
+        with nested(mock.patch.object(self.do, 'rollout_state'),
+                    mock.patch.object(self.do, '_save_rollout'),
+                    mock.patch.object(self.do.backend, 'txn'),
+                    mock.patch.object(self.do, 'wait_for_version'),
+                    mock.patch.object(self.do, 'trigger_update'),
+                    mock.patch.object(self.do, '_touch_current_version'),
+                    mock.patch.object(self.do, '_consul_request')
+          ) as (rollout_state, save_rollout, kv_txn, wait_for_version, trigger_update, touch,
+                consul_request):
+            rollout_state.return_value = (self.rollout(), 5)
+            save_rollout.return_value = 6
+            wait_for_version.return_value = True
+            self.assertTrue(self.do.run_rollout())
+            self.assertEquals(kv_txn.call_args_list,
+                              [mock.call([('set', 'target_version/cp1', 'v2'),
+                                          ('set', 'target_version/cp2', 'v2')]),
+                               mock.call([('set', 'target_version/cp3', 'v2')])])
+            self.assertEquals([(c[0][1], c[0][2], c[1]) for c in wait_for_version.call_args_list],
+                              [(3, 60, {'progress': None, 'service': 'nova'}),
+                               (4, 60, {'progress': None, 'service': 'nova'})])
+            # Watchers of /current_version are woken as each wave is admitted
+            self.assertEquals(touch.call_count, 2)
+            trigger_update.assert_called_with('v2')
+            consul_request.assert_called_with('DELETE', 'kv/target_version/', {'recurse': True})
+            self.assertEquals(save_rollout.call_args[0][0]['status'], 'done')
+
+    def test_run_rollout_halts_and_resumes(self):
+        with nested(mock.patch.object(self.do, 'rollout_state'),
+                    mock.patch.object(self.do, '_save_rollout'),
+                    mock.patch.object(self.do.backend, 'txn'),
+                    mock.patch.object(self.do, 'wait_for_version'),
+                    mock.patch.object(self.do, 'trigger_update'),
+                    mock.patch.object(self.do, '_touch_current_version')
+          ) as (rollout_state, save_rollout, kv_txn, wait_for_version, trigger_update, touch):
+            rollout_state.return_value = (self.rollout(), 5)
+            wait_for_version.return_value = False
+            self.assertFalse(self.do.run_rollout())
+            state = save_rollout.call_args[0][0]
+            self.assertEquals((state['status'], state['wave']), ('halted', 0))
+            self.assertEquals(state['reason'], 'A check went critical during wave 1')
+            self.assertFalse(trigger_update.called)
+
+            # Resuming waits for the admitted wave again without readmitting it
+            kv_txn.reset_mock()
+            rollout_state.return_value = (self.rollout(status='halted', wave=0), 7)
+            wait_for_version.side_effect = [True, None]
+            self.assertFalse(self.do.run_rollout())
+            self.assertEquals(kv_txn.call_args_list,
+                              [mock.call([('set', 'target_version/cp3', 'v2')])])
+            self.assertEquals(save_rollout.call_args[0][0]['reason'], 'Wave 2 timed out')
+
+    def test_run_rollout_nothing_to_run(self):
+        with mock.patch.object(self.do, 'rollout_state') as rollout_state:
+            rollout_state.return_value = (None, 0)
+            self.assertRaises(Exception, self.do.run_rollout)
+            rollout_state.return_value = (self.rollout(status='done'), 3)
+            self.assertRaises(Exception, self.do.run_rollout)
+
+    def test_save_rollout_conflict(self):
+        with mock.patch.object(self.do.backend, 'put') as kv_put:
+            kv_put.return_value = False
+            self.assertRaises(Exception, self.do._save_rollout, {}, 5)
+            kv_put.assert_called_with('rollout/state', '{}', cas=5)
+
+    def test_follow(self):
+        blocking_get, calls = self.fake_blocking_get({
+            'kv/x': [('a', 5), IOError('refused'), ('a', 5), ('b', 9), ('c', 3), ('d', 4), ('e', 5)]})
+        seen = []
+        stop = threading.Event()
+        def callback(data):
+            seen.append(data)
+            if data == 'd':
+                stop.set()
+        with nested(mock.patch.object(self.do, '_blocking_get', side_effect=blocking_get),
+                    mock.patch('time.sleep')):
+            self.do._follow(lambda index, wait: self.do._blocking_get('kv/x', {}, index, wait),
+                            callback, stop)
+        # Unchanged indexes are skipped, and a lower one starts over
+        self.assertEquals(seen, ['a', 'b', 'c', 'd'])
+        self.assertEquals([index for path, index in calls], [0, 5, 5, 5, 9, 0])
+
+    def test_watch_update_known_version(self):
+        with mock.patch.object(self.do.backend, 'get') as kv_get:
+            kv_get.side_effect = [('v2', 10), ('v3', 11)]
+            self.assertEquals(self.do.watch_update(known_version='v2'), 'v3')
+
+    def test_watch_update_timeout(self):
+        with nested(mock.patch.object(self.do.backend, 'get'),
+                    mock.patch('time.time')
+          ) as (kv_get, time):
+            time.side_effect = [100, 100, 161]
+            kv_get.return_value = ('v1', 10)
+            self.assertEquals(self.do.watch_update(known_version='v1', wait=300, timeout=60), None)
+            self.assertEquals(kv_get.call_args[1]['wait'], 60)
+    def test_gc_versions(self):
+        with nested(mock.patch.object(self.do, 'live_nodes'),
+                    mock.patch.object(self.do, 'running_versions'),
+                    mock.patch.object(self.do.backend, 'iter_keys'),
+                    mock.patch.object(self.do.backend, 'record'),
+                    mock.patch.object(self.do.backend, 'txn')
+          ) as (live_nodes, running_versions, iter_kv_keys, kv_record, kv_txn):
+            live_nodes.return_value = set(['cp1', 'cp2'])
+            running_versions.return_value = set(['v1', 'v2'])
+            keys = {'running_version/v1/': ['running_version/v1/', 'running_version/v1/cp1',
+                                            'running_version/v1/old1', 'running_version/v1/old2',
+                                            'running_version/v1/old3'],
+                    'running_version/v2/': ['running_version/v2/cp2']}
+            iter_kv_keys.side_effect = lambda prefix: iter(keys[prefix])
+            kv_record.return_value = ('4', 77)
+            kv_txn.return_value = True
+
+            self.assertEquals(self.do.gc_versions(dry_run=True), {'v1': 3})
+            self.assertFalse(kv_txn.called)
+
+            self.assertEquals(self.do.gc_versions(batch_size=2), {'v1': 3})
+            self.assertEquals(kv_txn.call_args_list, [
+                mock.call([('delete', 'running_version/v1/old1'),
+                           ('delete', 'host_version/old1'),
+                           ('delete', 'running_version/v1/old2'),
+                           ('delete', 'host_version/old2'),
+                           ('cas', 'version_count/v1', '2', 77)]),
+                mock.call([('delete', 'running_version/v1/old3'),
+                           ('delete', 'host_version/old3'),
+                           ('cas', 'version_count/v1', '3', 77)])])
+
+    def test_gc_versions_batch_size(self):
+        with nested(mock.patch.object(self.do, 'live_nodes'),
+                    mock.patch.object(self.do, 'running_versions'),
+                    mock.patch.object(self.do.backend, 'iter_keys'),
+                    mock.patch.object(self.do.backend, 'record'),
+                    mock.patch.object(self.do.backend, 'txn')
+          ) as (live_nodes, running_versions, iter_kv_keys, kv_record, kv_txn):
+            live_nodes.return_value = set(['cp1'])
+            running_versions.return_value = set(['v1'])
+            iter_kv_keys.return_value = ['running_version/v1/old%d' % i for i in range(40)]
+            kv_record.return_value = ('40', 77)
+            kv_txn.return_value = True
+            self.assertEquals(self.do.gc_versions(), {'v1': 40})
+            # As many hosts as fit in one transaction
+            self.assertEquals([len(c[0][0]) for c in kv_txn.call_args_list], [63, 19])
+            self.assertRaises(ValueError, self.do.gc_versions, batch_size=32)
+            self.assertRaises(ValueError, self.do.gc_versions, batch_size=-1)
+            self.assertEquals(live_nodes.call_count, 1)
+
+    def test_main_gc_versions_bad_batch_size(self):
+        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator'),
+                    mock.patch('sys.stderr', new_callable=StringIO.StringIO)
+          ) as (DO, stderr):
+            DO.return_value.gc_versions.side_effect = ValueError('The batch size must be between 1 and 31, not 40')
+            self.assertRaises(SystemExit, orchestrate.main,
+                              ['--no_agent', 'gc_versions', '--batch_size', '40'])
+            self.assertIn('The batch size must be between 1 and 31', stderr.getvalue())
+
+    def test_gc_versions_empty_catalog(self):
+        with mock.patch.object(self.do, 'live_nodes') as live_nodes:
+            live_nodes.return_value = set()
+            self.assertRaises(HTTPError, self.do.gc_versions)
+
+class AgentTests(unittest.TestCase):
+    def setUp(self, *args, **kwargs):
+        super(AgentTests, self).setUp(*args, **kwargs)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'agent.sock')
+        self.do = DeploymentOrchestrator('127.0.0.1', 8500)
+        self.agent = orchestrate_agent.Agent(self.path, self.do)
+        self.thread = threading.Thread(target=self.agent.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.agent.shutdown()
+        self.thread.join()
+        self.agent.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_call_agent(self):
+        with mock.patch.object(self.do, 'current_version') as current_version:
+            current_version.return_value = 'v12'
+            result = orchestrate.call_agent(self.path, ['current_version'])
+            self.assertEquals(result, {'rc': None, 'stdout': 'v12\n', 'stderr': ''})
+
+    def test_call_agent_exit_code(self):
+        with mock.patch.object(self.do, 'check_single_version') as check_single_version:
+            check_single_version.return_value = False
+            result = orchestrate.call_agent(self.path, ['check_single_version', 'v1'])
+            self.assertEquals(result['rc'], True)
+            check_single_version.assert_called_with('v1', False, False)
+
+    def test_call_agent_exception(self):
+        with mock.patch.object(self.do, 'trigger_update') as trigger_update:
+            trigger_update.side_effect = ValueError('boom')
+            result = orchestrate.call_agent(self.path, ['trigger_update', 'v2'])
+            self.assertEquals(result['rc'], 1)
+            self.assertIn('ValueError: boom', result['stderr'])
+
+    def test_main_uses_agent(self):
+        with nested(
+                mock.patch.object(self.do, 'current_version'),
+                mock.patch('jiocloud.orchestrate.DeploymentOrchestrator'),
+                mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                ) as (current_version, DO, stdout):
+            current_version.return_value = 'v12'
+            orchestrate.main(['--agent_socket', self.path, 'current_version'])
+            self.assertFalse(DO.called)
+            self.assertEquals(stdout.getvalue(), 'v12\n')
+
+    def test_main_splay_only_in_client(self):
+        with nested(
+                mock.patch.object(self.do, 'current_version'),
+                mock.patch('random.uniform'),
+                mock.patch('time.sleep'),
+                mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                ) as (current_version, uniform, sleep, stdout):
+            current_version.return_value = 'v12'
+            uniform.return_value = 12
+            orchestrate.main(['--agent_socket', self.path, '--splay', '30', 'current_version'])
+            # The agent runs the same argv, but doesn't sleep again
+            sleep.assert_called_once_with(12)
+            self.assertEquals(stdout.getvalue(), 'v12\n')
+            sleep.reset_mock()
+            orchestrate.main(['--splay', '30', 'current_version'], do=self.do)
+            self.assertFalse(sleep.called)
+
+    def test_main_no_agent(self):
+        with nested(
+                mock.patch('jiocloud.orchestrate.call_agent'),
+                mock.patch('jiocloud.orchestrate.DeploymentOrchestrator'),
+                mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                ) as (call_agent, DO, stdout):
+            DO.return_value.current_version.return_value = 'v13'
+            orchestrate.main(['--agent_socket', self.path, '--no_agent', 'current_version'])
+            self.assertFalse(call_agent.called)
+            self.assertEquals(stdout.getvalue(), 'v13\n')
+
+    def test_already_running(self):
+        self.assertRaises(Exception, orchestrate_agent.Agent, self.path, self.do)
+
+    def listen(self, name):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(os.path.join(self.tmpdir, name))
+        server.listen(1)
+        self.addCleanup(server.close)
+        return server
+
+    def test_call_agent_hung(self):
+        self.listen('hung')
+        self.assertEquals(orchestrate.call_agent(os.path.join(self.tmpdir, 'hung'), ['ping'],
+                                                 timeout=0.1), None)
+
+    def test_call_agent_dies(self):
+        server = self.listen('dying')
+        def answer():
+            conn, addr = server.accept()
+            conn.recv(65536)
+            conn.sendall('{"rc": 0, "std')
+            conn.close()
+        thread = threading.Thread(target=answer)
+        thread.start()
+        self.assertEquals(orchestrate.call_agent(os.path.join(self.tmpdir, 'dying'), ['ping'],
+                                                 timeout=5), None)
+        thread.join()
+
+    def test_main_agent_gives_up(self):
+        with nested(
+                mock.patch('jiocloud.orchestrate.call_agent'),
+                mock.patch('jiocloud.orchestrate.DeploymentOrchestrator'),
+                mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                ) as (call_agent, DO, stdout):
+            call_agent.return_value = None
+            DO.return_value.current_version.return_value = 'v13'
+            orchestrate.main(['--agent_socket', self.path, 'current_version'])
+            self.assertEquals(stdout.getvalue(), 'v13\n')
 
+    def test_call_agent_not_running(self):
+        self.assertEquals(orchestrate.call_agent(os.path.join(self.tmpdir, 'nope'), ['ping']), None)
+        open(os.path.join(self.tmpdir, 'stale'), 'w').close()
+        self.assertEquals(orchestrate.call_agent(os.path.join(self.tmpdir, 'stale'), ['ping']), None)
@@ -0,0 +1,42 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import __builtin__
+import sys
+import unittest
+from jiocloud import startup_benchmark
+
+class TestStartupBenchmark(unittest.TestCase):
+    def test_import_timer(self):
+        sys.modules.pop('colorsys', None)
+        import_ = __builtin__.__import__
+        with startup_benchmark.ImportTimer() as timer:
+            import colorsys
+            import sys as _sys
+        self.assertTrue(__builtin__.__import__ is import_)
+        self.assertEquals([(depth, name) for depth, name, s, c in timer.times], [(0, 'colorsys')])
+        depth, name, self_secs, cumulative = timer.times[0]
+        self.assertTrue(0 <= self_secs <= cumulative)
+
+    def test_format_import_times(self):
+        self.assertEquals(startup_benchmark.format_import_times([(1, 'b', 0.001, 0.001),
+                                                                 (0, 'a', 0.002, 0.003)]).split('\n'),
+                          ['import time: self [us] | cumulative | imported package',
+                           'import time:      1000 |       1000 |   b',
+                           'import time:      2000 |       3000 | a'])
+
+    def test_import_times(self):
+        times = startup_benchmark.import_times(['--no_agent', 'local_version'])
+        names = [name for depth, name, s, c in times]
+        self.assertTrue('jiocloud' in names)
+        self.assertFalse('consulate' in names)
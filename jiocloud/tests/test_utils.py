@@ -0,0 +1,119 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import nested
+from jiocloud import fakenova
+from jiocloud import utils
+
+class TestUtils(unittest.TestCase):
+    def test_rate_limiter(self):
+        with nested(mock.patch('time.sleep'), mock.patch('time.time')) as (sleep, now):
+            now.return_value = 100.0
+            limiter = utils.RateLimiter(rate=4)
+            limiter.wait()
+            limiter.wait()
+            limiter.wait()
+            self.assertEquals(sleep.call_args_list, [mock.call(0.25), mock.call(0.5)])
+
+    def test_rate_limiter_unlimited(self):
+        with nested(mock.patch('time.sleep'), mock.patch('time.time')) as (sleep, now):
+            limiter = utils.RateLimiter()
+            limiter.wait()
+            limiter.wait()
+            self.assertFalse(sleep.called)
+
+    def test_run_in_pool(self):
+        def func(x):
+            if x == 3:
+                raise ValueError(x)
+            return x * 2
+
+        results, failures = utils.run_in_pool(func, range(6), concurrency=3)
+        self.assertEquals(results, [(0, 0), (1, 2), (2, 4), (4, 8), (5, 10)])
+        self.assertEquals([item for item, e in failures], [3])
+        self.assertTrue(isinstance(failures[0][1], ValueError))
+
+    def test_run_in_pool_empty(self):
+        self.assertEquals(utils.run_in_pool(lambda x: x, [], concurrency=5), ([], []))
+
+    def test_iter_servers_paginates(self):
+        nova_client = mock.Mock()
+        pages = [[mock.Mock(id=1), mock.Mock(id=2)],
+                 [mock.Mock(id=3), mock.Mock(id=4)],
+                 [mock.Mock(id=5)]]
+        nova_client.servers.list.side_effect = pages
+        self.assertEquals([s.id for s in utils.iter_servers(nova_client, page_size=2)],
+                          [1, 2, 3, 4, 5])
+        self.assertEquals(nova_client.servers.list.call_args_list,
+                          [mock.call(detailed=True, search_opts=None, marker=None, limit=2),
+                           mock.call(detailed=True, search_opts=None, marker=2, limit=2),
+                           mock.call(detailed=True, search_opts=None, marker=4, limit=2)])
+
+    def test_iter_servers_below_page_size(self):
+        # The cloud's osapi_max_limit is below the page size asked for
+        nova_client = fakenova.FakeNovaClient(max_limit=500)
+        nova_client.add_servers(['cp%d_ci' % i for i in range(1, 1201)])
+        servers = list(utils.iter_servers(nova_client, search_opts={'name': '_ci$'}))
+        self.assertEquals(len(servers), 1200)
+        # Once a full page has been seen, a shorter one is the last
+        self.assertEquals(nova_client.calls, {'servers.list': 3})
+        # but a single short page might be capped too
+        nova_client = fakenova.FakeNovaClient(max_limit=500)
+        nova_client.add_servers(['cp1_ci'])
+        self.assertEquals(len(list(utils.iter_servers(nova_client))), 1)
+        self.assertEquals(nova_client.calls, {'servers.list': 2})
+
+    def test_resolution_cache(self):
+        fetch = mock.Mock(side_effect=lambda k: k + '-id')
+        cache = utils.ResolutionCache()
+        self.assertEquals(cache.get('image', 'ubuntu', fetch), 'ubuntu-id')
+        self.assertEquals(cache.get('image', 'ubuntu', fetch), 'ubuntu-id')
+        self.assertEquals(cache.get('flavor', 'ubuntu', fetch), 'ubuntu-id')
+        self.assertEquals(fetch.call_count, 2)
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+
+    def test_resolution_cache_expires(self):
+        fetch = mock.Mock(side_effect=lambda k: k + '-id')
+        with mock.patch('time.time') as now:
+            now.return_value = 1000
+            cache = utils.ResolutionCache(ttl=60)
+            cache.get('image', 'ubuntu', fetch)
+            now.return_value = 1059
+            cache.get('image', 'ubuntu', fetch)
+            self.assertEquals(fetch.call_count, 1)
+            now.return_value = 1061
+            cache.get('image', 'ubuntu', fetch)
+            self.assertEquals(fetch.call_count, 2)
+
+    def test_resolution_cache_persists(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'sub', 'cache.json')
+            fetch = mock.Mock(side_effect=lambda k: k + '-id')
+            cache = utils.ResolutionCache(path, 'cloud1')
+            cache.get('image', 'ubuntu', fetch)
+            cache.save()
+            utils.ResolutionCache(path, 'cloud2').save()
+
+            cache = utils.ResolutionCache(path, 'cloud1')
+            self.assertEquals(cache.get('image', 'ubuntu', fetch), 'ubuntu-id')
+            self.assertEquals(fetch.call_count, 1)
+            cache = utils.ResolutionCache(path, 'cloud2')
+            cache.get('image', 'ubuntu', fetch)
+            self.assertEquals(fetch.call_count, 2)
+        finally:
+            shutil.rmtree(tmpdir)
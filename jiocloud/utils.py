@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 import argparse
 import IPy
+import json
 import os
+import Queue
+import threading
+import time
 from novaclient import client as novaclient
 
 """
@@ -26,18 +30,180 @@ def is_rfc1918(ip_string):
 def is_ipv4(ip_string):
     return IPy.IP(ip_string).version() == 4
 
-def get_ip_of_node(nova_client, name):
+def iter_servers(nova_client, search_opts=None, page_size=1000):
+    """
+    Walk the detailed server list one page of up to `page_size`
+    servers at a time, following the marker of the last server on each
+    page. Nova caps pages at its osapi_max_limit, which may be below
+    page_size, so a short page only ends the walk if an earlier page
+    was longer; otherwise it takes an empty page.
+    """
+    marker = None
+    longest = 0
+    while True:
+        page = nova_client.servers.list(detailed=True,
+                                        search_opts=search_opts,
+                                        marker=marker,
+                                        limit=page_size)
+        # A cloud that ignores the marker hands back the same page
+        if not page or page[-1].id == marker:
+            return
+        for server in page:
+            yield server
+        if len(page) < longest:
+            return
+        longest = len(page)
+        marker = page[-1].id
+
+def get_public_ip(server):
+    """
+    Return the first public IPv4 address of a server,
+    or whatever address it has if none of them are public
+    """
     ip = None
+    for network in server.networks.values():
+        for ip in network:
+            if is_ipv4(ip) and not is_rfc1918(ip):
+                return ip
+    # Fallthrough... If none are non-rfc1918 just return whatever
+    return ip
+
+def get_ip_index(nova_client, names=None, page_size=1000):
+    """
+    Build a dict of server name to IP from a single listing,
+    optionally restricted to the given set of names
+    """
+    index = {}
+    for server in iter_servers(nova_client, page_size=page_size):
+        if names is None or server.name in names:
+            index[server.name] = get_public_ip(server)
+    return index
+
+def get_ip_of_node(nova_client, name):
     for server in nova_client.servers.list():
         if server.name == name:
-            for network in server.networks.values():
-                for ip in network:
-                    if is_ipv4(ip) and not is_rfc1918(ip):
-                        return ip
-            # Fallthrough... If none are non-rfc1918 just return whatever
-            return ip
+            return get_public_ip(server)
     raise Exception('Server not found')
 
+class RateLimiter(object):
+    """
+    Spaces calls to wait() out so that no more than `rate`
+    of them return per second. A rate of None means no limit.
+    """
+    def __init__(self, rate=None):
+        self.interval = rate and 1.0 / rate or 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class ResolutionCache(object):
+    """
+    Thread safe cache of lookups such as image and flavor ids, optionally
+    persisted to a JSON file at `path`. Entries expire after `ttl` seconds
+    and are kept under `namespace` in the file, so that several clouds or
+    tenants can share one cache file.
+    """
+    def __init__(self, path=None, namespace='', ttl=86400):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = self._read().get(namespace, {})
+
+    def _read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, kind, key, fetch):
+        """
+        Return the cached value for (kind, key), calling fetch(key)
+        to look it up if it is missing or has expired
+        """
+        cache_key = '%s:%s' % (kind, key)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry and entry[1] > time.time() - self.ttl:
+                self.hits += 1
+                return entry[0]
+            # Holding the lock while fetching means concurrent
+            # lookups of the same key only hit the API once
+            value = fetch(key)
+            self.misses += 1
+            self.entries[cache_key] = (value, time.time())
+            return value
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            now = time.time()
+            data = self._read()
+            data[self.namespace] = dict((k, v) for k, v in self.entries.iteritems()
+                                        if v[1] > now - self.ttl)
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = '%s.%d' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as fp:
+                json.dump(data, fp)
+            os.rename(tmp_path, self.path)
+
+def run_in_pool(func, items, concurrency=1, rate=None):
+    """
+    Call func on each item from a pool of `concurrency` threads,
+    starting no more than `rate` calls per second.
+
+    Exceptions do not stop the other calls. Returns a list of
+    (item, result) for the calls that succeeded and a list of
+    (item, exception) for the ones that failed, both in input order.
+    """
+    items = list(items)
+    limiter = RateLimiter(rate)
+    queue = Queue.Queue()
+    for i in range(len(items)):
+        queue.put(i)
+    outcome = [None] * len(items)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            limiter.wait()
+            try:
+                outcome[i] = (True, func(items[i]))
+            except Exception, e:
+                outcome[i] = (False, e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(concurrency, len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    results = [(items[i], o[1]) for i, o in enumerate(outcome) if o[0]]
+    failures = [(items[i], o[1]) for i, o in enumerate(outcome) if not o[0]]
+    return results, failures
+
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     subparsers = argparser.add_subparsers(dest='action', help='Action to perform')